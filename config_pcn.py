@@ -1,6 +1,10 @@
 # -*- coding: utf-8 -*-
 # @Author: XP
 
+import json
+import logging
+import os
+import socket
 from easydict import EasyDict as edict
 
 __C                                              = edict()
@@ -25,6 +29,8 @@ __C.DATASETS.SHAPENET.SEG_COMPLETE_POINTS_PATH    = './datasets/ShapeNetPartV0/%
 __C.DATASETS.SHAPENET.SEGMENTATION_FILE_PATH  = './datasets/ShapeNetPartV0.json'
 __C.DATASETS.SHAPENET.PARTIAL_LABELS_PATH     = './datasets/ShapeNetPartV0/%s/partial/%s/%s-%d.txt'
 __C.DATASETS.SHAPENET.COMPLETE_LABELS_PATH    = './datasets/ShapeNetPartV0/%s/complete/%s/%s.txt'
+__C.DATASETS.SHAPENET.SEG_PACKED_POINTS_PATH  = './datasets/ShapeNetPartV0/%s/complete/%s/%s.npy'
+__C.DATASETS.SHAPENET.PACKED_LABELS          = False
 __C.DATASETS.MODELNET                            = edict()
 __C.DATASETS.MODELNET.CATEGORY_FILE_PATH         = './datasets/ModelNet40/modelnet40_shape_names.txt'
 __C.DATASETS.MODELNET.N_RENDERINGS               = 8
@@ -38,6 +44,26 @@ __C.DATASETS.SCANOBNN.N_RENDERINGS               = 8
 __C.DATASETS.SCANOBNN.N_POINTS                   = 1024
 __C.DATASETS.SCANOBNN.PARTIAL_POINTS_PATH        = './datasets/'+__C.DATASETS.SCANOBNN.TYPE+'/%s/partial/%s/%s/%s-%d.pcd'
 __C.DATASETS.SCANOBNN.COMPLETE_POINTS_PATH       = './datasets/'+__C.DATASETS.SCANOBNN.TYPE+'/%s/complete/%s/%s.pcd'
+__C.DATASETS.SHARDS                              = edict()
+__C.DATASETS.SHARDS.SOURCE                       = 'ModelNet40' # loader whose samples were sharded
+__C.DATASETS.SHARDS.DIR                          = './datasets/shards'
+__C.DATASETS.SHARDS.SHUFFLE_BUFFER               = 1000
+__C.DATASETS.SHARDS.READ_AHEAD                   = 64
+__C.DATASETS.SHARDS.SEED                         = 0
+__C.DATASETS.CACHE                               = edict()
+__C.DATASETS.CACHE.ENABLED                       = False # in /dev/shm; docker defaults to --shm-size 64m
+__C.DATASETS.CACHE.MAX_BYTES                     = 2 * 1024 ** 3 # shared by all workers, capped to half the free /dev/shm
+__C.DATASETS.CACHE.MAX_ENTRIES                   = 65536
+__C.DATASETS.CACHE.ITEMS                         = ['gtcloud']
+__C.DATASETS.MANIFEST                            = edict()
+__C.DATASETS.MANIFEST.ENABLED                    = True
+__C.DATASETS.MANIFEST.CACHE_DIR                  = './datasets/.manifests'
+# Synthesise seed-and-patch partials from the complete clouds instead of reading */partial/* files
+__C.DATASETS.ONLINE_PARTIAL                      = edict()
+__C.DATASETS.ONLINE_PARTIAL.ENABLED              = False
+__C.DATASETS.ONLINE_PARTIAL.NUM_SEED             = 64
+__C.DATASETS.ONLINE_PARTIAL.K                    = 16
+__C.DATASETS.ONLINE_PARTIAL.CACHE_DIR            = './datasets/.neighbours'
 #
 # Dataset
 #
@@ -59,6 +85,7 @@ __C.CONST                                        = edict()
 __C.DIR                                          = edict()
 __C.DIR.OUT_PATH                                 = './output'
 __C.CONST.NUM_WORKERS                            = 20
+__C.CONST.PREFETCH_FACTOR                        = 2 # batches loaded ahead by each training DataLoader worker
 __C.CONST.DEVICE                                 = '0,1,2,3,4,5,6,7,8,9'#
 __C.CONST.N_INPUT_POINTS                         = 2048
 # __C.CONST.WEIGHTS                                = './output/checkpoints/2023-08-14T17:54:32.027133/ckpt-best.pth' #
@@ -68,6 +95,14 @@ __C.CONST.N_INPUT_POINTS                         = 2048
 #
 # Memcached
 #
+__C.STORAGE                                      = edict()
+__C.STORAGE.BACKEND                              = 'local' # local, tar, kv or memcached (also set by MEMCACHED.ENABLED)
+__C.STORAGE.N_THREADS                            = 8
+__C.STORAGE.TAR_SHARDS                           = './datasets/shards/*.tar'
+__C.STORAGE.KV_ADDRESS                           = '/tmp/pcd_kv.sock' # Unix socket of a utils.storage.KVServer
+__C.STORAGE.POOL_SIZE                            = 4
+__C.STORAGE.QPC_BITS                             = 16 # .qpc point files: fixed-point bits per coordinate
+__C.STORAGE.QPC_ZSTD                             = False
 __C.MEMCACHED                                    = edict()
 __C.MEMCACHED.ENABLED                            = False
 __C.MEMCACHED.LIBRARY_PATH                       = '/mnt/lustre/share/pymc/py3'
@@ -96,8 +131,96 @@ __C.TRAIN.BETAS                                  = (.9, .999)
 __C.TRAIN.WEIGHT_DECAY                           = 0
 __C.TRAIN.NOMI                                   = False
 __C.TRAIN.CODE                                   = False
+__C.TRAIN.BATCH_AUGMENTATION                     = False # augment collated batches on device, not per sample
+__C.TRAIN.N_VIEWS                                = 1 # partial views per object in a training batch, gt loaded once
+__C.TRAIN.LOG_FREQ                               = 50 # steps between host syncs of the training metrics
+__C.TRAIN.MICRO_BATCH                            = edict() # gradient accumulation over micro-batches of a batch
+__C.TRAIN.MICRO_BATCH.SIZE                       = 0 # samples per forward/backward; 0: whole batch, -1: auto
+__C.TRAIN.MICRO_BATCH.MEMORY_BUDGET              = 0 # GiB per device for SIZE = -1; 0: 90% of device memory
+__C.TRAIN.CHECKPOINT                             = edict()
+__C.TRAIN.CHECKPOINT.SAVE_FREQ                   = 1 # epochs between checkpoints of train_25 (written asynchronously)
+__C.TRAIN.CHECKPOINT.KEEP_LAST                   = 3 # most recent epoch checkpoints kept
+__C.TRAIN.CHECKPOINT.KEEP_BEST                   = 3 # best checkpoints by validation accuracy kept
+__C.TRAIN.CHECKPOINT.RESUME                      = '' # checkpoint, or checkpoint directory, to continue from
+__C.TRAIN.DDP                                    = edict() # used by main25_ddp.py
+__C.TRAIN.DDP.BACKEND                            = '' # nccl with CUDA, gloo on CPU-only hosts when empty
+__C.TRAIN.DDP.SYNC_BN                            = False # SyncBatchNorm across ranks (CUDA only)
+__C.TRAIN.PROFILE                                = edict() # torch.profiler traces of train_25 steps (or --profile)
+__C.TRAIN.PROFILE.ENABLED                        = False
+__C.TRAIN.PROFILE.WAIT                           = 5 # steps skipped, e.g. cudnn autotuning
+__C.TRAIN.PROFILE.WARMUP                         = 3 # steps traced but discarded
+__C.TRAIN.PROFILE.ACTIVE                         = 10 # steps recorded per trace
+__C.TRAIN.PROFILE.REPEAT                         = 1 # traces written; 0: until the end of training
+__C.TRAIN.PROFILE.RECORD_SHAPES                  = False
+__C.TRAIN.PROFILE.PROFILE_MEMORY                 = False
+__C.TRAIN.PROFILE.WITH_STACK                     = False
+__C.TRAIN.PROFILE.MODULES                        = ['FeatureExtractor', 'SeedGenerator', 'SPD', 'SkipTransformer',
+                                                    'PointNet_SD_Cascade', 'PointNet_SA_Module_KNN']
+__C.TRAIN.PROFILE.FUNCTIONS                      = ['models.utils.fps_subsample', 'models.utils.query_knn',
+                                                    'models.utils.grouping_operation',
+                                                    'models.utils.furthest_point_sample',
+                                                    'utils.loss_utils.chamfer', 'utils.loss_utils.chamfer_sqrt',
+                                                    'utils.loss_utils.chamfer_single_side',
+                                                    'utils.loss_utils.chamfer_single_side_sqrt']
 #
 # Test
 #
 __C.TEST                                         = edict()
 __C.TEST.METRIC_NAME                             = 'ChamferDistance'
+__C.TEST.EVAL_CACHE                              = edict()
+__C.TEST.EVAL_CACHE.ENABLED                      = True
+__C.TEST.EVAL_CACHE.DIR                          = './datasets/.eval_cache' # memmapped across runs; '' keeps it in memory
+__C.TEST.EVAL_CACHE.BATCH_SIZE                   = 512
+__C.TEST.EVAL_CACHE.SEED                         = 0
+__C.TEST.ASYNC_EVAL                              = edict() # validate in a separate process while training continues
+__C.TEST.ASYNC_EVAL.ENABLED                      = False
+__C.TEST.ASYNC_EVAL.DEVICE                       = '' # '' shares the training GPUs, 'cpu', or CUDA device ids, e.g. '9'
+__C.TEST.ASYNC_EVAL.FREQ                         = 1 # epochs between weight snapshots
+
+#
+# Machine-specific overlay (written by python -m utils.autotune), applied last
+#
+__C.CONST.MACHINE_CONFIG                         = os.environ.get('PCN_MACHINE_CONFIG',
+                                                                  './configs/machine/%s.json' % socket.gethostname())
+
+
+def merge_overlay(config, overlay, prefix=''):
+    """Merges `overlay` into `config`; returns the dotted names of the keys set"""
+    # Keys starting with '_' hold notes, e.g. the autotuner's measurements
+    applied = []
+    for k, v in overlay.items():
+        if k.startswith('_'):
+            continue
+        if isinstance(v, dict) and isinstance(config.get(k), dict):
+            applied.extend(merge_overlay(config[k], v, prefix + k + '.'))
+        else:
+            config[k] = v
+            applied.append('%s%s=%s' % (prefix, k, v))
+    return applied
+
+
+def _ddp_batch_size(overlay, world_size):
+    """The autotuner measures TRAIN.BATCH_SIZE with DataParallel over the GPUs of one host; under DDP the
+    global batch is shared out over `world_size` ranks, so keep the tuned size per GPU instead"""
+    n_devices = len(overlay.get('_autotune', {}).get('devices', []))
+    return overlay['TRAIN']['BATCH_SIZE'] // n_devices * world_size if n_devices > 0 else None
+
+
+if os.path.exists(__C.CONST.MACHINE_CONFIG):
+    # A named logger: reports through the last-resort handler without configuring the root logger,
+    # whose format the entry points set up after importing this module
+    _logger = logging.getLogger(__name__)
+    with open(__C.CONST.MACHINE_CONFIG) as f:
+        _overlay = json.load(f)
+    _world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if _world_size > 1 and 'BATCH_SIZE' in _overlay.get('TRAIN', {}):
+        _batch_size = _ddp_batch_size(_overlay, _world_size)
+        if _batch_size is None:
+            _logger.warning('Ignoring TRAIN.BATCH_SIZE of %s: tuned without a device count' %
+                            __C.CONST.MACHINE_CONFIG)
+            del _overlay['TRAIN']['BATCH_SIZE']
+        else:
+            _overlay['TRAIN']['BATCH_SIZE'] = _batch_size
+    _applied = merge_overlay(__C, _overlay)
+    if _applied:
+        _logger.warning('Machine config %s overrides %s' % (__C.CONST.MACHINE_CONFIG, ', '.join(_applied)))
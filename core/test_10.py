@@ -25,7 +25,7 @@ def test_net(cfg, epoch_idx=-1, test_data_loader=None, test_writer=None, model=N
         test_data_loader = torch.utils.data.DataLoader(dataset=dataset_loader.get_dataset(dload.DatasetSubset.TEST),
                                                        batch_size=100,
                                                        num_workers=cfg.CONST.NUM_WORKERS//2,
-                                                       collate_fn=dload.collate_fn4,
+                                                       collate_fn=dload.BatchCollator(segmentation=True),
                                                        pin_memory=True,
                                                        shuffle=False)
         color_json = './datasets/shapenet_part_seg_hdf5_data/part_color_mapping.json'
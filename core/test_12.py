@@ -18,14 +18,12 @@ def test_net(cfg, epoch_idx=-1, test_data_loader=None, test_writer=None, model=N
 
     if test_data_loader is None:
         # Set up data loader
+        collate_fn = utils.data_loaders.BatchCollator()
         if cfg.DATASET.TRAIN_DATASET == 'ShapeNet':
-            collate_fn = utils.data_loaders.collate_fn
             ncat = 8
         elif cfg.DATASET.TRAIN_DATASET == 'ModelNet40':
-            collate_fn = utils.data_loaders.collate_fn2
             ncat = 40
         elif cfg.DATASET.TRAIN_DATASET == 'ScanObjectNN':
-            collate_fn = utils.data_loaders.collate_fn3
             ncat = 15
         else:
             raise(NotImplementedError)
@@ -78,7 +76,7 @@ def test_net(cfg, epoch_idx=-1, test_data_loader=None, test_writer=None, model=N
 
                 partial = data['partial_cloud']
                 gt = data['gtcloud']
-                gt_label = utils.helpers.var_or_cuda(torch.Tensor(gt_label).long())
+                gt_label = utils.helpers.var_or_cuda(gt_label)
                 # print(f'test partial {partial.shape}')
                 # print(f'test gt_label {gt_label.shape}') # 64
 
@@ -1,6 +1,7 @@
 import logging
 import torch
 import utils.data_loaders
+import utils.eval_cache
 import utils.helpers
 from tqdm import tqdm
 from utils.loss_utils import *
@@ -17,25 +18,31 @@ def test_net(cfg, epoch_idx=-1, test_data_loader=None, test_writer=None, model=N
 
     if test_data_loader is None:
         # Set up data loader
+        collate_fn = utils.data_loaders.BatchCollator()
         if cfg.DATASET.TRAIN_DATASET == 'ShapeNet':
-            collate_fn = utils.data_loaders.collate_fn
             ncat = 8
         elif cfg.DATASET.TRAIN_DATASET == 'ModelNet40':
-            collate_fn = utils.data_loaders.collate_fn2
             ncat = 40
         elif cfg.DATASET.TRAIN_DATASET == 'ScanObjectNN':
-            collate_fn = utils.data_loaders.collate_fn3
             ncat = 15
         else:
             raise(NotImplementedError)
         dataset_loader = utils.data_loaders.DATASET_LOADER_MAPPING[cfg.DATASET.TEST_DATASET](cfg)
-        test_data_loader = torch.utils.data.DataLoader(dataset=dataset_loader.get_dataset(utils.data_loaders.DatasetSubset.TEST),
-                                                       batch_size=cfg.TRAIN.BATCH_SIZE,
-                                                       num_workers=cfg.CONST.NUM_WORKERS,
-                                                       collate_fn=collate_fn,
-                                                       pin_memory=True,
-                                                       shuffle=False,
-                                                       drop_last=False)
+        test_dataset = dataset_loader.get_dataset(utils.data_loaders.DatasetSubset.TEST)
+        if cfg.TEST.EVAL_CACHE.ENABLED and not isinstance(test_dataset, torch.utils.data.IterableDataset):
+            # Reused across runs through the memmapped cache in cfg.TEST.EVAL_CACHE.DIR
+            test_data_loader = utils.eval_cache.EvalCache.build(
+                test_dataset, cfg.TEST.EVAL_CACHE.BATCH_SIZE, cfg.CONST.NUM_WORKERS, cfg.TEST.EVAL_CACHE.SEED,
+                utils.eval_cache.eval_cache_dir(cfg, cfg.DATASET.TEST_DATASET, utils.data_loaders.DatasetSubset.TEST,
+                                                test_dataset))
+        else:
+            test_data_loader = torch.utils.data.DataLoader(dataset=test_dataset,
+                                                           batch_size=cfg.TRAIN.BATCH_SIZE,
+                                                           num_workers=cfg.CONST.NUM_WORKERS,
+                                                           collate_fn=collate_fn,
+                                                           pin_memory=True,
+                                                           shuffle=False,
+                                                           drop_last=False)
 
     # Setup networks and initialize networks
     if model is None:
@@ -84,7 +91,7 @@ def test_net(cfg, epoch_idx=-1, test_data_loader=None, test_writer=None, model=N
 
                 partial = data['partial_cloud']
                 gt = data['gtcloud']
-                gt_label = utils.helpers.var_or_cuda(torch.Tensor(gt_label).long())
+                gt_label = utils.helpers.var_or_cuda(gt_label)
                 # print(f'test partial {partial.shape}')
                 x_train_bat = partial.detach().cpu().numpy()#.reshape(len(taxonomy_ids), -1)
                 x_train.append(x_train_bat)
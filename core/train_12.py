@@ -25,14 +25,12 @@ def train_net(cfg):
 
     train_dataset_loader = utils.data_loaders.DATASET_LOADER_MAPPING[cfg.DATASET.TRAIN_DATASET](cfg)
     test_dataset_loader = utils.data_loaders.DATASET_LOADER_MAPPING[cfg.DATASET.TEST_DATASET](cfg)
+    collate_fn = utils.data_loaders.BatchCollator()
     if cfg.DATASET.TRAIN_DATASET == 'ShapeNet':
-        collate_fn = utils.data_loaders.collate_fn
         ncat = 8
     elif cfg.DATASET.TRAIN_DATASET == 'ModelNet40':
-        collate_fn = utils.data_loaders.collate_fn2
         ncat = 40
     elif cfg.DATASET.TRAIN_DATASET == 'ScanObjectNN':
-        collate_fn = utils.data_loaders.collate_fn3
         ncat = 15
     else:
         raise(NotImplementedError)
@@ -127,7 +125,7 @@ def train_net(cfg):
                 partial = data['partial_cloud']
                 gt = data['gtcloud']#[:, :4096, :].contiguous()
                 # print('train:', partial.shape, gt.shape)
-                gt_label = utils.helpers.var_or_cuda(torch.Tensor(gt_label).long())
+                gt_label = utils.helpers.var_or_cuda(gt_label)
 
                 pcds_pred, labels_pred, feats_cls = model(partial)
                 # print('train:', pcds_pred[-1].shape)
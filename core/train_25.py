@@ -5,14 +5,19 @@ import logging
 import os
 import torch
 import utils.data_loaders
+import utils.async_eval
+import utils.distributed
+from utils.checkpoint import CheckpointManager, get_rng_state, latest_checkpoint, set_rng_state
+import utils.eval_cache
 import utils.helpers
+import utils.micro_batch
+import utils.profiler
 from datetime import datetime
 from tqdm import tqdm
 from time import time
 import collections
-from torch.utils.tensorboard import SummaryWriter
 from core.test_25 import test_net
-from utils.average_meter import AverageMeter
+from utils.average_meter import AverageMeter, DeviceAverageMeter
 from torch.optim.lr_scheduler import StepLR, ReduceLROnPlateau
 from utils.schedular import GradualWarmupScheduler
 from utils.loss_utils import *
@@ -22,58 +27,94 @@ import numpy as np
 # from IDNNs.idnns.information import information_process as IB
 
 
+def build_val_loader(cfg, dataset_name):
+    """The per-epoch validation loader of train_net, also built by the asynchronous evaluator"""
+    dataset_loader = utils.data_loaders.DATASET_LOADER_MAPPING[cfg.DATASET.TRAIN_DATASET](cfg)
+    val_dataset = dataset_loader.get_dataset(utils.data_loaders.DatasetSubset.TRAIN)
+    if cfg.TEST.EVAL_CACHE.ENABLED and not isinstance(val_dataset, torch.utils.data.IterableDataset):
+        # Transformed once, then replayed every epoch with identical inputs
+        return utils.eval_cache.EvalCache.build(
+            val_dataset, cfg.TEST.EVAL_CACHE.BATCH_SIZE, cfg.CONST.NUM_WORKERS, cfg.TEST.EVAL_CACHE.SEED,
+            utils.eval_cache.eval_cache_dir(cfg, dataset_name, utils.data_loaders.DatasetSubset.TRAIN,
+                                            val_dataset))
+    return torch.utils.data.DataLoader(dataset=val_dataset,
+                                       batch_size=cfg.TRAIN.BATCH_SIZE,
+                                       num_workers=cfg.CONST.NUM_WORKERS,
+                                       collate_fn=utils.data_loaders.BatchCollator(),
+                                       pin_memory=True,
+                                       shuffle=False,
+                                       drop_last=False, persistent_workers=True)
+
+
+def update_best(best_metrics, best_metrics_mean, best_metrics_CD, accs, mean_accs, cd):
+    best_metrics = [max(m, a) for m, a in zip(best_metrics, accs)]
+    best_metrics_mean = [max(m, a) for m, a in zip(best_metrics_mean, mean_accs)]
+    best_metrics_CD = min(best_metrics_CD, cd)
+    print(f'Best acc: {best_metrics}, mean: {best_metrics_mean}, CD: {best_metrics_CD}')
+    return best_metrics, best_metrics_mean, best_metrics_CD
+
+
 def train_net(cfg):
     # Enable the inbuilt cudnn auto-tuner to find the best algorithm to use
     torch.backends.cudnn.benchmark = True
 
     train_dataset_loader = utils.data_loaders.DATASET_LOADER_MAPPING[cfg.DATASET.TRAIN_DATASET](cfg)
-    test_dataset_loader = utils.data_loaders.DATASET_LOADER_MAPPING[cfg.DATASET.TEST_DATASET](cfg)
-    if cfg.DATASET.TRAIN_DATASET == 'ShapeNet':
-        collate_fn = utils.data_loaders.collate_fn
+    dataset_name = cfg.DATASETS.SHARDS.SOURCE if cfg.DATASET.TRAIN_DATASET == 'Shards' else cfg.DATASET.TRAIN_DATASET
+    if dataset_name == 'ShapeNet':
         ncat = 8
-    elif cfg.DATASET.TRAIN_DATASET == 'ModelNet40':
-        collate_fn = utils.data_loaders.collate_fn2
+    elif dataset_name == 'ModelNet40':
         ncat = 40
-    elif cfg.DATASET.TRAIN_DATASET == 'ScanObjectNN':
-        collate_fn = utils.data_loaders.collate_fn3
+    elif dataset_name == 'ScanObjectNN':
         ncat = 15
     else:
         raise(NotImplementedError)
 
-    train_data_loader = torch.utils.data.DataLoader(dataset=train_dataset_loader.get_dataset(utils.data_loaders.DatasetSubset.TRAIN),
-                                                    batch_size=cfg.TRAIN.BATCH_SIZE,
-                                                    num_workers=cfg.CONST.NUM_WORKERS,
-                                                    collate_fn=collate_fn, #2: MN40,3:SCAN
+    # With DDP, BATCH_SIZE and NUM_WORKERS are shared out over the ranks (of this host, for the workers)
+    is_main = utils.distributed.is_main_process()
+    batch_size = max(1, cfg.TRAIN.BATCH_SIZE // utils.distributed.get_world_size())
+    num_workers = max(1, cfg.CONST.NUM_WORKERS // utils.distributed.get_local_world_size())
+
+    # With N_VIEWS > 1 each of the BATCH_SIZE objects contributes N_VIEWS partial views sharing one gt
+    train_dataset = train_dataset_loader.get_dataset(utils.data_loaders.DatasetSubset.TRAIN, n_views=cfg.TRAIN.N_VIEWS)
+    # Streaming datasets split shards over ranks and shuffle a buffer themselves
+    is_iterable = isinstance(train_dataset, torch.utils.data.IterableDataset)
+    train_sampler = None
+    if utils.distributed.is_distributed() and not is_iterable:
+        train_sampler = torch.utils.data.distributed.DistributedSampler(train_dataset, shuffle=True)
+    train_data_loader = torch.utils.data.DataLoader(dataset=train_dataset,
+                                                    batch_size=batch_size,
+                                                    num_workers=num_workers,
+                                                    collate_fn=utils.data_loaders.BatchCollator(n_views=cfg.TRAIN.N_VIEWS), #2: MN40,3:SCAN
                                                     pin_memory=True,
-                                                    shuffle=True,
+                                                    sampler=train_sampler,
+                                                    shuffle=train_sampler is None and not is_iterable,
+                                                    prefetch_factor=cfg.CONST.PREFETCH_FACTOR,
                                                     drop_last=False, persistent_workers=True)
-    val_data_loader = torch.utils.data.DataLoader(dataset=train_dataset_loader.get_dataset(utils.data_loaders.DatasetSubset.TRAIN),
-                                                  batch_size=cfg.TRAIN.BATCH_SIZE,
-                                                  num_workers=cfg.CONST.NUM_WORKERS,
-                                                  collate_fn=collate_fn,
-                                                  pin_memory=True,
-                                                  shuffle=False,
-                                                  drop_last=False, persistent_workers=True)
-
-    # Set up folders for logs and checkpoints
-    output_dir = os.path.join(cfg.DIR.OUT_PATH, '%s', datetime.now().isoformat())
+    # Only rank 0 evaluates, in this process or in the asynchronous evaluator
+    async_eval = is_main and cfg.TEST.ASYNC_EVAL.ENABLED
+    val_data_loader = build_val_loader(cfg, dataset_name) if is_main and not async_eval else None
+    batch_transforms = utils.data_loaders.get_batch_transforms(cfg, utils.data_loaders.DatasetSubset.TRAIN)
+
+    # Set up folders for logs and checkpoints (named by rank 0, created by rank 0 only)
+    output_dir = os.path.join(cfg.DIR.OUT_PATH, '%s', utils.distributed.broadcast_object(datetime.now().isoformat()))
     cfg.DIR.CHECKPOINTS = output_dir % 'checkpoints'
     cfg.DIR.LOGS = output_dir % 'logs'
-    if not os.path.exists(cfg.DIR.CHECKPOINTS):
-        os.makedirs(cfg.DIR.CHECKPOINTS)
     cfg.DIR.FIGPATH = output_dir % 'figs'
-    if not os.path.exists(cfg.DIR.FIGPATH):
-        os.makedirs(cfg.DIR.FIGPATH)
-
-    # Create tensorboard writers
-    train_writer = SummaryWriter(os.path.join(cfg.DIR.LOGS, 'train'))
-    val_writer = SummaryWriter(os.path.join(cfg.DIR.LOGS, 'test'))
+    if is_main:
+        if not os.path.exists(cfg.DIR.CHECKPOINTS):
+            os.makedirs(cfg.DIR.CHECKPOINTS)
+        if not os.path.exists(cfg.DIR.FIGPATH):
+            os.makedirs(cfg.DIR.FIGPATH)
+
+    # Create tensorboard writers (no-ops on the other ranks)
+    train_writer = utils.distributed.summary_writer(os.path.join(cfg.DIR.LOGS, 'train'))
+    # The asynchronous evaluator writes the test logs itself
+    val_writer = utils.distributed.summary_writer(os.path.join(cfg.DIR.LOGS, 'test')) if not async_eval else None
     # log_file = open(os.path.join(cfg.DIR.LOGS, 'logs.txt'), 'w')
 
     # model = Model(dim_feat=512, num_pc=256, num_p0=1024, up_factors=[1, 1])
     model = Model(dim_feat=512, num_pc=256, ncat=ncat, up_factors=[1, 2])
-    if torch.cuda.is_available():
-        model = torch.nn.DataParallel(model).cuda()
+    model = utils.distributed.wrap_model(model, sync_bn=cfg.TRAIN.DDP.SYNC_BN)
     total_params1 = sum(p.numel() for p in model.parameters())
     total_params2 = sum(p.numel() for p in model.parameters() if p.requires_grad)
     print(f'Number of parameters: {total_params1, total_params2}')
@@ -94,17 +135,57 @@ def train_net(cfg):
     best_metrics, best_metrics_mean = [float('-inf')]*3, [float('-inf')]*3
     best_metrics_CD = float('inf')
     steps = 0
-    counter, indices, last_idx = collections.Counter(), [], 2
-
-    if 'WEIGHTS' in cfg.CONST:
-        logging.info('Recovering from %s ...' % (cfg.CONST.WEIGHTS))
-        checkpoint = torch.load(cfg.CONST.WEIGHTS)
+    counter, last_idx = collections.Counter(), 2
+
+    # TRAIN.CHECKPOINT.RESUME (a checkpoint, or a checkpoint directory for its latest epoch) continues a run
+    # exactly; CONST.WEIGHTS only initialises the model from older, model-only checkpoints
+    resume_path = cfg.TRAIN.CHECKPOINT.RESUME
+    if resume_path and os.path.isdir(resume_path):
+        resume_path = latest_checkpoint(resume_path)
+        if resume_path is None:
+            logging.warning('No checkpoint in %s; training from scratch' % cfg.TRAIN.CHECKPOINT.RESUME)
+    if not resume_path and 'WEIGHTS' in cfg.CONST:
+        resume_path = cfg.CONST.WEIGHTS
+    rng_state = None
+    if resume_path:
+        logging.info('Recovering from %s ...' % (resume_path))
+        checkpoint = torch.load(resume_path, map_location='cpu')
         best_metrics = checkpoint['best_metrics']
+        # Checkpoints hold the DataParallel/DDP state dict ('module.' prefixed) either way
         model.load_state_dict(checkpoint['model'])
+        if 'rng_states' in checkpoint:
+            init_epoch = checkpoint['epoch_index']
+            best_metrics_mean = checkpoint['best_metrics_mean']
+            best_metrics_CD = checkpoint['best_metrics_CD']
+            optimizer.load_state_dict(checkpoint['optimizer'])
+            lr_scheduler.load_state_dict(checkpoint['scheduler'])
+            steps, last_idx = checkpoint['steps'], checkpoint['last_idx']
+            rng_states = checkpoint['rng_states']
+            if utils.distributed.get_rank() < len(rng_states):
+                rng_state = rng_states[utils.distributed.get_rank()]
         logging.info('Recover complete. Current epoch = #%d; best metrics = %s.' % (init_epoch, best_metrics))
-
+    if hasattr(train_dataset, 'set_epoch'):
+        # Streaming datasets reshuffle per epoch; set before the (persistent) workers copy the dataset
+        train_dataset.set_epoch(init_epoch)
+    checkpoints = CheckpointManager(cfg.DIR.CHECKPOINTS, cfg.TRAIN.CHECKPOINT.KEEP_LAST,
+                                    cfg.TRAIN.CHECKPOINT.KEEP_BEST) if is_main else None
+    evaluator = utils.async_eval.AsyncEvaluator(cfg, ncat, dataset_name, model, cfg.TEST.ASYNC_EVAL.DEVICE) \
+        if async_eval else None
+
+    # Losses of get_loss_nomi (CD x 1e3, CE x 1e2) followed by the accuracy of each classifier head
+    train_metrics = DeviceAverageMeter(['cd_pc', 'cd_p1', 'cd_p2', 'cd_p3', 'partial_matching', 'ce_s1', 'ce_s2',
+                                        'ce_s3', 'kl_r1', 'kl_r2', 'mse_1', 'mse_2', 'mse_3', 'acc1', 'acc2', 'acc3'],
+                                       scales=[1e3] * 5 + [1e2] * 3 + [1] * 8, flush_every=cfg.TRAIN.LOG_FREQ)
+    # Samples per forward/backward pass (after N_VIEWS expansion); None is measured on the first batch
+    micro_batch_size = cfg.TRAIN.MICRO_BATCH.SIZE if cfg.TRAIN.MICRO_BATCH.SIZE >= 0 else None
     # Information plane
     ws = []
+    if rng_state is not None:
+        # Restored last, so shuffling and augmentation continue where the checkpointed run left off
+        set_rng_state(rng_state)
+    profiler = utils.profiler.Profiler(cfg.TRAIN.PROFILE, os.path.join(cfg.DIR.LOGS, 'profile'), model,
+                                       utils.distributed.get_rank())
+    profiler.start()
     # Training/Testing the network
     for epoch_idx in range(init_epoch + 1, cfg.TRAIN.N_EPOCHS + 1):
         epoch_start_time = time()
@@ -113,89 +194,81 @@ def train_net(cfg):
         data_time = AverageMeter()
 
         model.train()
+        if train_sampler is not None:
+            train_sampler.set_epoch(epoch_idx)
 
-        total_cd_pc = 0
-        total_cd_p1 = 0
-        total_cd_p2 = 0
-        total_cd_p3 = 0
-        total_partial = 0
-        total_ce_d, total_ce_s1, total_ce_s2, total_ce_s3 = 0, 0, 0, 0
-        total_kl_r1, total_kl_r2, total_kl_r3 = 0, 0, 0
-        total_mse_1, total_mse_2, total_mse_3 = 0, 0, 0
-
+        train_metrics.reset()
         batch_end_time = time()
         n_batches = len(train_data_loader)
 
-        # Information plane
-        x_train, xb, wb, y_onehot, y = [], [], [], [], []
-        with tqdm(train_data_loader) as t:
+        with tqdm(train_data_loader, disable=not is_main) as t:
             for batch_idx, (taxonomy_ids, model_ids, data, gt_label) in enumerate(t):
                 # print('taxonomy_ids:', taxonomy_ids)
                 data_time.update(time() - batch_end_time)
                 for k, v in data.items():
                     data[k] = utils.helpers.var_or_cuda(v)
+                data = utils.data_loaders.expand_views(data, cfg.TRAIN.N_VIEWS)
+                if batch_transforms is not None:
+                    data = batch_transforms(data)
                 partial = data['partial_cloud']
                 gt = data['gtcloud']
                 # print('train:', partial.shape, gt.shape)
-                gt_label = utils.helpers.var_or_cuda(torch.Tensor(gt_label).long())
-                x_train_bat = partial.detach().cpu().numpy()#.reshape(len(taxonomy_ids), -1)
-                x_train.append(x_train_bat)
-                y_onehot_bat = torch.nn.functional.one_hot(gt_label, 15).detach().cpu().numpy()
-                y_onehot.append(y_onehot_bat)
-                y.append(gt_label.detach().cpu().numpy())
-
-                pcds_pred, labels_pred, feats_cls = model(partial)
-                # print('train in and pred and gt:', partial.shape, pcds_pred[-1].shape, gt.shape)
-
-                loss_total, losses, cur_idx, best_idx = get_loss_nomi(labels_pred, gt_label, pcds_pred, partial, 
-                                                            gt, feats_cls, last_idx, indices, epoch_idx,
-                                                            mse=cfg.TRAIN.CODE, nomi=cfg.TRAIN.NOMI)
-                last_idx = best_idx
+                gt_label = utils.helpers.var_or_cuda(gt_label)
+
+                if micro_batch_size is None:
+                    def probe_step(n):
+                        with utils.micro_batch.no_sync(model, True):
+                            pcds_pred, labels_pred, feats_cls = model(partial[:n])
+                            get_loss_nomi(labels_pred, gt_label[:n], pcds_pred, partial[:n], gt[:n], feats_cls,
+                                          last_idx, None, epoch_idx, mse=cfg.TRAIN.CODE,
+                                          nomi=cfg.TRAIN.NOMI)[0].backward()
+
+                    micro_batch_size = utils.micro_batch.auto_micro_batch_size(
+                        model, probe_step, batch_size * cfg.TRAIN.N_VIEWS, cfg.TRAIN.MICRO_BATCH.MEMORY_BUDGET,
+                        cfg.TRAIN.N_VIEWS)
 
+                # Gradients of weighted batch-mean losses add up to those of the whole batch
                 optimizer.zero_grad()
-                loss_total.backward()
-                torch.nn.utils.clip_grad_value_(model.parameters(), clip_value=0.95)
-                optimizer.step()
-
-                accs = []
-                for logit in labels_pred:
-                    pred = logit.argmax(-1)
-                    acc = (pred == gt_label).sum() / float(gt_label.size(0))
-                    accs.append(acc)
-
-                cd_pc_item = losses[0].item() * 1e3
-                total_cd_pc += cd_pc_item
-                cd_p1_item = losses[1].item() * 1e3
-                total_cd_p1 += cd_p1_item
-                cd_p2_item = losses[2].item() * 1e3
-                total_cd_p2 += cd_p2_item
-                cd_p3_item = losses[3].item() * 1e3
-                total_cd_p3 += cd_p3_item
-                partial_item = losses[4].item() * 1e3
-                total_partial += partial_item
-                ce_s1_item = losses[5].item() * 1e2
-                total_ce_s1 += ce_s1_item
-                ce_s2_item = losses[6].item() * 1e2
-                total_ce_s2 += ce_s2_item
-                ce_s3_item = losses[7].item() * 1e2
-                total_ce_s3 += ce_s3_item
-                kl_r1_item = losses[8].item()# * 1e2
-                total_kl_r1 += kl_r1_item
-                kl_r2_item = losses[9].item()# * 1e2
-                total_kl_r2 += kl_r2_item
-                if cfg.TRAIN.CODE:
-                    mse_1_item = losses[10].item()# * 1e2
-                    total_mse_1 += mse_1_item
-                    mse_2_item = losses[11].item()# * 1e2
-                    total_mse_2 += mse_2_item
-                    mse_3_item = losses[12].item()# * 1e2
-                    total_mse_3 += mse_3_item
+                micro_batches = utils.micro_batch.split_batch([partial, gt, gt_label], micro_batch_size,
+                                                              cfg.TRAIN.N_VIEWS)
+                batch_metrics = None
+                with utils.micro_batch.accumulate_bn(model, len(micro_batches)):
+                    for micro_idx, ((mb_partial, mb_gt, mb_label), weight) in enumerate(micro_batches):
+                        with utils.micro_batch.no_sync(model, micro_idx < len(micro_batches) - 1):
+                            with utils.profiler.stage('forward'):
+                                pcds_pred, labels_pred, feats_cls = model(mb_partial)
+                            # print('train in and pred and gt:', partial.shape, pcds_pred[-1].shape, gt.shape)
+
+                            with utils.profiler.stage('loss'):
+                                loss_total, losses, cur_idx, best_idx = get_loss_nomi(
+                                    labels_pred, mb_label, pcds_pred, mb_partial, mb_gt, feats_cls, last_idx,
+                                    None, epoch_idx, mse=cfg.TRAIN.CODE, nomi=cfg.TRAIN.NOMI)
+                            with utils.profiler.stage('backward'):
+                                (loss_total * weight if weight != 1. else loss_total).backward()
+
+                        # Queued on the device; the host only sees the sums every TRAIN.LOG_FREQ steps
+                        accs = [(logit.argmax(-1) == mb_label).float().mean() for logit in labels_pred]
+                        values = [v.detach() * weight for v in losses + accs]
+                        batch_metrics = values if batch_metrics is None else \
+                            [a + b for a, b in zip(batch_metrics, values)]
+                last_idx = best_idx
+
+                with utils.profiler.stage('optimizer'):
+                    torch.nn.utils.clip_grad_value_(model.parameters(), clip_value=0.95)
+                    optimizer.step()
+                profiler.step()
+
                 batch_time.update(time() - batch_end_time)
                 batch_end_time = time()
-                t.set_description('[Epoch %d/%d]' % (epoch_idx, cfg.TRAIN.N_EPOCHS))
-                t.set_postfix(cd='%s' % ['%.4f' % l for l in [cd_pc_item, cd_p1_item, cd_p2_item, cd_p3_item]],
-                              acc='%s' % ['%.4f' % acc for acc in accs],
-                              kl='%s' % ['%.4f' % kl for kl in [kl_r1_item, kl_r2_item]])
+                if train_metrics.update(batch_metrics):
+                    metrics = dict(zip(train_metrics.items, train_metrics.val()))
+                    n_itr = (epoch_idx - 1) * n_batches + batch_idx
+                    for name, value in metrics.items():
+                        train_writer.add_scalar('Loss/Batch/%s' % name, value, n_itr)
+                    t.set_description('[Epoch %d/%d]' % (epoch_idx, cfg.TRAIN.N_EPOCHS))
+                    t.set_postfix(cd='%s' % ['%.4f' % metrics[k] for k in ['cd_pc', 'cd_p1', 'cd_p2', 'cd_p3']],
+                                  acc='%s' % ['%.4f' % metrics[k] for k in ['acc1', 'acc2', 'acc3']],
+                                  kl='%s' % ['%.4f' % metrics[k] for k in ['kl_r1', 'kl_r2']])
 
                 if steps <= cfg.TRAIN.WARMUP_STEPS:
                     lr_scheduler.step()
@@ -213,26 +286,19 @@ def train_net(cfg):
         # model.module.decoder.deep_cls.reset()
         # print(xb.shape, wb[0].shape, wb[1].shape, wb[2].shape, wb[3].shape, yb.shape)
 
-        avg_cdc = total_cd_pc / n_batches
-        avg_cd1 = total_cd_p1 / n_batches
-        avg_cd2 = total_cd_p2 / n_batches
-        avg_cd3 = total_cd_p3 / n_batches
-        avg_partial = total_partial / n_batches
-        avg_ce1 = total_ce_s1 / n_batches
-        avg_ce2 = total_ce_s2 / n_batches
-        avg_ce3 = total_ce_s3 / n_batches
-        avg_kl1 = total_kl_r1 / n_batches
-        avg_kl2 = total_kl_r2 / n_batches
+        # Epoch averages over all ranks
+        train_metrics.flush()
+        avg_cdc, avg_cd1, avg_cd2, avg_cd3, avg_partial, avg_ce1, avg_ce2, avg_ce3, avg_kl1, avg_kl2, \
+            avg_mse1, avg_mse2, avg_mse3, avg_acc1, avg_acc2, avg_acc3 = \
+            utils.distributed.all_reduce_mean(train_metrics.avg())
         if cfg.TRAIN.CODE:
-            avg_mse1 = total_mse_1 / n_batches
             train_writer.add_scalar('Loss/Epoch/total_mse_1', avg_mse1, epoch_idx)
-            avg_mse2 = total_mse_2 / n_batches
-            avg_mse3 = total_mse_3 / n_batches
             train_writer.add_scalar('Loss/Epoch/total_mse_2', avg_mse2, epoch_idx)
             train_writer.add_scalar('Loss/Epoch/total_mse_3', avg_mse3, epoch_idx)
 
         lr_scheduler.step()
-        print('epoch: ', epoch_idx, 'optimizer: ', optimizer.param_groups[0]['lr'], 'best:', best_idx)
+        if is_main:
+            print('epoch: ', epoch_idx, 'optimizer: ', optimizer.param_groups[0]['lr'], 'best:', best_idx)
         epoch_end_time = time()
         train_writer.add_scalar('Loss/Epoch/cd_pc', avg_cdc, epoch_idx)
         train_writer.add_scalar('Loss/Epoch/cd_p1', avg_cd1, epoch_idx)
@@ -245,16 +311,38 @@ def train_net(cfg):
         train_writer.add_scalar('Hyper/Epoch/best_idx', best_idx, epoch_idx)
         train_writer.add_scalar('Loss/Epoch/kl_r1', avg_kl1, epoch_idx)
         train_writer.add_scalar('Loss/Epoch/kl_r2', avg_kl2, epoch_idx)
+        train_writer.add_scalar('Loss/Epoch/acc1', avg_acc1, epoch_idx)
+        train_writer.add_scalar('Loss/Epoch/acc2', avg_acc2, epoch_idx)
+        train_writer.add_scalar('Loss/Epoch/acc3', avg_acc3, epoch_idx)
         train_writer.add_scalar('Hyper/Epoch/lr', optimizer.param_groups[0]['lr'], epoch_idx)
+        # Host-side times: the step is only waited for at the metric flushes (and the model's own host copies)
+        train_writer.add_scalar('Time/Epoch/batch_time', batch_time.avg(), epoch_idx)
+        train_writer.add_scalar('Time/Epoch/data_time', data_time.avg(), epoch_idx)
         logging.info(
-            '[Epoch %d/%d] EpochTime = %.3f (s) Losses = %s Losses_CE = %s' %
-            (epoch_idx, cfg.TRAIN.N_EPOCHS, epoch_end_time - epoch_start_time, ['%.4f' % l for l in [avg_cdc, avg_cd1, avg_cd2, avg_cd3, avg_partial]],
+            '[Epoch %d/%d] EpochTime = %.3f (s) BatchTime = %.3f (s) DataTime = %.3f (s) Losses = %s Losses_CE = %s' %
+            (epoch_idx, cfg.TRAIN.N_EPOCHS, epoch_end_time - epoch_start_time, batch_time.avg(), data_time.avg(),
+             ['%.4f' % l for l in [avg_cdc, avg_cd1, avg_cd2, avg_cd3, avg_partial]],
              ['%.4f' % l for l in [avg_ce1, avg_ce2, avg_ce3]]))
+        sample_cache = utils.data_loaders.get_sample_cache(cfg)
+        if sample_cache is not None:
+            cache_stats = sample_cache.stats()
+            train_writer.add_scalar('Data/Epoch/cache_hit_rate', cache_stats['hit_rate'], epoch_idx)
+            logging.info('Sample cache: %s' % cache_stats)
 
         # paperwithcode
         model.module.decoder.deep_cls.reset()
         model.module.decoder.reset()
-        best_acc, best_mean, best_CD = test_net(cfg, epoch_idx, val_data_loader, val_writer, model, show=True, save_path=cfg.DIR.FIGPATH)
+        submitted = False
+        if evaluator is not None:
+            # Evaluated from a weight snapshot while the next epoch trains
+            if epoch_idx % cfg.TEST.ASYNC_EVAL.FREQ == 0:
+                submitted = evaluator.submit(model, epoch_idx)
+        elif is_main:
+            best_acc, best_mean, best_CD = test_net(cfg, epoch_idx, val_data_loader, val_writer,
+                                                    utils.distributed.eval_model(model), show=True,
+                                                    save_path=cfg.DIR.FIGPATH)
+        # Every rank's RNG goes into the checkpoint; this also makes the other ranks wait for the evaluation
+        rng_states = utils.distributed.all_gather_object(get_rng_state())
         # model.module.decoder.deep_cls.reset()
         """github shalomma pytorch bottleneck"""
         # method_name = 'pointnet-hsd-snn-s128-k8'
@@ -287,47 +375,41 @@ def train_net(cfg):
         # model.module.decoder.reset()
 
 
-        # # Save checkpoints
-        # if epoch_idx % cfg.TRAIN.SAVE_FREQ == 0:
-        #     output_path = os.path.join(cfg.DIR.CHECKPOINTS, 'ckpt-epoch-%03d.pth' % epoch_idx)
-        #     torch.save({
-        #         'epoch_index': epoch_idx,
-        #         'best_metrics': best_metrics,
-        #         'best_metrics_mean': best_mean,
-        #         'best_metrics_CD': best_CD,
-        #         'scheduler': lr_scheduler.state_dict(),
-        #         'optimizer': optimizer.state_dict(),
-        #         'model': model.state_dict()
-        #     }, output_path)
-        #     logging.info('Saved checkpoint to %s ...' % output_path)
-        # if max(best_acc) > max(best_metrics) and epoch_idx > 50:
-        #     output_path = os.path.join(cfg.DIR.CHECKPOINTS, 'ckpt-best.pth')
-        #     torch.save({
-        #         'epoch_index': epoch_idx,
-        #         'best_metrics': best_acc,
-        #         'best_metrics_mean': best_mean,
-        #         'best_metrics_CD': best_metrics_CD,
-        #         'scheduler': lr_scheduler.state_dict(),
-        #         'optimizer': optimizer.state_dict(),
-        #         'model': model.state_dict()
-        #     }, output_path)
-        #     logging.info('Saved checkpoint to %s ...' % output_path)
-
-        # if best_acc[0] > best_metrics[0]:
-        #     best_metrics[0] = best_acc[0]
-        # if best_acc[1] > best_metrics[1]:
-        #     best_metrics[1] = best_acc[1]
-        # if best_acc[2] > best_metrics[2]:
-        #     best_metrics[2] = best_acc[2]
-        # if best_mean[0] > best_metrics_mean[0]:
-        #     best_metrics_mean[0] = best_mean[0]
-        # if best_mean[1] > best_metrics_mean[1]:
-        #     best_metrics_mean[1] = best_mean[1]
-        # if best_mean[2] > best_metrics_mean[2]:
-        #     best_metrics_mean[2] = best_mean[2]
-        # if best_CD < best_metrics_CD:
-        #     best_metrics_CD = best_CD
-        # print(f'Best acc: {best_metrics}, mean: {best_metrics_mean}, CD: {best_metrics_CD}')
+        if is_main:
+            if evaluator is None:
+                best_metrics, best_metrics_mean, best_metrics_CD = update_best(
+                    best_metrics, best_metrics_mean, best_metrics_CD, best_acc, best_mean, best_CD)
+
+            # Snapshotted here, written in the background. A snapshot under asynchronous evaluation is kept
+            # (pinned) until its result arrives and promote() decides whether it is among the best.
+            checkpoints.save({
+                'epoch_index': epoch_idx,
+                'best_metrics': best_metrics,
+                'best_metrics_mean': best_metrics_mean,
+                'best_metrics_CD': best_metrics_CD,
+                'metrics': best_acc if evaluator is None else None,
+                'scheduler': lr_scheduler.state_dict(),
+                'optimizer': optimizer.state_dict(),
+                'model': model.state_dict(),
+                'steps': steps,
+                'last_idx': last_idx,
+                'rng_states': rng_states
+            }, epoch_idx, metric=max(best_acc) if evaluator is None else None,
+               save_last=submitted or epoch_idx % cfg.TRAIN.CHECKPOINT.SAVE_FREQ == 0, pin=submitted)
+
+            if evaluator is not None:
+                for eval_epoch_idx, accs, mean_accs, cd in evaluator.poll():
+                    best_metrics, best_metrics_mean, best_metrics_CD = update_best(
+                        best_metrics, best_metrics_mean, best_metrics_CD, accs, mean_accs, cd)
+                    checkpoints.promote(eval_epoch_idx, max(accs))
+    profiler.stop()
+    if evaluator is not None:
+        for eval_epoch_idx, accs, mean_accs, cd in evaluator.close():
+            best_metrics, best_metrics_mean, best_metrics_CD = update_best(
+                best_metrics, best_metrics_mean, best_metrics_CD, accs, mean_accs, cd)
+            checkpoints.promote(eval_epoch_idx, max(accs))
+    if checkpoints is not None:
+        checkpoints.close()
     # train_writer.close()
     # val_writer.close()
 
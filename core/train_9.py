@@ -25,17 +25,15 @@ def train_net(cfg):
 
     train_dataset_loader = dload.DATASET_LOADER_MAPPING[cfg.DATASET.TRAIN_DATASET](cfg)
     test_dataset_loader = dload.DATASET_LOADER_MAPPING[cfg.DATASET.TEST_DATASET](cfg)
+    collate_fn = dload.BatchCollator()
     if cfg.DATASET.TRAIN_DATASET == 'ShapeNet':
-        collate_fn = dload.collate_fn
         ncat = 8
     elif cfg.DATASET.TRAIN_DATASET == 'ModelNet40':
-        collate_fn = dload.collate_fn2
         ncat = 40
     elif cfg.DATASET.TRAIN_DATASET == 'ScanObjectNN':
-        collate_fn = dload.collate_fn3
         ncat = 15
     elif cfg.DATASET.TRAIN_DATASET == 'ShapeNetPart':
-        collate_fn = dload.collate_fn4
+        collate_fn = dload.BatchCollator(segmentation=True)
         ncat = 50
     else:
         raise(NotImplementedError)
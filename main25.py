@@ -24,6 +24,8 @@ def get_args_from_command_line():
     parser = argparse.ArgumentParser(description='The argument parser of SnowflakeNet')
     parser.add_argument('--test', dest='test', help='Test neural networks', action='store_true')
     parser.add_argument('--inference', dest='inference', help='Inference for benchmark', action='store_true')
+    parser.add_argument('--profile', dest='profile', help='Write torch.profiler traces of training steps (cfg.TRAIN.PROFILE)',
+                        action='store_true')
     args = parser.parse_args()
 
     return args
@@ -33,6 +35,8 @@ def main():
     # Get args from command line
     args = get_args_from_command_line()
     print('cuda available ', torch.cuda.is_available())
+    if args.profile:
+        cfg.TRAIN.PROFILE.ENABLED = True
 
     # Print config
     print('Use config:')
@@ -0,0 +1,63 @@
+import argparse
+import logging
+import os
+import numpy as np
+import torch
+from pprint import pprint
+from config_pcn import cfg
+from core.train_25 import train_net
+import utils.distributed
+os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
+os.environ["CUDA_VISIBLE_DEVICES"] = cfg.CONST.DEVICE
+
+
+def set_seed(seed):
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    torch.cuda.manual_seed(seed)
+    torch.cuda.manual_seed_all(seed)
+
+
+def get_args_from_command_line():
+    parser = argparse.ArgumentParser(description='Distributed training of SnowflakeNet (launch with torchrun)')
+    parser.add_argument('--backend', dest='backend', help='nccl or gloo (default: cfg.TRAIN.DDP.BACKEND)',
+                        default=None)
+    parser.add_argument('--sync_bn', dest='sync_bn', help='Use SyncBatchNorm', action='store_true')
+    parser.add_argument('--profile', dest='profile', help='Write torch.profiler traces of training steps (cfg.TRAIN.PROFILE)',
+                        action='store_true')
+    # Passed by the legacy torch.distributed.launch without --use_env
+    parser.add_argument('--local_rank', '--local-rank', dest='local_rank', type=int, default=None)
+    args = parser.parse_args()
+
+    return args
+
+
+def main():
+    args = get_args_from_command_line()
+    if args.local_rank is not None:
+        os.environ.setdefault('LOCAL_RANK', str(args.local_rank))
+    if args.sync_bn:
+        cfg.TRAIN.DDP.SYNC_BN = True
+    if args.profile:
+        cfg.TRAIN.PROFILE.ENABLED = True
+
+    utils.distributed.init_distributed(args.backend or cfg.TRAIN.DDP.BACKEND)
+    # Different augmentation streams per rank
+    set_seed(seed + utils.distributed.get_rank())
+    if utils.distributed.is_main_process():
+        print('cuda available ', torch.cuda.is_available())
+        print('Use config:')
+        pprint(cfg)
+    else:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    try:
+        train_net(cfg)
+    finally:
+        utils.distributed.cleanup()
+
+
+if __name__ == '__main__':
+    seed = 1
+    logging.basicConfig(format='[%(levelname)s] %(asctime)s %(message)s', level=logging.DEBUG)
+    main()
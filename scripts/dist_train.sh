@@ -1,12 +1,10 @@
 #!/usr/bin/env bash
+# Usage: scripts/dist_train.sh NGPUS PORT [main25_ddp.py args, e.g. --sync_bn or --backend gloo]
+# On CPU-only hosts NGPUS is the number of processes; they communicate over gloo.
 
 set -x
 NGPUS=$1
 PORT=$2
+PY_ARGS=${@:3}
 
-
-
-# python -m torch.distributed.launch --nproc_per_node=${NGPUS} --rdzv_endpoint=localhost:${PORT} main17_pcn_ddp.py --launcher pytorch ${PY_ARGS}
-
-# python -m torch.distributed.launch --nproc_per_node=${NGPUS}  --master_port=${PORT} main17_ddp.py
-python -m torch.distributed.launch --nproc_per_node=${NGPUS}  --master_port=${PORT} main21_ddp.py
\ No newline at end of file
+torchrun --nproc_per_node=${NGPUS} --master_port=${PORT} main25_ddp.py ${PY_ARGS}
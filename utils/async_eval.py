@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+# Validation in a separate process, fed with weight snapshots through shared memory while training continues.
+
+import logging
+import os
+import queue
+import traceback
+import torch
+import torch.multiprocessing as mp
+
+# Snapshot buffers: one being evaluated, one being filled
+N_SLOTS = 2
+
+
+def _unwrap(model):
+    return model.module if hasattr(model, 'module') else model
+
+
+def _evaluator_main(cfg, ncat, dataset_name, shared_states, free_slots, requests, results, device):
+    try:
+        if device != '':
+            # Before CUDA is initialised in this process: '' keeps the training devices, 'cpu' hides all GPUs
+            os.environ['CUDA_VISIBLE_DEVICES'] = '' if device == 'cpu' else device
+        from core.test_25 import test_net
+        from core.train_25 import build_val_loader
+        from models.model25 import SnowflakeNet as Model
+        from torch.utils.tensorboard import SummaryWriter
+
+        torch.backends.cudnn.benchmark = True
+        # test_net expects the DataParallel layout (model.module); without GPUs DataParallel just forwards
+        model = Model(dim_feat=512, num_pc=256, ncat=ncat, up_factors=[1, 2])
+        model = torch.nn.DataParallel(model).cuda() if torch.cuda.is_available() else torch.nn.DataParallel(model)
+        val_data_loader = build_val_loader(cfg, dataset_name)
+        val_writer = SummaryWriter(os.path.join(cfg.DIR.LOGS, 'test'))
+        parent = mp.parent_process()
+
+        while True:
+            try:
+                request = requests.get(timeout=5)
+            except queue.Empty:
+                if parent is not None and not parent.is_alive():
+                    return
+                continue
+            if request is None:
+                break
+            slot, epoch_idx = request
+            model.module.load_state_dict(shared_states[slot])
+            free_slots.put(slot)
+
+            model.module.decoder.deep_cls.reset()
+            model.module.decoder.reset()
+            accs, mean_accs, cd = test_net(cfg, epoch_idx, val_data_loader, val_writer, model, show=True,
+                                           save_path=cfg.DIR.FIGPATH)
+            val_writer.flush()
+            results.put((epoch_idx, accs, mean_accs, cd))
+        val_writer.close()
+    except Exception:
+        results.put(('error', traceback.format_exc()))
+    results.put(None)
+
+
+class AsyncEvaluator(object):
+    """Runs test_net on weight snapshots in a spawned process that logs to the `test` SummaryWriter.
+
+    submit() copies the weights into one of two shared-memory buffers and returns at once; when both are
+    taken (the evaluator is more than one snapshot behind) the snapshot is skipped rather than stalling
+    training. poll() returns the (epoch_idx, accs, mean_accs, cd) results that have arrived.
+    `device` places the evaluator: '' on the training GPUs, 'cpu', or CUDA device ids such as '7'.
+    """
+    def __init__(self, cfg, ncat, dataset_name, model, device=''):
+        ctx = mp.get_context('spawn')
+        state = _unwrap(model).state_dict()
+        self.shared_states = [{k: v.detach().to('cpu', copy=True).share_memory_() for k, v in state.items()}
+                              for _ in range(N_SLOTS)]
+        self.free_slots = ctx.Queue()
+        for slot in range(N_SLOTS):
+            self.free_slots.put(slot)
+        self.requests = ctx.Queue()
+        self.results = ctx.Queue()
+        self.finished = False
+        # Not a daemon: the evaluator's DataLoader starts worker processes of its own
+        self.process = ctx.Process(target=_evaluator_main,
+                                   args=(cfg, ncat, dataset_name, self.shared_states, self.free_slots,
+                                         self.requests, self.results, device))
+        self.process.start()
+
+    def submit(self, model, epoch_idx):
+        """Snapshots the weights for evaluation at `epoch_idx`; False if the snapshot was skipped"""
+        try:
+            slot = self.free_slots.get_nowait()
+        except queue.Empty:
+            logging.warning('Evaluator busy; epoch %d is not evaluated' % epoch_idx)
+            return False
+        with torch.no_grad():
+            for k, v in _unwrap(model).state_dict().items():
+                self.shared_states[slot][k].copy_(v)
+        self.requests.put((slot, epoch_idx))
+        return True
+
+    def _receive(self, block):
+        received = []
+        while not self.finished:
+            try:
+                result = self.results.get(timeout=5) if block else self.results.get_nowait()
+            except queue.Empty:
+                if block and self.process.is_alive():
+                    continue
+                if block:
+                    raise Exception('Evaluator process exited with code %s' % self.process.exitcode)
+                break
+            if result is None:
+                self.finished = True
+            elif result[0] == 'error':
+                self.finished = True
+                raise Exception('Evaluator process failed:\n%s' % result[1])
+            else:
+                received.append(result)
+        return received
+
+    def poll(self):
+        if not self.finished and not self.process.is_alive() and self.results.empty():
+            raise Exception('Evaluator process exited with code %s' % self.process.exitcode)
+        return self._receive(block=False)
+
+    def close(self):
+        """Waits for the pending evaluations and returns their results"""
+        self.requests.put(None)
+        received = self._receive(block=True)
+        self.process.join()
+        return received
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+# Batch size and DataLoader autotuner: profiles a few real training/evaluation steps on this host and writes
+# the fastest settings into the machine-specific overlay read by config_pcn (CONST.MACHINE_CONFIG).
+# Usage: python -m utils.autotune [--steps 10] [--max-batch-size 1024] [--memory-budget 0] [--out path]
+
+import argparse
+import json
+import logging
+import os
+import socket
+from time import time
+import torch
+import utils.data_loaders
+import utils.distributed
+import utils.helpers
+
+from config_pcn import cfg
+from models.model25 import SnowflakeNet as Model
+from utils.loss_utils import get_loss_nomi
+
+N_CATEGORIES = {'ShapeNet': 8, 'ModelNet40': 40, 'ScanObjectNN': 15}
+
+
+def _sync():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+def _is_oom(e):
+    return isinstance(e, RuntimeError) and 'out of memory' in str(e)
+
+
+def profile_loader(loader, step_fn, n_steps, n_warmup=2):
+    """Samples/sec and the fraction of time spent waiting for batches over n_steps (after n_warmup)"""
+    it = iter(loader)
+    wait_time, n_samples, start = 0., 0, None
+    for step_idx in range(n_warmup + n_steps):
+        if step_idx == n_warmup:
+            _sync()
+            wait_time, n_samples, start = 0., 0, time()
+        fetch_start = time()
+        try:
+            batch = next(it)
+        except StopIteration:
+            break
+        wait_time += time() - fetch_start
+        n_samples += step_fn(batch)
+        # Steps are timed to completion, so that device time is not attributed to the next batch wait
+        _sync()
+    if start is None or n_samples == 0:
+        return None
+    elapsed = time() - start
+    return {'samples_per_sec': n_samples / elapsed, 'data_wait': wait_time / elapsed}
+
+
+class Autotuner(object):
+    def __init__(self, cfg, n_steps=10, max_batch_size=1024, memory_budget=0):
+        self.cfg = cfg
+        self.n_steps = n_steps
+        self.max_batch_size = max_batch_size
+        self.memory_budget = memory_budget * 1024 ** 3 if memory_budget > 0 else None
+        self.n_views = cfg.TRAIN.N_VIEWS
+        dataset_name = cfg.DATASETS.SHARDS.SOURCE if cfg.DATASET.TRAIN_DATASET == 'Shards' else \
+            cfg.DATASET.TRAIN_DATASET
+        self.train_dataset = utils.data_loaders.DATASET_LOADER_MAPPING[cfg.DATASET.TRAIN_DATASET](cfg).get_dataset(
+            utils.data_loaders.DatasetSubset.TRAIN, n_views=self.n_views)
+        self.test_dataset = utils.data_loaders.DATASET_LOADER_MAPPING[cfg.DATASET.TEST_DATASET](cfg).get_dataset(
+            utils.data_loaders.DatasetSubset.TEST)
+        self.model = utils.distributed.wrap_model(Model(dim_feat=512, num_pc=256, ncat=N_CATEGORIES[dataset_name],
+                                                        up_factors=[1, 2]))
+        self.optimizer = torch.optim.Adam(filter(lambda p: p.requires_grad, self.model.parameters()),
+                                          lr=cfg.TRAIN.LEARNING_RATE, weight_decay=cfg.TRAIN.WEIGHT_DECAY,
+                                          betas=cfg.TRAIN.BETAS)
+        self.results = {'train': [], 'test': []}
+
+    def _loader(self, dataset, batch_size, num_workers, prefetch_factor, n_views=1):
+        shuffle = not isinstance(dataset, torch.utils.data.IterableDataset)
+        kwargs = {'prefetch_factor': prefetch_factor} if num_workers > 0 else {}
+        return torch.utils.data.DataLoader(dataset=dataset, batch_size=batch_size, num_workers=num_workers,
+                                           collate_fn=utils.data_loaders.BatchCollator(n_views=n_views),
+                                           pin_memory=True, shuffle=shuffle, drop_last=True, **kwargs)
+
+    def _train_step(self, batch):
+        # The step of core.train_25.train_net
+        _, _, data, gt_label = batch
+        for k, v in data.items():
+            data[k] = utils.helpers.var_or_cuda(v)
+        data = utils.data_loaders.expand_views(data, self.n_views)
+        gt_label = utils.helpers.var_or_cuda(gt_label)
+        self.model.train()
+        pcds_pred, labels_pred, feats_cls = self.model(data['partial_cloud'])
+        loss_total = get_loss_nomi(labels_pred, gt_label, pcds_pred, data['partial_cloud'], data['gtcloud'],
+                                   feats_cls, 2, None, 1, mse=self.cfg.TRAIN.CODE, nomi=self.cfg.TRAIN.NOMI)[0]
+        self.optimizer.zero_grad()
+        loss_total.backward()
+        self.optimizer.step()
+        return gt_label.size(0)
+
+    def _test_step(self, batch):
+        # The forward pass of core.test_25.test_net
+        _, _, data, gt_label = batch
+        self.model.eval()
+        with torch.no_grad():
+            self.model(utils.helpers.var_or_cuda(data['partial_cloud']))
+        return gt_label.size(0)
+
+    def _measure(self, mode, batch_size, num_workers, prefetch_factor):
+        if mode == 'train':
+            dataset, step_fn, n_views = self.train_dataset, self._train_step, self.n_views
+        else:
+            dataset, step_fn, n_views = self.test_dataset, self._test_step, 1
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+            torch.cuda.reset_peak_memory_stats()
+        try:
+            result = profile_loader(self._loader(dataset, batch_size, num_workers, prefetch_factor, n_views),
+                                    step_fn, self.n_steps)
+        except RuntimeError as e:
+            if not _is_oom(e):
+                raise
+            self.optimizer.zero_grad(set_to_none=True)
+            result = {'oom': True}
+        if result is None:
+            return None
+        if torch.cuda.is_available() and 'oom' not in result:
+            result['peak_memory'] = max(torch.cuda.max_memory_allocated(d) for d in range(torch.cuda.device_count()))
+            if self.memory_budget is not None and result['peak_memory'] > self.memory_budget:
+                result['over_budget'] = True
+        result.update({'batch_size': batch_size, 'num_workers': num_workers, 'prefetch_factor': prefetch_factor})
+        self.results[mode].append(result)
+        logging.info('[%s] %s' % (mode, result))
+        return result
+
+    @staticmethod
+    def _fits(result):
+        return result is not None and 'oom' not in result and 'over_budget' not in result
+
+    def sweep_batch_size(self, mode, num_workers, prefetch_factor):
+        """Doubles the batch size until it runs out of memory (or budget); the fastest one wins"""
+        best, batch_size = None, 16
+        while batch_size <= self.max_batch_size:
+            result = self._measure(mode, batch_size, num_workers, prefetch_factor)
+            if not self._fits(result):
+                break
+            if best is None or result['samples_per_sec'] > best['samples_per_sec']:
+                best = result
+            batch_size *= 2
+        return best
+
+    def sweep_workers(self, mode, batch_size):
+        """Worker counts and prefetch factors; the fewest workers within 5% of the fastest setting win"""
+        n_cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+        worker_counts = sorted({n for n in [1, 2, 4, 8, 12, 16, 24, 32, 48, 64] if n <= n_cpus} | {n_cpus})
+        results = []
+        for num_workers in worker_counts:
+            for prefetch_factor in (2, 4, 8):
+                result = self._measure(mode, batch_size, num_workers, prefetch_factor)
+                if self._fits(result):
+                    results.append(result)
+        if not results:
+            return None
+        fastest = max(r['samples_per_sec'] for r in results)
+        return min([r for r in results if r['samples_per_sec'] >= 0.95 * fastest],
+                   key=lambda r: (r['num_workers'], r['prefetch_factor']))
+
+    def run(self):
+        num_workers, prefetch_factor = self.cfg.CONST.NUM_WORKERS, self.cfg.CONST.PREFETCH_FACTOR
+        train = self.sweep_batch_size('train', num_workers, prefetch_factor)
+        if train is None:
+            raise Exception('No training batch size of at least 16 fits on this machine')
+        train = self.sweep_workers('train', train['batch_size']) or train
+        test = self.sweep_batch_size('test', train['num_workers'], train['prefetch_factor'])
+
+        overlay = {
+            'TRAIN': {'BATCH_SIZE': train['batch_size']},
+            'CONST': {'NUM_WORKERS': train['num_workers'], 'PREFETCH_FACTOR': train['prefetch_factor']},
+            '_autotune': {
+                'host': socket.gethostname(),
+                'train_dataset': self.cfg.DATASET.TRAIN_DATASET,
+                'devices': [torch.cuda.get_device_name(d) for d in range(torch.cuda.device_count())],
+                'best': {'train': train, 'test': test},
+                'results': self.results
+            }
+        }
+        if test is not None:
+            overlay['TEST'] = {'EVAL_CACHE': {'BATCH_SIZE': test['batch_size']}}
+        return overlay
+
+
+def write_overlay(overlay, output_path):
+    output_dir = os.path.dirname(output_path)
+    if output_dir and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    with open(output_path + '.tmp', 'w') as f:
+        json.dump(overlay, f, indent=4)
+    os.replace(output_path + '.tmp', output_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Tune batch size and DataLoader workers for this machine')
+    parser.add_argument('--steps', type=int, default=10, help='Timed steps per setting')
+    parser.add_argument('--max-batch-size', type=int, default=1024)
+    parser.add_argument('--memory-budget', type=float, default=0, help='GiB per device; 0: until out of memory')
+    parser.add_argument('--out', default=cfg.CONST.MACHINE_CONFIG, help='Overlay to write')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='[%(levelname)s] %(asctime)s %(message)s', level=logging.INFO)
+    overlay = Autotuner(cfg, args.steps, args.max_batch_size, args.memory_budget).run()
+    write_overlay(overlay, args.out)
+    logging.info('Best settings %s written to %s' % ({k: v for k, v in overlay.items() if not k.startswith('_')},
+                                                     args.out))
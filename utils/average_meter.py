@@ -5,6 +5,8 @@
 # @Last Modified time: 2019-12-03 21:50:38
 # @Email:  cshzxie@gmail.com
 
+import torch
+
 
 class AverageMeter(object):
     """Computes and stores the average and current value"""
@@ -116,3 +118,45 @@ class MultiAverageMeter(object):
             ]
         else:
             return self._sum[idx] / self._count[idx]
+
+
+class DeviceAverageMeter(MultiAverageMeter):
+    """MultiAverageMeter whose running sums stay on the device until flushed.
+
+    update() only queues tensor additions, so no step waits for the device; flush() copies all sums to the
+    host in one transfer. After a flush, val() is the mean since the previous flush and avg() the mean since
+    reset(), both multiplied by `scales` (e.g. 1e3 for Chamfer distances).
+    """
+    def __init__(self, items, scales=None, flush_every=50):
+        self.scales = [1.] * len(items) if scales is None else scales
+        self.flush_every = flush_every
+        super(DeviceAverageMeter, self).__init__(items)
+
+    def reset(self):
+        super(DeviceAverageMeter, self).reset()
+        self._device_sum = None
+        self._pending = 0
+
+    def update(self, values):
+        """`values` are 0-dim tensors on one device; returns True when the update triggered a flush"""
+        values = torch.stack([v.detach().float() for v in values])
+        if self._device_sum is None:
+            self._device_sum = torch.zeros_like(values)
+        self._device_sum += values
+        self._pending += 1
+        if self._pending >= self.flush_every:
+            self.flush()
+            return True
+        return False
+
+    def flush(self):
+        if self._pending == 0:
+            return
+        sums = self._device_sum.tolist()
+        for idx, s in enumerate(sums):
+            s *= self.scales[idx]
+            self._val[idx] = s / self._pending
+            self._sum[idx] += s
+            self._count[idx] += self._pending
+        self._device_sum.zero_()
+        self._pending = 0
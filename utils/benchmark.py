@@ -0,0 +1,418 @@
+# -*- coding: utf-8 -*-
+# Micro-benchmarks of the point operations, losses and model stages, swept over the number of points N, the batch
+# size B and the neighbourhood size k. Results are written as JSON; with --baseline they are compared to an
+# earlier run and slowdowns above --threshold are flagged (exit code 1), so performance changes can be validated.
+# Usage: python -m utils.benchmark [--device cpu] [--cases query_knn chamfer_torch] [--n 512 2048] [--baseline old.json]
+#        python -m utils.benchmark --results new.json --baseline old.json   (compare two existing runs)
+#
+# The pointnet2_ops and Chamfer3D extension ops (and the model stages built on them) only run on CUDA; on CPU they
+# are reported as skipped, and the *_torch cases time pure PyTorch versions of the same operations instead.
+
+import argparse
+import collections
+import json
+import logging
+import os
+import platform
+import socket
+import statistics
+import sys
+from datetime import datetime
+from time import perf_counter
+import torch
+
+from config_pcn import cfg
+
+CASES = collections.OrderedDict()
+# B * N * N distances above which pairwise cases are skipped (4 bytes each: 1 GiB)
+MAX_PAIRS = 2 ** 28
+
+
+class Skip(Exception):
+    pass
+
+
+def case(name, axes, cuda_only=False, pairwise=False, min_n=0):
+    """Registers `setup(device, n, b, k)`, which returns the callable to time.
+
+    axes: the sweep parameters that apply, among 'n', 'b' and 'k'
+    cuda_only: uses extension ops without a CPU implementation
+    pairwise: allocates B x N x N distances
+    min_n: smallest N the operation accepts
+    """
+    def register(setup):
+        CASES[name] = {'setup': setup, 'axes': axes, 'cuda_only': cuda_only, 'pairwise': pairwise, 'min_n': min_n}
+        return setup
+    return register
+
+
+def _import(module_name, name):
+    # The extension ops are built on first import; a host without a CUDA toolchain cannot build them
+    try:
+        return getattr(__import__(module_name, fromlist=[name]), name)
+    except Exception as e:
+        raise Skip('import of %s.%s failed: %s' % (module_name, name, str(e).splitlines()[0] if str(e) else
+                                                   type(e).__name__))
+
+
+def _points(b, n, device, requires_grad=False):
+    return torch.rand(b, n, 3, device=device, requires_grad=requires_grad)
+
+
+def _forward_backward(module, *inputs):
+    def fn():
+        module.zero_grad(set_to_none=True)
+        out = module(*inputs)
+        out = out[0] if isinstance(out, tuple) else out
+        out.mean().backward()
+    return fn
+
+
+# Pure PyTorch versions of the CUDA-only extension ops (same arguments and results)
+def torch_square_distance(src, dst):
+    return torch.cdist(src, dst) ** 2
+
+
+def torch_query_knn(nsample, xyz, new_xyz, include_self=True):
+    pad = 0 if include_self else 1
+    sqrdists = torch_square_distance(new_xyz, xyz)
+    return torch.argsort(sqrdists, dim=-1, descending=False)[:, :, pad: nsample + pad].int()
+
+
+def torch_furthest_point_sample(xyz, npoint):
+    b, n, _ = xyz.shape
+    idx = torch.zeros(b, npoint, dtype=torch.long, device=xyz.device)
+    dist = torch.full((b, n), 1e10, device=xyz.device)
+    farthest = torch.zeros(b, dtype=torch.long, device=xyz.device)
+    batch = torch.arange(b, device=xyz.device)
+    for i in range(npoint):
+        idx[:, i] = farthest
+        centroid = xyz[batch, farthest].unsqueeze(1)
+        dist = torch.minimum(dist, ((xyz - centroid) ** 2).sum(-1))
+        farthest = dist.argmax(-1)
+    return idx.int()
+
+
+def torch_grouping_operation(features, idx):
+    b, c, _ = features.shape
+    _, npoint, nsample = idx.shape
+    idx = idx.long().reshape(b, 1, npoint * nsample).expand(-1, c, -1)
+    return torch.gather(features, 2, idx).reshape(b, c, npoint, nsample)
+
+
+def torch_three_interpolate(features, idx, weight):
+    b, c, _ = features.shape
+    _, n, _ = idx.shape
+    grouped = torch.gather(features, 2, idx.long().reshape(b, 1, n * 3).expand(-1, c, -1)).reshape(b, c, n, 3)
+    return (grouped * weight.unsqueeze(1)).sum(-1)
+
+
+def torch_chamfer_sqrt(p1, p2):
+    dist = torch_square_distance(p1, p2)
+    d1 = torch.mean(torch.sqrt(dist.min(2)[0]))
+    d2 = torch.mean(torch.sqrt(dist.min(1)[0]))
+    return (d1 + d2) / 2
+
+
+@case('square_distance', ('n', 'b'), pairwise=True)
+def _square_distance(device, n, b, k):
+    square_distance = _import('models.utils', 'square_distance')
+    xyz = _points(b, n, device)
+    return lambda: square_distance(xyz, xyz)
+
+
+@case('square_distance_torch', ('n', 'b'), pairwise=True)
+def _square_distance_torch(device, n, b, k):
+    xyz = _points(b, n, device)
+    return lambda: torch_square_distance(xyz, xyz)
+
+
+@case('query_knn', ('n', 'b', 'k'), pairwise=True)
+def _query_knn(device, n, b, k):
+    query_knn = _import('models.utils', 'query_knn')
+    xyz = _points(b, n, device)
+    return lambda: query_knn(k, xyz, xyz)
+
+
+@case('query_knn_torch', ('n', 'b', 'k'), pairwise=True)
+def _query_knn_torch(device, n, b, k):
+    xyz = _points(b, n, device)
+    return lambda: torch_query_knn(k, xyz, xyz)
+
+
+@case('fps', ('n', 'b'), cuda_only=True)
+def _fps(device, n, b, k):
+    furthest_point_sample = _import('models.utils', 'furthest_point_sample')
+    xyz = _points(b, n, device)
+    return lambda: furthest_point_sample(xyz, n // 4)
+
+
+@case('fps_torch', ('n', 'b'))
+def _fps_torch(device, n, b, k):
+    xyz = _points(b, n, device)
+    return lambda: torch_furthest_point_sample(xyz, n // 4)
+
+
+def _grouping_inputs(device, n, b, k):
+    features = torch.rand(b, 128, n, device=device)
+    idx = torch.randint(0, n, (b, n, k), dtype=torch.int32, device=device)
+    return features, idx
+
+
+@case('grouping_operation', ('n', 'b', 'k'), cuda_only=True)
+def _grouping(device, n, b, k):
+    grouping_operation = _import('models.utils', 'grouping_operation')
+    features, idx = _grouping_inputs(device, n, b, k)
+    return lambda: grouping_operation(features, idx)
+
+
+@case('grouping_operation_torch', ('n', 'b', 'k'))
+def _grouping_torch(device, n, b, k):
+    features, idx = _grouping_inputs(device, n, b, k)
+    return lambda: torch_grouping_operation(features, idx)
+
+
+def _interpolate_inputs(device, n, b, k):
+    # Features of N/4 points interpolated to N points, as in PointNet_FP_Module
+    features = torch.rand(b, 128, n // 4, device=device)
+    idx = torch.randint(0, n // 4, (b, n, 3), dtype=torch.int32, device=device)
+    weight = torch.softmax(torch.rand(b, n, 3, device=device), -1)
+    return features, idx, weight
+
+
+@case('three_interpolate', ('n', 'b'), cuda_only=True)
+def _three_interpolate(device, n, b, k):
+    three_interpolate = _import('models.utils', 'three_interpolate')
+    features, idx, weight = _interpolate_inputs(device, n, b, k)
+    return lambda: three_interpolate(features, idx, weight)
+
+
+@case('three_interpolate_torch', ('n', 'b'))
+def _three_interpolate_torch(device, n, b, k):
+    features, idx, weight = _interpolate_inputs(device, n, b, k)
+    return lambda: torch_three_interpolate(features, idx, weight)
+
+
+@case('chamfer', ('n', 'b'), cuda_only=True)
+def _chamfer(device, n, b, k):
+    chamfer_sqrt = _import('utils.loss_utils', 'chamfer_sqrt')
+    p1, p2 = _points(b, n, device, requires_grad=True), _points(b, n, device)
+    return lambda: chamfer_sqrt(p1, p2)[0].backward()
+
+
+@case('chamfer_torch', ('n', 'b'), pairwise=True)
+def _chamfer_torch(device, n, b, k):
+    p1, p2 = _points(b, n, device, requires_grad=True), _points(b, n, device)
+    return lambda: torch_chamfer_sqrt(p1, p2).backward()
+
+
+@case('transformer', ('n', 'b', 'k'), cuda_only=True, pairwise=True)
+def _transformer(device, n, b, k):
+    Transformer = _import('models.utils', 'Transformer')
+    module = Transformer(128, dim=64, n_knn=k).to(device).train()
+    return _forward_backward(module, torch.rand(b, 128, n, device=device), torch.rand(b, 3, n, device=device))
+
+
+@case('skip_transformer', ('n', 'b', 'k'), cuda_only=True, pairwise=True)
+def _skip_transformer(device, n, b, k):
+    SkipTransformer = _import('models.skip_transformer', 'SkipTransformer')
+    module = SkipTransformer(in_channel=128, dim=64, n_knn=k).to(device).train()
+    pos, key, query = torch.rand(b, 3, n, device=device), torch.rand(b, 128, n, device=device), \
+        torch.rand(b, 128, n, device=device)
+    return _forward_backward(module, pos, key, query)
+
+
+@case('spd', ('n', 'b'), cuda_only=True, pairwise=True)
+def _spd(device, n, b, k):
+    # N is the number of points before upsampling (512 in SnowflakeNet)
+    SPD = _import('models.model25', 'SPD')
+    module = SPD(dim_feat=512, up_factor=2, i=1).to(device).train()
+    return _forward_backward(module, torch.rand(b, 3, n, device=device), torch.rand(b, 512, 1, device=device),
+                             torch.rand(b, 128, n, device=device))
+
+
+@case('feature_extractor', ('n', 'b'), cuda_only=True, min_n=512)
+def _feature_extractor(device, n, b, k):
+    FeatureExtractor = _import('models.model25', 'FeatureExtractor')
+    module = FeatureExtractor(out_dim=512).to(device).train()
+    return _forward_backward(module, torch.rand(b, 3, n, device=device))
+
+
+@case('snowflakenet', ('n', 'b'), cuda_only=True, min_n=512)
+def _snowflakenet(device, n, b, k):
+    Model = _import('models.model25', 'SnowflakeNet')
+    model = Model(dim_feat=512, num_pc=256, ncat=8, up_factors=[1, 2]).to(device).train()
+    partial = _points(b, n, device)
+
+    def fn():
+        model.zero_grad(set_to_none=True)
+        pcds_pred, labels_pred, _ = model(partial)
+        # The decoder keeps host copies of every batch for the information plane
+        model.decoder.reset()
+        model.decoder.deep_cls.reset()
+        (sum(p.mean() for p in pcds_pred) + sum(l.mean() for l in labels_pred)).backward()
+    return fn
+
+
+def _sync(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def time_fn(fn, device, n_warmup=3, n_repeat=10):
+    """Milliseconds per call over n_repeat calls, each waited for on the device"""
+    for _ in range(n_warmup):
+        fn()
+    _sync(device)
+    times = []
+    for _ in range(n_repeat):
+        start = perf_counter()
+        fn()
+        _sync(device)
+        times.append((perf_counter() - start) * 1e3)
+    return {
+        'median_ms': statistics.median(times),
+        'mean_ms': statistics.mean(times),
+        'min_ms': min(times),
+        'std_ms': statistics.stdev(times) if len(times) > 1 else 0.
+    }
+
+
+def result_key(name, n, b, k):
+    return '%s/N=%d/B=%d' % (name, n, b) + ('/k=%d' % k if k is not None else '')
+
+
+def run(case_names, device, ns, batch_sizes, ks, n_warmup=3, n_repeat=10, max_pairs=MAX_PAIRS):
+    results = collections.OrderedDict()
+    for name in case_names:
+        spec = CASES[name]
+        for n in ns:
+            for b in batch_sizes:
+                for k in (ks if 'k' in spec['axes'] else [None]):
+                    key = result_key(name, n, b, k)
+                    try:
+                        if spec['cuda_only'] and device.type != 'cuda':
+                            raise Skip('needs CUDA (extension op without a CPU implementation)')
+                        if n < spec['min_n']:
+                            raise Skip('needs N >= %d' % spec['min_n'])
+                        if spec['pairwise'] and b * n * n > max_pairs:
+                            raise Skip('B * N * N = %d distances > --max-pairs' % (b * n * n))
+                        if k is not None and k > n:
+                            raise Skip('k > N')
+                        torch.manual_seed(0)
+                        result = time_fn(spec['setup'](device, n, b, k), device, n_warmup, n_repeat)
+                        result['samples_per_sec'] = b * 1e3 / result['median_ms']
+                    except Skip as e:
+                        result = {'skipped': str(e)}
+                    except RuntimeError as e:
+                        if 'out of memory' not in str(e) and "can't allocate memory" not in str(e):
+                            raise
+                        result = {'skipped': 'out of memory'}
+                    if device.type == 'cuda':
+                        torch.cuda.empty_cache()
+                    results[key] = result
+                    logging.info('%-50s %s' % (key, '%.3f ms' % result['median_ms'] if 'median_ms' in result
+                                               else 'skipped: %s' % result['skipped']))
+    return results
+
+
+def metadata(device):
+    meta = {
+        'host': socket.gethostname(),
+        'time': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'device': str(device),
+        'threads': torch.get_num_threads(),
+        'processor': platform.processor()
+    }
+    if device.type == 'cuda':
+        meta['device_name'] = torch.cuda.get_device_name(device)
+        meta['cuda'] = torch.version.cuda
+    return meta
+
+
+def compare(results, baseline, threshold=0.1):
+    """[(key, baseline ms, ms, ratio, status)] for the cases timed in both runs.
+
+    status is 'regression' when the median time grew by more than `threshold` (a fraction), 'improvement' when
+    it shrank by as much, 'ok' otherwise.
+    """
+    rows = []
+    for key, result in results.items():
+        base = baseline.get(key)
+        if base is None or 'median_ms' not in base or 'median_ms' not in result:
+            continue
+        ratio = result['median_ms'] / base['median_ms']
+        if ratio > 1. + threshold:
+            status = 'regression'
+        elif ratio < 1. / (1. + threshold):
+            status = 'improvement'
+        else:
+            status = 'ok'
+        rows.append((key, base['median_ms'], result['median_ms'], ratio, status))
+    return rows
+
+
+def write_results(output, output_path):
+    output_dir = os.path.dirname(output_path)
+    if output_dir and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    with open(output_path + '.tmp', 'w') as f:
+        json.dump(output, f, indent=4)
+    os.replace(output_path + '.tmp', output_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Micro-benchmarks of point ops, losses and model stages')
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--cases', nargs='+', default=list(CASES), choices=list(CASES))
+    parser.add_argument('--n', nargs='+', type=int, default=[512, 2048, 8192, 16384], help='Points per cloud')
+    parser.add_argument('--batch-size', nargs='+', type=int, default=[1, 8])
+    parser.add_argument('--k', nargs='+', type=int, default=[8, 16], help='Neighbours, for the k-NN based cases')
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--threads', type=int, default=0, help='torch CPU threads; 0: default')
+    parser.add_argument('--max-pairs', type=int, default=MAX_PAIRS, help='Skip pairwise cases above B * N * N')
+    parser.add_argument('--out', default=None, help='JSON to write (default: <OUT_PATH>/benchmarks/...)')
+    parser.add_argument('--results', default=None, help='Compare this earlier JSON instead of running')
+    parser.add_argument('--baseline', default=None, help='JSON of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1, help='Slowdown flagged as a regression (0.1: 10%%)')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='[%(levelname)s] %(asctime)s %(message)s', level=logging.INFO)
+    if args.results is not None:
+        with open(args.results) as f:
+            output = json.load(f)
+    else:
+        if args.threads > 0:
+            torch.set_num_threads(args.threads)
+        device = torch.device(args.device)
+        output = {
+            'meta': metadata(device),
+            'results': run(args.cases, device, args.n, args.batch_size, args.k, args.warmup, args.repeat,
+                           args.max_pairs)
+        }
+        output_path = args.out or os.path.join(cfg.DIR.OUT_PATH, 'benchmarks', '%s-%s-%s.json' % (
+            socket.gethostname(), device.type, datetime.now().strftime('%Y%m%d-%H%M%S')))
+        write_results(output, output_path)
+        logging.info('Results written to %s' % output_path)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        for field in ('host', 'device', 'device_name', 'torch', 'threads'):
+            if baseline['meta'].get(field) != output['meta'].get(field):
+                logging.warning('Baseline %s differs: %s vs %s' % (field, baseline['meta'].get(field),
+                                                                  output['meta'].get(field)))
+        rows = compare(output['results'], baseline['results'], args.threshold)
+        width = max([len('Case')] + [len(row[0]) for row in rows])
+        print('%-*s %12s %12s %8s  %s' % (width, 'Case', 'Baseline ms', 'ms', 'Ratio', 'Status'))
+        for key, base_ms, ms, ratio, status in rows:
+            print('%-*s %12.3f %12.3f %8.3f  %s' % (width, key, base_ms, ms, ratio, status))
+        regressions = [row for row in rows if row[4] == 'regression']
+        if regressions:
+            logging.error('%d of %d cases are more than %.0f%% slower than the baseline' %
+                          (len(regressions), len(rows), 100 * args.threshold))
+            sys.exit(1)
+        logging.info('No regressions above %.0f%% in %d cases' % (100 * args.threshold, len(rows)))
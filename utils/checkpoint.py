@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+# Checkpoints snapshotted on the training thread and written by a background thread, with full resume state.
+
+import glob
+import json
+import logging
+import os
+import queue
+import random
+import re
+import shutil
+import threading
+import numpy as np
+import torch
+
+
+def _to_cpu(obj):
+    """Deep copy of a (nested) state dict with every tensor detached and copied to host memory"""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, _to_cpu(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(v) for v in obj)
+    return obj
+
+
+def get_rng_state():
+    state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state()
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available() and len(state['cuda']) == torch.cuda.device_count():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def _atomic_save(obj, output_path):
+    tmp_path = '%s.%d.tmp' % (output_path, os.getpid())
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, output_path)
+
+
+def _atomic_link(src_path, output_path):
+    # A second name for an already written checkpoint, without writing it again where hard links work
+    tmp_path = '%s.%d.tmp' % (output_path, os.getpid())
+    try:
+        os.link(src_path, tmp_path)
+    except OSError:
+        shutil.copyfile(src_path, tmp_path)
+    os.replace(tmp_path, output_path)
+
+
+class CheckpointManager(object):
+    """Saves checkpoints into `ckpt_dir` without stalling training.
+
+    save() copies the state to host memory on the calling thread, so training may continue to update the
+    model right away; a background thread serialises the copy to a temporary file and renames it into place.
+    At most one snapshot waits behind the one being written. Retention: the `keep_last` most recent epoch
+    checkpoints (ckpt-epoch-%03d.pth) and the `keep_best` best ones by metric (ckpt-best-epoch-%03d.pth),
+    the very best also as ckpt-best.pth. checkpoints.json, written last, lists what is on disk.
+
+    An epoch checkpoint saved with `pin=True` survives retention until promote() ranks it by a metric that
+    is only known later, e.g. from an AsyncEvaluator.
+    """
+    def __init__(self, ckpt_dir, keep_last=3, keep_best=3, mode='max'):
+        self.ckpt_dir = ckpt_dir
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.mode = mode
+        self.last = []  # epoch checkpoint file names, oldest first
+        self.best = []  # (metric, file name), best first
+        self._pinned = set()
+        self._queue = queue.Queue(maxsize=1)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def is_better(self, metric):
+        if len(self.best) < self.keep_best:
+            return True
+        worst = self.best[-1][0]
+        return metric > worst if self.mode == 'max' else metric < worst
+
+    def save(self, state, epoch_idx, metric=None, save_last=True, pin=False):
+        """`metric` (e.g. the best validation accuracy) ranks checkpoints for keep-best"""
+        self._raise_error()
+        save_best = metric is not None and self.keep_best > 0 and self.is_better(metric)
+        if not save_last and not save_best:
+            return
+        if pin and save_last:
+            self._pinned.add('ckpt-epoch-%03d.pth' % epoch_idx)
+        self._queue.put((self._write, (_to_cpu(state), epoch_idx, metric, save_last, save_best)))
+
+    def promote(self, epoch_idx, metric):
+        """Ranks the pinned checkpoint of `epoch_idx` by `metric` and releases it to retention"""
+        self._raise_error()
+        self._queue.put((self._promote, (epoch_idx, metric)))
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                self._queue.task_done()
+                return
+            try:
+                job[0](*job[1])
+            except Exception as e:
+                logging.exception('Failed to save checkpoint')
+                self._error = e
+            self._queue.task_done()
+
+    def _write(self, state, epoch_idx, metric, save_last, save_best):
+        written = None
+        if save_last:
+            name = 'ckpt-epoch-%03d.pth' % epoch_idx
+            written = os.path.join(self.ckpt_dir, name)
+            _atomic_save(state, written)
+            self.last = [n for n in self.last if n != name] + [name]
+            logging.info('Saved checkpoint to %s ...' % written)
+        if save_best:
+            if written is None:
+                written = os.path.join(self.ckpt_dir, 'ckpt-best-epoch-%03d.pth' % epoch_idx)
+                _atomic_save(state, written)
+            self._add_best(written, epoch_idx, metric)
+        self._retain()
+
+    def _promote(self, epoch_idx, metric):
+        name = 'ckpt-epoch-%03d.pth' % epoch_idx
+        self._pinned.discard(name)
+        file_path = os.path.join(self.ckpt_dir, name)
+        if self.keep_best > 0 and self.is_better(metric):
+            if os.path.exists(file_path):
+                self._add_best(file_path, epoch_idx, metric)
+            else:
+                logging.warning('No checkpoint of epoch %d to keep as best (%.4f)' % (epoch_idx, metric))
+        self._retain()
+
+    def _add_best(self, src_path, epoch_idx, metric):
+        name = 'ckpt-best-epoch-%03d.pth' % epoch_idx
+        output_path = os.path.join(self.ckpt_dir, name)
+        if src_path != output_path:
+            _atomic_link(src_path, output_path)
+        self.best = [b for b in self.best if b[1] != name] + [(metric, name)]
+        self.best.sort(key=lambda b: b[0], reverse=self.mode == 'max')
+        if self.best[0][1] == name:
+            _atomic_link(output_path, os.path.join(self.ckpt_dir, 'ckpt-best.pth'))
+        logging.info('Saved best checkpoint (%.4f) to %s ...' % (metric, output_path))
+
+    def _retain(self):
+        # Retention, then the index of what is kept
+        removed = [b[1] for b in self.best[self.keep_best:]]
+        self.best = self.best[:self.keep_best]
+        expired = self.last[:max(0, len(self.last) - self.keep_last)]
+        removed += [n for n in expired if n not in self._pinned]
+        self.last = [n for n in self.last if n not in removed]
+        for name in removed:
+            file_path = os.path.join(self.ckpt_dir, name)
+            if os.path.exists(file_path):
+                os.remove(file_path)
+        tmp_path = os.path.join(self.ckpt_dir, 'checkpoints.json.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump({'last': self.last, 'best': self.best}, f, indent=4)
+        os.replace(tmp_path, os.path.join(self.ckpt_dir, 'checkpoints.json'))
+
+    def wait(self):
+        """Blocks until every queued checkpoint is on disk"""
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        self.wait()
+        self._queue.put(None)
+        self._thread.join()
+
+
+def latest_checkpoint(ckpt_dir):
+    """Path of the most recent complete epoch checkpoint in `ckpt_dir`, or None"""
+    file_paths = glob.glob(os.path.join(ckpt_dir, 'ckpt-epoch-*.pth'))
+    if not file_paths:
+        return None
+    return max(file_paths, key=lambda p: int(re.search(r'ckpt-epoch-(\d+)\.pth$', p).group(1)))
@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+# Throughput of the data pipeline: samples/sec, the cost of each stage (IO.get, transforms, collate, H2D) and the
+# utilisation of the DataLoader workers, for each loader of DATASET_LOADER_MAPPING and each worker count.
+# Usage: python -m utils.data_benchmark [--root /tmp/pcn-synthetic [--generate]] [--datasets ModelNet40]
+#        [--workers 0 2 4 8] [--batch-size 32] [--batches 50]
+#
+# With --root, the datasets are read from there (see utils.synthetic_data); --generate writes them first.
+# Stage times are measured inside the workers and summed over them, so with several workers they add up to
+# more than the wall time; utilisation is the busy fraction of each worker's wall time.
+
+import argparse
+import collections
+import inspect
+import logging
+import os
+import socket
+from datetime import datetime
+from time import perf_counter
+import torch
+import utils.data_loaders
+import utils.data_transforms
+import utils.synthetic_data
+
+from config_pcn import cfg
+from utils.benchmark import metadata, write_results
+from utils.io import IO
+
+# Columns of the per-worker stage counters
+STAGES = ['fetch', 'io', 'transform', 'collate', 'samples', 'batches']
+MAX_WORKERS = 256
+
+# Counters of this process: a row of the shared stats tensor, and the nesting depth of timed calls, so that
+# IO.get_many -> IO.get or a Compose within a Compose is counted once
+_row = None
+_depth = collections.Counter()
+
+
+def _timed(stage, fn):
+    def wrapper(*args, **kwargs):
+        if _row is None or _depth[stage] > 0:
+            return fn(*args, **kwargs)
+        _depth[stage] += 1
+        start = perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _row[STAGES.index(stage)] += perf_counter() - start
+            _depth[stage] -= 1
+    wrapper.__wrapped__ = fn
+    return wrapper
+
+
+def _install_timers():
+    # Once per process: the class attributes are shared by every caller of IO and Compose
+    if getattr(IO.get, '__wrapped__', None) is None:
+        for name in ('get', 'get_many', 'decode'):
+            setattr(IO, name, classmethod(_timed('io', getattr(IO, name).__func__)))
+        utils.data_transforms.Compose.__call__ = _timed('transform', utils.data_transforms.Compose.__call__)
+
+
+def _bind(stats):
+    global _row
+    worker_info = torch.utils.data.get_worker_info()
+    _row = stats[0 if worker_info is None else worker_info.id + 1]
+    _install_timers()
+
+
+class _TimedDataset(torch.utils.data.Dataset):
+    """Map-style dataset timing each fetch (one sample, or one batch through __getitems__) in its process"""
+    def __init__(self, dataset, stats):
+        self.dataset = dataset
+        self.stats = stats
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def _fetch(self, fn, n_samples):
+        _bind(self.stats)
+        start = perf_counter()
+        result = fn()
+        _row[STAGES.index('fetch')] += perf_counter() - start
+        _row[STAGES.index('samples')] += n_samples
+        return result
+
+    def __getitem__(self, idx):
+        return self._fetch(lambda: self.dataset[idx], 1)
+
+    def __getitems__(self, indices):
+        if hasattr(self.dataset, '__getitems__'):
+            return self._fetch(lambda: self.dataset.__getitems__(indices), len(indices))
+        return self._fetch(lambda: [self.dataset[idx] for idx in indices], len(indices))
+
+
+class _TimedIterableDataset(torch.utils.data.IterableDataset):
+    """Streaming dataset (e.g. ShardDataset) timing each sample it yields"""
+    def __init__(self, dataset, stats):
+        self.dataset = dataset
+        self.stats = stats
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __iter__(self):
+        _bind(self.stats)
+        it = iter(self.dataset)
+        while True:
+            start = perf_counter()
+            try:
+                sample = next(it)
+            except StopIteration:
+                return
+            _row[STAGES.index('fetch')] += perf_counter() - start
+            _row[STAGES.index('samples')] += 1
+            yield sample
+
+
+class _TimedCollate(object):
+    def __init__(self, collate_fn, stats):
+        self.collate_fn = collate_fn
+        self.stats = stats
+
+    def __call__(self, batch):
+        _bind(self.stats)
+        start = perf_counter()
+        result = self.collate_fn(batch)
+        _row[STAGES.index('collate')] += perf_counter() - start
+        _row[STAGES.index('batches')] += 1
+        return result
+
+
+def _to_device(batch, device):
+    # Every tensor of the batch, as train_25 moves them (non_blocking from the collator's pinned buffers)
+    if torch.is_tensor(batch):
+        return batch.to(device, non_blocking=True)
+    if isinstance(batch, dict):
+        return {k: _to_device(v, device) for k, v in batch.items()}
+    if isinstance(batch, (list, tuple)):
+        return [_to_device(v, device) for v in batch]
+    return batch
+
+
+def _get_dataset(loader, subset):
+    # Loaders without multi-view support take the subset only
+    if 'n_views' in inspect.signature(loader.get_dataset).parameters:
+        return loader.get_dataset(subset, n_views=1)
+    return loader.get_dataset(subset)
+
+
+def measure(dataset, batch_size, num_workers, n_batches, n_warmup, prefetch_factor=2, shuffle=True):
+    """Throughput of one DataLoader configuration over n_batches, after n_warmup batches"""
+    stats = torch.zeros(MAX_WORKERS + 1, len(STAGES), dtype=torch.float64).share_memory_()
+    is_iterable = isinstance(dataset, torch.utils.data.IterableDataset)
+    timed = _TimedIterableDataset(dataset, stats) if is_iterable else _TimedDataset(dataset, stats)
+    segmentation = isinstance(dataset, utils.data_loaders.Datasetv0)
+    kwargs = {'prefetch_factor': prefetch_factor, 'persistent_workers': False} if num_workers > 0 else {}
+    data_loader = torch.utils.data.DataLoader(
+        dataset=timed, batch_size=batch_size, num_workers=num_workers,
+        collate_fn=_TimedCollate(utils.data_loaders.BatchCollator(segmentation=segmentation), stats),
+        pin_memory=True, shuffle=shuffle and not is_iterable, drop_last=False, **kwargs)
+    device = torch.device('cuda') if torch.cuda.is_available() else None
+
+    start = perf_counter()
+    it = iter(data_loader)
+    wait_time = h2d_time = 0.
+    n_samples = n_timed = 0
+    first_batch_time = None
+    for batch_idx in range(n_warmup + n_batches):
+        if batch_idx == n_warmup:
+            # Work done so far (worker start-up, prefetching) is not counted
+            stats.zero_()
+            wait_time = h2d_time = 0.
+            n_samples = 0
+            start = perf_counter()
+        fetch_start = perf_counter()
+        try:
+            batch = next(it)
+        except StopIteration:
+            break
+        wait_time += perf_counter() - fetch_start
+        if first_batch_time is None:
+            first_batch_time = perf_counter() - start
+        if device is not None:
+            h2d_start = perf_counter()
+            _to_device(batch, device)
+            torch.cuda.synchronize()
+            h2d_time += perf_counter() - h2d_start
+        n_samples += len(batch[-1])
+        n_timed = batch_idx - n_warmup + 1
+    elapsed = perf_counter() - start
+    del it
+
+    if n_timed <= 0 or n_samples == 0:
+        return {'skipped': 'fewer than %d batches' % (n_warmup + 1)}
+    rows = stats[:num_workers + 1] if num_workers > 0 else stats[:1]
+    totals = dict(zip(STAGES, rows.sum(0).tolist()))
+    # Worker rows start at 1; without workers everything runs in the main process (row 0)
+    busy = [row[STAGES.index('fetch')] + row[STAGES.index('collate')] for row in
+            (rows[1:] if num_workers > 0 else rows).tolist()]
+    produced = max(1., totals['samples'])
+    return {
+        'batches': n_timed,
+        'samples': n_samples,
+        'samples_per_sec': n_samples / elapsed,
+        'first_batch_sec': first_batch_time,
+        'data_wait': wait_time / elapsed,
+        'stage_ms_per_sample': {
+            'io': 1e3 * totals['io'] / produced,
+            'transform': 1e3 * totals['transform'] / produced,
+            'other_fetch': 1e3 * (totals['fetch'] - totals['io'] - totals['transform']) / produced,
+            'collate': 1e3 * totals['collate'] / produced,
+            'h2d': 1e3 * h2d_time / n_samples if device is not None else None
+        },
+        'worker_utilisation': {
+            'mean': sum(busy) / len(busy) / elapsed,
+            'min': min(busy) / elapsed,
+            'max': max(busy) / elapsed,
+            'per_worker': [b / elapsed for b in busy]
+        }
+    }
+
+
+def run(cfg, datasets, subsets, worker_counts, batch_size, n_batches, n_warmup):
+    results = collections.OrderedDict()
+    for dataset_name in datasets:
+        for subset in subsets:
+            try:
+                loader = utils.data_loaders.DATASET_LOADER_MAPPING[dataset_name](cfg)
+                dataset = _get_dataset(loader, subset)
+            except Exception as e:
+                # e.g. KITTI (no cfg.DATASETS.KITTI) or datasets that are not on disk
+                logging.warning('Skipping %s/%s: %s' % (dataset_name, subset.name.lower(), e))
+                results['%s/%s' % (dataset_name, subset.name.lower())] = {'skipped': '%s: %s' % (type(e).__name__, e)}
+                continue
+            for num_workers in worker_counts:
+                key = '%s/%s/workers=%d' % (dataset_name, subset.name.lower(), num_workers)
+                result = measure(dataset, batch_size, num_workers, n_batches, n_warmup,
+                                 cfg.CONST.PREFETCH_FACTOR, shuffle=subset == utils.data_loaders.DatasetSubset.TRAIN)
+                results[key] = result
+                if 'skipped' in result:
+                    logging.info('%-40s skipped: %s' % (key, result['skipped']))
+                else:
+                    logging.info('%-40s %8.1f samples/s, wait %.0f%%, utilisation %.0f%%, ms/sample %s' % (
+                        key, result['samples_per_sec'], 100 * result['data_wait'],
+                        100 * result['worker_utilisation']['mean'],
+                        {k: round(v, 3) for k, v in result['stage_ms_per_sample'].items() if v is not None}))
+    return results
+
+
+if __name__ == '__main__':
+    n_cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    parser = argparse.ArgumentParser(description='Data pipeline throughput per loader and worker count')
+    parser.add_argument('--root', default=None, help='Read the datasets under this directory (synthetic data)')
+    parser.add_argument('--generate', action='store_true', help='Write synthetic datasets under --root first')
+    parser.add_argument('--train-objects', type=int, default=16, help='Per class, with --generate')
+    parser.add_argument('--test-objects', type=int, default=4, help='Per class, with --generate')
+    parser.add_argument('--datasets', nargs='+', default=list(utils.data_loaders.DATASET_LOADER_MAPPING),
+                        choices=list(utils.data_loaders.DATASET_LOADER_MAPPING))
+    parser.add_argument('--subsets', nargs='+', default=['train', 'test'], choices=['train', 'test', 'val'])
+    parser.add_argument('--workers', nargs='+', type=int,
+                        default=[n for n in [0, 1, 2, 4, 8, 16] if n <= n_cpus])
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--batches', type=int, default=50, help='Timed batches per configuration')
+    parser.add_argument('--warmup', type=int, default=5, help='Batches before timing starts')
+    parser.add_argument('--sample-cache', action='store_true',
+                        help='Use the shared sample cache (later configurations then read cached clouds)')
+    parser.add_argument('--out', default=None, help='JSON to write (default: <OUT_PATH>/benchmarks/...)')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='[%(levelname)s] %(asctime)s %(message)s', level=logging.INFO)
+    cfg.DATASETS.CACHE.ENABLED = args.sample_cache
+    output_path = os.path.abspath(args.out or os.path.join(cfg.DIR.OUT_PATH, 'benchmarks', 'data-%s-%s.json' % (
+        socket.gethostname(), datetime.now().strftime('%Y%m%d-%H%M%S'))))
+    if args.generate:
+        if args.root is None:
+            parser.error('--generate needs --root')
+        utils.synthetic_data.generate(cfg, os.path.abspath(args.root), args.datasets, args.train_objects,
+                                      args.test_objects, ['files', 'shards'] if 'Shards' in args.datasets else
+                                      ['files'])
+
+    subsets = [utils.data_loaders.DatasetSubset[s.upper()] for s in args.subsets]
+    with utils.synthetic_data.in_root(os.path.abspath(args.root or '.')):
+        results = run(cfg, args.datasets, subsets, args.workers, args.batch_size, args.batches, args.warmup)
+    output = {
+        'meta': dict(metadata(torch.device('cuda' if torch.cuda.is_available() else 'cpu')), root=args.root,
+                     batch_size=args.batch_size, sample_cache=args.sample_cache),
+        'results': results
+    }
+    write_results(output, output_path)
+    logging.info('Results written to %s' % output_path)
@@ -15,6 +15,11 @@ import utils.data_transforms
 from enum import Enum, unique
 from tqdm import tqdm
 from utils.io import IO
+from utils.h5_backend import LazyH5Array
+from utils.sample_cache import SharedSampleCache, shm_available_bytes
+from utils.manifest import ManifestCache
+from utils.partial_views import SeedPatchSampler
+from utils.shards import ShardDataset
 import glob
 import os
 import h5py
@@ -123,104 +128,55 @@ class DatasetSubset(Enum):
     VAL = 2
 
 
-def collate_fn(batch): # allocate batch size of data, and output one more dimension: labels
-    taxonomy_ids = [] # will be size of B
-    model_ids = []
-    data = {}
-    labels = [] # will be size of B
-
-    for sample in batch:
-        taxonomy_ids.append(sample[0])
-        model_ids.append(sample[1])
-        labels.append(label_mapping[sample[0]])
-        _data = sample[2]
-        for k, v in _data.items():
-            if k not in data:
-                data[k] = []
-            data[k].append(v)
-
-    for k, v in data.items(): #k: partial_cloud or gtcloud
-        data[k] = torch.stack(v, 0) #B, 2048 or 16384, 3
-
-    return taxonomy_ids, model_ids, data, labels
-
-def collate_fn2(batch): # allocate batch size of data, and output one more dimension: labels
-    taxonomy_ids = [] # will be size of B
-    model_ids = []
-    data = {}
-    labels = [] # will be size of B
-
-    for sample in batch:
-        taxonomy_ids.append(sample[0])
-        model_ids.append(sample[1])
-        labels.append(label_mapping2[sample[0]])
-        _data = sample[2]
-        for k, v in _data.items():
-            if k not in data:
-                data[k] = []
-            data[k].append(v)
-
-    for k, v in data.items(): #k: partial_cloud or gtcloud
-        data[k] = torch.stack(v, 0) #B, 2048 or 16384, 3
-
-    return taxonomy_ids, model_ids, data, labels
-
-def collate_fn3(batch): # allocate batch size of data, and output one more dimension: labels
-    taxonomy_ids = [] # will be size of B
-    model_ids = []
-    data = {}
-    labels = [] # will be size of B
-
-    for sample in batch:
-        taxonomy_ids.append(sample[0])
-        model_ids.append(sample[1])
-        labels.append(label_mapping3[sample[0]])
-        _data = sample[2]
-        for k, v in _data.items():
-            if k not in data:
-                data[k] = []
-            data[k].append(v)
-
-    for k, v in data.items(): #k: partial_cloud or gtcloud
-        data[k] = torch.stack(v, 0) #B, 2048 or 16384, 3
-
-    return taxonomy_ids, model_ids, data, labels
-
-def collate_fn4(batch): # allocate batch size of data, and output one more dimension: labels
-    taxonomy_ids = [] # will be size of B
-    model_ids = []
-    data = {}
-    data_label = {} # will be size of B
-    data_class_label = []
-
-    for sample in batch:
-        taxonomy_ids.append(sample[0])
-        model_ids.append(sample[1])
-        data_class_label.append(label_mapping_partv0[sample[0]])
-        _data = sample[2]
-        _data_label = sample[3]
-        for k, v in _data.items():
-            if k not in data:
-                data[k] = []
-            data[k].append(v)
-        for k, v in _data_label.items():
-            if k not in data_label:
-                data_label[k] = []
-            data_label[k].append(v)
-
-    data_class_label = torch.tensor(data_class_label)
-    # print(f'data_class_label {data_class_label}')
-    for k, v in data.items(): #k: partial_cloud or gtcloud
-        data[k] = torch.stack(v, 0) #B, 2048 or 16384, 3
-    #     print(f'v1 v: {v[0].shape, type(v)}')
-    #     print(f'v1 data[k]: {data[k].shape}')
-    # print(f'v1 data[gtcloud]: ', data['gtcloud'].shape)
-    for k, v in data_label.items(): #k: partial_cloud or gtcloud
-        # print(f'v2: {v[0].shape, type(v)}')
-        data_label[k] = torch.stack(v, 0) #B, 2048 or 16384, 3
-    # print(f'v1 data_label[gtlabel]: ', data_label['gtlabel'].shape)
-
-    return taxonomy_ids, model_ids, data, data_label, data_class_label
+class BatchCollator(object):
+    """Single collate function for all datasets.
+
+    Class ids are resolved by the Dataset (last element of each sample) and returned as an
+    int64 tensor. Inside workers the batch is stacked straight into shared memory, so it is
+    sent to the main process without another copy; in the main process with CUDA available
+    it is stacked into pinned memory, ready for non_blocking H2D.
+    """
+    def __init__(self, segmentation=False, n_views=1):
+        self.segmentation = segmentation
+        self.n_views = n_views
+
+    def __call__(self, batch):
+        taxonomy_ids = [sample[0] for sample in batch]
+        model_ids = [sample[1] for sample in batch]
+        labels = self._out((len(batch), ), torch.int64)
+        labels.copy_(torch.as_tensor([sample[-1] for sample in batch], dtype=torch.int64))
+        data = self._stack_dict([sample[2] for sample in batch])
+        if self.segmentation:
+            data_label = self._stack_dict([sample[3] for sample in batch])
+            return taxonomy_ids, model_ids, data, data_label, labels
+        if self.n_views > 1:
+            # Multi-view samples (Dataset with n_views): one row per partial view, everything else per
+            # object; expand_views repeats the per-object items on the device
+            data['partial_cloud'] = data['partial_cloud'].flatten(0, 1)
+            taxonomy_ids = [t for t in taxonomy_ids for _ in range(self.n_views)]
+            model_ids = [m for m in model_ids for _ in range(self.n_views)]
+            labels = labels.repeat_interleave(self.n_views)
+
+        return taxonomy_ids, model_ids, data, labels
+
+    def _stack_dict(self, samples):
+        batch = {}
+        for k in samples[0].keys():
+            v = [s[k] for s in samples]
+            out = self._out((len(v), ) + tuple(v[0].shape), v[0].dtype)
+            batch[k] = torch.stack(v, 0, out=out) #B, 2048 or 16384, 3
+
+        return batch
+
+    def _out(self, shape, dtype):
+        if torch.utils.data.get_worker_info() is not None:
+            # Batches leave the worker through shared memory anyway; allocate them there directly
+            return torch.empty(shape, dtype=dtype).share_memory_()
+        if not torch.cuda.is_available():
+            return torch.empty(shape, dtype=dtype)
+        # A fresh tensor each batch: the caching host allocator only hands a pinned block out again once the
+        # non_blocking copies recorded on it have completed, however far the host runs ahead
+        return torch.empty(shape, dtype=dtype, pin_memory=True)
 
 code_mapping = {
     'plane': '02691156',
@@ -239,37 +195,188 @@ def read_ply(file_path):
     return ptcloud
 
 
+_sample_cache = None
+# Smallest arena worth creating when /dev/shm is short
+_MIN_SAMPLE_CACHE_BYTES = 64 * 1024 ** 2
+
+
+def get_sample_cache(cfg):
+    """Process-wide shared cache; created once in the main process before workers start"""
+    global _sample_cache
+    if 'CACHE' not in cfg.DATASETS or not cfg.DATASETS.CACHE.ENABLED:
+        return None
+    if _sample_cache is None:
+        max_bytes = cfg.DATASETS.CACHE.MAX_BYTES
+        # Pages of the arena are only backed when written: an arena larger than /dev/shm raises SIGBUS later
+        shm_bytes = shm_available_bytes()
+        if shm_bytes is not None and max_bytes > shm_bytes // 2:
+            max_bytes = shm_bytes // 2
+            logging.warning('Sample cache reduced to %d MiB, half the free /dev/shm' % (max_bytes // 1024 ** 2))
+        if max_bytes < _MIN_SAMPLE_CACHE_BYTES:
+            logging.warning('Sample cache disabled: too little free /dev/shm')
+            _sample_cache = False
+        else:
+            _sample_cache = SharedSampleCache(max_bytes, cfg.DATASETS.CACHE.MAX_ENTRIES)
+    return _sample_cache or None
+
+
+_manifest_cache = None
+
+
+def get_file_list(cfg, loader, subset, n_renderings, dataset_cfg, sources):
+    """loader._get_file_list through the manifest cache, invalidated by `sources` and the config"""
+    global _manifest_cache
+    if 'MANIFEST' not in cfg.DATASETS or not cfg.DATASETS.MANIFEST.ENABLED:
+        return loader._get_file_list(cfg, subset, n_renderings)
+    if _manifest_cache is None:
+        _manifest_cache = ManifestCache(cfg.DATASETS.MANIFEST.CACHE_DIR)
+    categories = [dc if type(dc) == dict else str(dc) for dc in loader.dataset_categories]
+    return _manifest_cache.load('%s-%s' % (type(loader).__name__, subset),
+                                [n_renderings, dict(dataset_cfg), categories], sources,
+                                lambda: loader._get_file_list(cfg, subset, n_renderings))
+
+
+def group_by_taxonomy(samples, taxonomy_ids):
+    """Samples of each taxonomy in file order, using the same `category_name in taxonomy_id` rule
+    as before but matching each distinct category name once instead of every sample per taxonomy"""
+    matches = {}
+    grouped = {taxonomy_id: [] for taxonomy_id in taxonomy_ids}
+    for s in samples:
+        category_name = s.split('_')[0]
+        if category_name not in matches:
+            matches[category_name] = [t for t in taxonomy_ids if category_name in t]
+        for taxonomy_id in matches[category_name]:
+            grouped[taxonomy_id].append(s)
+
+    return grouped
+
+
+def get_partial_sampler(cfg):
+    """Sampler replacing the pre-rendered partial_cloud files, or None to read them from disk"""
+    if 'ONLINE_PARTIAL' not in cfg.DATASETS or not cfg.DATASETS.ONLINE_PARTIAL.ENABLED:
+        return None
+    return SeedPatchSampler(cfg.DATASETS.ONLINE_PARTIAL.NUM_SEED, cfg.DATASETS.ONLINE_PARTIAL.K,
+                            cfg.DATASETS.ONLINE_PARTIAL.CACHE_DIR)
+
+
+def load_points(file_path):
+    return IO.get(file_path).astype(np.float32)
+
+
+def load_items(cache, cached_items, items):
+    """Arrays for (item, file path) pairs; cache misses are read with a single IO.get_many"""
+    arrays = [None] * len(items)
+    if cache is not None:
+        for i, (ri, file_path) in enumerate(items):
+            if ri in cached_items:
+                arrays[i] = cache.get(file_path)
+    misses = [i for i, array in enumerate(arrays) if array is None]
+    for i, array in zip(misses, IO.get_many([items[i][1] for i in misses])):
+        ri, file_path = items[i]
+        arrays[i] = array.astype(np.float32)
+        if cache is not None and ri in cached_items:
+            cache.put(file_path, arrays[i])
+
+    return arrays
+
+
 class Dataset(torch.utils.data.dataset.Dataset):
     def __init__(self, options, file_list, transforms=None):
         self.options = options
         self.file_list = file_list
         self.transforms = transforms
-        self.cache = dict()
+        self.cache = options.get('cache')
+        self.cached_items = options.get('cached_items', [])
+        self.partial_sampler = options.get('partial_sampler')
+        self.n_views = options.get('n_views', 1)
+        # Resolve class ids once, not per sample in the collate function
+        mapping = options.get('label_mapping')
+        self.labels = np.array([mapping[s['taxonomy_id']] if mapping is not None else -1 for s in file_list],
+                               dtype=np.int64)
 
     def __len__(self):
         return len(self.file_list)
 
+    def _sample_partial(self, idx, sample, data, n_views=None):
+        # Fresh views while training; fixed views per object otherwise, so evaluation is repeatable. Every view
+        # of an object is drawn from the same generator, so they differ (and the first is the single view)
+        rng = np.random if self.options['shuffle'] else np.random.RandomState(idx)
+        if n_views is None:
+            return self.partial_sampler(sample['gtcloud_path'], data['gtcloud'], rng)
+        return [self.partial_sampler(sample['gtcloud_path'], data['gtcloud'], rng) for _ in range(n_views)]
 
-    def __getitem__(self, idx):
+    def _plan(self, idx):
+        """(item, file path) pairs read for one sample; partial_cloud appears once per view"""
         sample = self.file_list[idx]
-        data = {}
-        rand_idx = -1
-        if 'n_renderings' in self.options:
-            rand_idx = random.randint(0, self.options['n_renderings'] - 1) if self.options['shuffle'] else 0
+        if self.n_views > 1:
+            n_renderings = self.options.get('n_renderings', 1)
+            if self.options['shuffle'] and n_renderings >= self.n_views:
+                rand_ids = random.sample(range(n_renderings), self.n_views)
+            else:
+                rand_ids = [i % n_renderings for i in range(self.n_views)]
+        else:
+            rand_idx = -1
+            if 'n_renderings' in self.options:
+                rand_idx = random.randint(0, self.options['n_renderings'] - 1) if self.options['shuffle'] else 0
+            rand_ids = [rand_idx]
 
+        items = []
         for ri in self.options['required_items']:
+            if ri == 'partial_cloud' and self.partial_sampler is not None:
+                continue
             file_path = sample['%s_path' % ri]
             if type(file_path) == list:
-                file_path = file_path[rand_idx]
-            # print(file_path)
-            data[ri] = IO.get(file_path).astype(np.float32)
-            # print(f'data[ri]: {data[ri].shape}')
+                items.extend((ri, file_path[i]) for i in rand_ids)
+            else:
+                items.extend([(ri, file_path)] * (self.n_views if ri == 'partial_cloud' else 1))
+        return items
 
+    def _transform_views(self, data, views):
+        """Items other than partial_cloud are transformed once, and all views take the same random augmentation"""
         if self.transforms is not None:
+            rnd_values = self.transforms.draw()
+            data = self.transforms(data, rnd_values)
+            views = [self.transforms({'partial_cloud': v}, rnd_values)['partial_cloud'] for v in views]
+        data['partial_cloud'] = torch.stack(views) if torch.is_tensor(views[0]) else np.stack(views)
+        return data
+
+    def _build(self, idx, items, arrays):
+        sample = self.file_list[idx]
+        data, views = {}, []
+        for (ri, _), array in zip(items, arrays):
+            if ri == 'partial_cloud' and self.n_views > 1:
+                views.append(array)
+            else:
+                data[ri] = array
+        if self.partial_sampler is not None:
+            if self.n_views > 1:
+                views = self._sample_partial(idx, sample, data, self.n_views)
+            else:
+                data['partial_cloud'] = self._sample_partial(idx, sample, data)
+
+        if self.n_views > 1:
+            # partial_cloud holds n_views stacked views of the object, see BatchCollator
+            data = self._transform_views(data, views)
+        elif self.transforms is not None:
             data = self.transforms(data)
         # print(f'Dataset: ', sample['label'])
 
-        return sample['taxonomy_id'], sample['taxonomy_id'], data#, sample['label']
+        return sample['taxonomy_id'], sample['taxonomy_id'], data, self.labels[idx]
+
+    def __getitem__(self, idx):
+        items = self._plan(idx)
+        return self._build(idx, items, load_items(self.cache, self.cached_items, items))
+
+    def __getitems__(self, indices):
+        # Batched fetch, called by the DataLoader (torch >= 2.0) with all indices of a batch:
+        # the files of every sample go to the storage backend in one get_many
+        plans = [self._plan(idx) for idx in indices]
+        arrays = load_items(self.cache, self.cached_items, [item for items in plans for item in items])
+        samples, start = [], 0
+        for idx, items in zip(indices, plans):
+            samples.append(self._build(idx, items, arrays[start:start + len(items)]))
+            start += len(items)
+        return samples
 
 
 class Datasetv0(torch.utils.data.dataset.Dataset):
@@ -277,11 +384,21 @@ class Datasetv0(torch.utils.data.dataset.Dataset):
         self.options = options
         self.file_list = file_list
         self.transforms = transforms
-        self.cache = dict()
+        self.cache = options.get('cache')
+        self.cached_items = options.get('cached_items', [])
+        self.partial_sampler = options.get('partial_sampler')
+        # Resolve class ids once, not per sample in the collate function
+        mapping = options.get('label_mapping')
+        self.labels = np.array([mapping[s['taxonomy_id']] if mapping is not None else -1 for s in file_list],
+                               dtype=np.int64)
 
     def __len__(self):
         return len(self.file_list)
 
+    def _sample_partial(self, idx, sample, data):
+        # Fresh views while training; a fixed view per object otherwise, so evaluation is repeatable
+        rng = np.random if self.options['shuffle'] else np.random.RandomState(idx)
+        return self.partial_sampler(sample['gtcloud_path'], data['gtcloud'], rng)
 
     def __getitem__(self, idx):
         sample = self.file_list[idx]
@@ -290,25 +407,38 @@ class Datasetv0(torch.utils.data.dataset.Dataset):
         if 'n_renderings' in self.options:
             rand_idx = random.randint(0, self.options['n_renderings'] - 1) if self.options['shuffle'] else 0
 
+        items = []
         for ri in self.options['required_items']:
+            if ri == 'partial_cloud' and self.partial_sampler is not None:
+                continue
             file_path = sample['%s_path' % ri]
             if type(file_path) == list:
                 file_path = file_path[rand_idx]
             # print(file_path)
-            data[ri] = IO.get(file_path).astype(np.float32)
+            items.append((ri, file_path))
+        if not self.options.get('packed_labels'):
+            items.extend((ri, sample['%s_path' % ri]) for ri in self.options['required_labels'])
+        for (ri, _), array in zip(items, load_items(self.cache, self.cached_items, items)):
+            data[ri] = array
+        if self.options.get('packed_labels'):
+            # Label columns follow xyz in the gt file, in the order of required_labels
+            packed = data['gtcloud']
+            data['gtcloud'] = packed[:, :3]
+            for i, ri in enumerate(self.options['required_labels']):
+                data[ri] = packed[:, 3 + i]
+        if self.partial_sampler is not None:
+            data['partial_cloud'] = self._sample_partial(idx, sample, data)
             # print(f'data[ri]: {data[ri].shape}')
-        for ri in self.options['required_labels']:
-            label_path = sample['%s_path' % ri]
-            data_label[ri] = IO.get(label_path).astype(np.float32)
-            # print(f'label: {data_label[ri].shape}')
         # print(2)
         if self.transforms is not None:
+            # Points and labels go through one Compose call, so JointRescalePoints can keep them aligned
             data = self.transforms(data) # call the objects (e.g., 'objects': ['partial_cloud', 'gtcloud']) iteratively
-            data_label = self.transforms(data_label)
+        for ri in self.options['required_labels']:
+            data_label[ri] = data.pop(ri)
         # print(f'Dataset data gt:  ', data['gtcloud'].shape)
         # print(f'Dataset data gtlabel:  ', data_label['gtlabel'].shape)
 
-        return sample['taxonomy_id'], sample['taxonomy_name'], data, data_label
+        return sample['taxonomy_id'], sample['taxonomy_name'], data, data_label, self.labels[idx]
 
 
 class ShapeNetDataLoader(object):
@@ -321,19 +451,25 @@ class ShapeNetDataLoader(object):
             # print(f'ShapeNetDataLoader: {f}')
             self.dataset_categories = json.loads(f.read())
 
-    def get_dataset(self, subset):
+    def get_dataset(self, subset, n_views=1):
         # print(f'ShapeNetDataLoader: get_dataset')
         n_renderings = self.cfg.DATASETS.SHAPENET.N_RENDERINGS if subset == DatasetSubset.TRAIN else 1
-        file_list = self._get_file_list(self.cfg, self._get_subset(subset), n_renderings)
+        file_list = get_file_list(self.cfg, self, self._get_subset(subset), n_renderings, self.cfg.DATASETS.SHAPENET,
+                                  [self.cfg.DATASETS.SHAPENET.CATEGORY_FILE_PATH])
         transforms = self._get_transforms(self.cfg, subset)
         return Dataset({
             'n_renderings': n_renderings,
             'required_items': ['partial_cloud', 'gtcloud'],
-            'shuffle': subset == DatasetSubset.TRAIN
+            'shuffle': subset == DatasetSubset.TRAIN,
+            'cache': get_sample_cache(self.cfg),
+            'cached_items': self.cfg.DATASETS.CACHE.ITEMS if 'CACHE' in self.cfg.DATASETS else [],
+            'label_mapping': label_mapping,
+            'n_views': n_views
         }, file_list, transforms)
 
     def _get_transforms(self, cfg, subset):
-        if subset == DatasetSubset.TRAIN:
+        # Mirroring moves to get_batch_transforms when batched augmentation is on
+        if subset == DatasetSubset.TRAIN and not cfg.TRAIN.BATCH_AUGMENTATION:
             return utils.data_transforms.Compose([{
                 'callback': 'RescalePoints',
                 'parameters': {
@@ -421,18 +557,26 @@ class ModelNet40DataLoader(object):
         with open(cfg.DATASETS.MODELNET.CATEGORY_FILE_PATH) as f:
             self.dataset_categories = np.loadtxt(f, dtype=str)
 
-    def get_dataset(self, subset):
+    def get_dataset(self, subset, n_views=1):
         n_renderings = self.cfg.DATASETS.MODELNET.N_RENDERINGS if subset == DatasetSubset.TRAIN else 1
-        file_list = self._get_file_list(self.cfg, self._get_subset(subset), n_renderings)
+        file_list = get_file_list(self.cfg, self, self._get_subset(subset), n_renderings, self.cfg.DATASETS.MODELNET,
+                                  [self.cfg.DATASETS.MODELNET.CATEGORY_FILE_PATH,
+                                   './datasets/ModelNet40/modelnet40_%s.txt' % self._get_subset(subset)])
         transforms = self._get_transforms(self.cfg, subset)
         return Dataset({
             'n_renderings': n_renderings,
             'required_items': ['partial_cloud', 'gtcloud'],
-            'shuffle': subset == DatasetSubset.TRAIN
+            'shuffle': subset == DatasetSubset.TRAIN,
+            'cache': get_sample_cache(self.cfg),
+            'cached_items': self.cfg.DATASETS.CACHE.ITEMS if 'CACHE' in self.cfg.DATASETS else [],
+            'label_mapping': label_mapping2,
+            'partial_sampler': get_partial_sampler(self.cfg),
+            'n_views': n_views
         }, file_list, transforms)
 
     def _get_transforms(self, cfg, subset):
-        if subset == DatasetSubset.TRAIN:
+        # Mirroring moves to get_batch_transforms when batched augmentation is on
+        if subset == DatasetSubset.TRAIN and not cfg.TRAIN.BATCH_AUGMENTATION:
             return utils.data_transforms.Compose([{
                 'callback': 'RescalePoints',
                 'parameters': {
@@ -470,34 +614,27 @@ class ModelNet40DataLoader(object):
         """Prepare file list for the dataset"""
         file_list = []
 
+        samples = group_by_taxonomy(np.loadtxt('./datasets/ModelNet40/modelnet40_%s.txt' % subset, dtype=str),
+                                    list(self.dataset_categories))
         for taxonomy_id in self.dataset_categories:
             logging.info('Collecting files of Taxonomy [Name=%s]' % taxonomy_id)
-            samples = np.loadtxt('./datasets/ModelNet40/modelnet40_%s.txt' % subset, dtype=str)
-            # samples = dc[subset]
 
-            for s in tqdm(samples, leave=False):
-                category_name = s.split('_')[0]
-                # if len(info) == 2:
-                #     category_name = info[0]
-                # else:
-                #     category_name = '_'.join(info[:-1])
+            for s in samples[taxonomy_id]:
                 if subset == 'test':
-                    if category_name in taxonomy_id:
-                        gt_path = cfg.DATASETS.MODELNET.COMPLETE_POINTS_PATH % (subset, taxonomy_id, s)
-                        file_list.append({'taxonomy_id': taxonomy_id,
-                        'partial_cloud_path': gt_path.replace('complete', 'partial'),
-                        'gtcloud_path': gt_path})
+                    gt_path = cfg.DATASETS.MODELNET.COMPLETE_POINTS_PATH % (subset, taxonomy_id, s)
+                    file_list.append({'taxonomy_id': taxonomy_id,
+                    'partial_cloud_path': gt_path.replace('complete', 'partial'),
+                    'gtcloud_path': gt_path})
                 else:
-                    if category_name in taxonomy_id:
-                        file_list.append({
-                            'taxonomy_id': taxonomy_id,
-                            'partial_cloud_path': [
-                                cfg.DATASETS.MODELNET.PARTIAL_POINTS_PATH % (subset, taxonomy_id, s, s, i)
-                                for i in range(n_renderings)
-                            ],
-                            'gtcloud_path':
-                                cfg.DATASETS.MODELNET.COMPLETE_POINTS_PATH % (subset, taxonomy_id, s),
-                        })
+                    file_list.append({
+                        'taxonomy_id': taxonomy_id,
+                        'partial_cloud_path': [
+                            cfg.DATASETS.MODELNET.PARTIAL_POINTS_PATH % (subset, taxonomy_id, s, s, i)
+                            for i in range(n_renderings)
+                        ],
+                        'gtcloud_path':
+                            cfg.DATASETS.MODELNET.COMPLETE_POINTS_PATH % (subset, taxonomy_id, s),
+                    })
 
         # print(f'_get_file_list file_list {len(file_list)}')
 
@@ -693,19 +830,28 @@ class ScanObjectNNDataLoader(object):
             # print(f'ModelNet40DataLoader: {f}')
             self.dataset_categories = np.loadtxt(f, dtype=str)
 
-    def get_dataset(self, subset):
+    def get_dataset(self, subset, n_views=1):
         # print(f'ShapeNetDataLoader: get_dataset')
         n_renderings = self.cfg.DATASETS.SCANOBNN.N_RENDERINGS if subset == DatasetSubset.TRAIN else 1
-        file_list = self._get_file_list(self.cfg, self._get_subset(subset), n_renderings)
+        file_list = get_file_list(self.cfg, self, self._get_subset(subset), n_renderings, self.cfg.DATASETS.SCANOBNN,
+                                  [self.cfg.DATASETS.SCANOBNN.CATEGORY_FILE_PATH,
+                                   './datasets/%s/scanobjectnn_%s.txt' % (self.cfg.DATASETS.SCANOBNN.TYPE,
+                                                                          self._get_subset(subset))])
         transforms = self._get_transforms(self.cfg, subset)
         return Dataset({
             'n_renderings': n_renderings,
             'required_items': ['partial_cloud', 'gtcloud'],
-            'shuffle': subset == DatasetSubset.TRAIN
+            'shuffle': subset == DatasetSubset.TRAIN,
+            'cache': get_sample_cache(self.cfg),
+            'cached_items': self.cfg.DATASETS.CACHE.ITEMS if 'CACHE' in self.cfg.DATASETS else [],
+            'label_mapping': label_mapping3,
+            'partial_sampler': get_partial_sampler(self.cfg),
+            'n_views': n_views
         }, file_list, transforms)
 
     def _get_transforms(self, cfg, subset):
-        if subset == DatasetSubset.TRAIN:
+        # Mirroring moves to get_batch_transforms when batched augmentation is on
+        if subset == DatasetSubset.TRAIN and not cfg.TRAIN.BATCH_AUGMENTATION:
             return utils.data_transforms.Compose([{
                 'callback': 'RescalePoints',
                 'parameters': {
@@ -743,34 +889,28 @@ class ScanObjectNNDataLoader(object):
         """Prepare file list for the dataset"""
         file_list = []
 
+        samples = group_by_taxonomy(
+            np.loadtxt('./datasets/%s/scanobjectnn_%s.txt' % (cfg.DATASETS.SCANOBNN.TYPE, subset), dtype=str),
+            list(self.dataset_categories))
         for taxonomy_id in self.dataset_categories:
             logging.info('Collecting files of Taxonomy [Name=%s]' % taxonomy_id)
-            samples = np.loadtxt('./datasets/%s/scanobjectnn_%s.txt' % (cfg.DATASETS.SCANOBNN.TYPE, subset), dtype=str)
-            # samples = dc[subset]
 
-            for s in tqdm(samples, leave=False):
-                category_name = s.split('_')[0]
-                # if len(info) == 2:
-                #     category_name = info[0]
-                # else:
-                #     category_name = '_'.join(info[:-1])
+            for s in samples[taxonomy_id]:
                 if subset == 'test':
-                    if category_name in taxonomy_id:
-                        gt_path = cfg.DATASETS.SCANOBNN.COMPLETE_POINTS_PATH % (subset, taxonomy_id, s)
-                        file_list.append({'taxonomy_id': taxonomy_id,
-                        'partial_cloud_path': gt_path.replace('complete', 'partial'),
-                        'gtcloud_path': gt_path})
+                    gt_path = cfg.DATASETS.SCANOBNN.COMPLETE_POINTS_PATH % (subset, taxonomy_id, s)
+                    file_list.append({'taxonomy_id': taxonomy_id,
+                    'partial_cloud_path': gt_path.replace('complete', 'partial'),
+                    'gtcloud_path': gt_path})
                 else:
-                    if category_name in taxonomy_id:
-                        file_list.append({
-                            'taxonomy_id': taxonomy_id,
-                            'partial_cloud_path': [
-                                cfg.DATASETS.SCANOBNN.PARTIAL_POINTS_PATH % (subset, taxonomy_id, s, s, i)
-                                for i in range(n_renderings)
-                            ],
-                            'gtcloud_path':
-                                cfg.DATASETS.SCANOBNN.COMPLETE_POINTS_PATH % (subset, taxonomy_id, s),
-                        })
+                    file_list.append({
+                        'taxonomy_id': taxonomy_id,
+                        'partial_cloud_path': [
+                            cfg.DATASETS.SCANOBNN.PARTIAL_POINTS_PATH % (subset, taxonomy_id, s, s, i)
+                            for i in range(n_renderings)
+                        ],
+                        'gtcloud_path':
+                            cfg.DATASETS.SCANOBNN.COMPLETE_POINTS_PATH % (subset, taxonomy_id, s),
+                    })
 
         # print(f'_get_file_list file_list {len(file_list)}')
 
@@ -790,37 +930,29 @@ class ShapeNetPartV0DataLoader(object):
     def get_dataset(self, subset):
         # print(f'ShapeNetDataLoader: get_dataset')
         n_renderings = self.cfg.DATASETS.SHAPENET.N_RENDERINGS if subset == DatasetSubset.TRAIN else 1
-        file_list = self._get_file_list(self.cfg, self._get_subset(subset), n_renderings)
+        file_list = get_file_list(self.cfg, self, self._get_subset(subset), n_renderings, self.cfg.DATASETS.SHAPENET,
+                                  [self.cfg.DATASETS.SHAPENET.SEGMENTATION_FILE_PATH])
         transforms = self._get_transforms(self.cfg, subset)
         return Datasetv0({
             'n_renderings': n_renderings,
             'required_items': ['partial_cloud', 'gtcloud'],
             'required_labels': ['gtlabel'],
-            'shuffle': subset == DatasetSubset.TRAIN
+            'shuffle': subset == DatasetSubset.TRAIN,
+            'cache': get_sample_cache(self.cfg),
+            'cached_items': self.cfg.DATASETS.CACHE.ITEMS if 'CACHE' in self.cfg.DATASETS else [],
+            'label_mapping': label_mapping_partv0,
+            'partial_sampler': get_partial_sampler(self.cfg),
+            'packed_labels': self.cfg.DATASETS.SHAPENET.PACKED_LABELS
         }, file_list, transforms)
 
     def _get_transforms(self, cfg, subset):
         if subset == DatasetSubset.TRAIN:
             return utils.data_transforms.Compose([{
-                'callback': 'RescaleSegPoints',
+                'callback': 'JointRescalePoints',
                 'parameters': {
                     'n_points': cfg.DATASETS.SHAPENET.N_POINTS
                 },
-                'objects': ['partial_cloud', 'gtcloud']
-            },
-            #     {
-            #     'callback': 'RescaleSegPoints',
-            #     'parameters': {
-            #         'n_points': cfg.DATASETS.SHAPENET.N_POINTS
-            #     },
-            #     'objects': ['gtcloud']
-            # },
-                {
-                'callback': 'RescaleSegLabels',
-                'parameters': {
-                    'n_points': cfg.DATASETS.SHAPENET.N_POINTS
-                },
-                'objects': ['gtlabel']
+                'objects': ['partial_cloud', 'gtcloud', 'gtlabel']
             }, {
                 'callback': 'RandomMirrorPoints',
                 'objects': ['partial_cloud', 'gtcloud']
@@ -830,17 +962,12 @@ class ShapeNetPartV0DataLoader(object):
             }])
         else:
             return utils.data_transforms.Compose([{
-                'callback': 'RescaleSegPoints',
+                'callback': 'JointRescalePoints',
                 'parameters': {
-                    'n_points': cfg.DATASETS.SHAPENET.N_POINTS
-                },
-                'objects': ['partial_cloud', 'gtcloud']
-            }, {
-                'callback': 'RescaleSegLabels',
-                'parameters': {
-                    'n_points': cfg.DATASETS.SHAPENET.N_POINTS
+                    'n_points': cfg.DATASETS.SHAPENET.N_POINTS,
+                    'deterministic': True
                 },
-                'objects': ['gtlabel']
+                'objects': ['partial_cloud', 'gtcloud', 'gtlabel']
             }, {
                 'callback': 'ToTensor',
                 'objects': ['partial_cloud', 'gtcloud', 'gtlabel']
@@ -862,14 +989,19 @@ class ShapeNetPartV0DataLoader(object):
             samples = dc[subset]
             for s in samples:
                 label_path = cfg.DATASETS.SHAPENET.COMPLETE_LABELS_PATH % (subset, dc['taxonomy_id'], s)
+                gt_path = cfg.DATASETS.SHAPENET.SEG_COMPLETE_POINTS_PATH % (subset, dc['taxonomy_id'], s)
+                if cfg.DATASETS.SHAPENET.PACKED_LABELS:
+                    # (N, 4) points with the part label as the last column, see preprocess.pack_seg_labels
+                    gtcloud_path = cfg.DATASETS.SHAPENET.SEG_PACKED_POINTS_PATH % (subset, dc['taxonomy_id'], s)
+                else:
+                    gtcloud_path = gt_path
                 if subset == 'test':
-                    gt_path = cfg.DATASETS.SHAPENET.SEG_COMPLETE_POINTS_PATH % (subset, dc['taxonomy_id'], s)
                     file_list.append({'taxonomy_id': dc['taxonomy_id'],
                     'model_id': s,
                     'taxonomy_name': dc['taxonomy_name'],
                     'gtlabel_path': label_path,
                     'partial_cloud_path': gt_path.replace('complete', 'partial'),
-                    'gtcloud_path': gt_path})
+                    'gtcloud_path': gtcloud_path})
                 else:
                     file_list.append({
                     'taxonomy_id':  dc['taxonomy_id'],
@@ -880,8 +1012,7 @@ class ShapeNetPartV0DataLoader(object):
                         cfg.DATASETS.SHAPENET.SEG_PARTIAL_POINTS_PATH % (subset, dc['taxonomy_id'], s, s, i)
                         for i in range(n_renderings)
                     ],
-                    'gtcloud_path':
-                        cfg.DATASETS.SHAPENET.SEG_COMPLETE_POINTS_PATH % (subset, dc['taxonomy_id'], s),
+                    'gtcloud_path': gtcloud_path,
                 })
 
         # print(f'_get_file_list file_list {len(file_list)}')
@@ -890,20 +1021,44 @@ class ShapeNetPartV0DataLoader(object):
         return file_list
 
 
-def load_data(partition):
+class ShardDataLoader(object):
+    """Streams samples of another dataset (cfg.DATASETS.SHARDS.SOURCE) from tar shards.
+
+    Write the shards once with utils.shards.write_dataset_shards(loader.get_dataset(subset),
+    cfg.DATASETS.SHARDS.DIR, '<source>-<subset>'); transforms and labels follow the source loader.
+    """
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.source = DATASET_LOADER_MAPPING[cfg.DATASETS.SHARDS.SOURCE](cfg)
+
+    def get_dataset(self, subset, n_views=1):
+        if n_views > 1:
+            raise NotImplementedError('Shards stream one view per sample; set TRAIN.N_VIEWS = 1')
+        subset_name = self.source._get_subset(subset)
+        return ShardDataset(self.cfg.DATASETS.SHARDS.DIR, '%s-%s' % (self.cfg.DATASETS.SHARDS.SOURCE, subset_name), {
+            'shuffle': subset == DatasetSubset.TRAIN,
+            'shuffle_buffer': self.cfg.DATASETS.SHARDS.SHUFFLE_BUFFER,
+            'read_ahead': self.cfg.DATASETS.SHARDS.READ_AHEAD,
+            'seed': self.cfg.DATASETS.SHARDS.SEED
+        }, self.source._get_transforms(self.cfg, subset))
+
+
+def load_data(partition, lazy=False, read_ahead=0):
     # download()
+    h5_names = glob.glob(os.path.join('datasets', 'modelnet40_ply_hdf5_2048', 'ply_data_%s*.h5'%partition))
     all_data = []
     all_label = []
-    for h5_name in glob.glob(os.path.join('datasets', 'modelnet40_ply_hdf5_2048', 'ply_data_%s*.h5'%partition)):
+    for h5_name in h5_names:
         # print(f"h5_name: {h5_name}")
-        f = h5py.File(h5_name,'r')
-        data = f['data'][:].astype('float32')
-        label = f['label'][:].astype('int64')
-        f.close()
-        all_data.append(data)
-        all_label.append(label)
-    all_data = np.concatenate(all_data, axis=0)
+        with h5py.File(h5_name, 'r') as f:
+            if not lazy:
+                all_data.append(f['data'][:].astype('float32'))
+            all_label.append(f['label'][:].astype('int64'))
     all_label = np.concatenate(all_label, axis=0)
+    if lazy:
+        # Points are read per item in each worker; labels are small enough to keep
+        return LazyH5Array(h5_names, 'data', np.float32, read_ahead), all_label
+    all_data = np.concatenate(all_data, axis=0)
     return all_data, all_label
 
 
@@ -916,8 +1071,8 @@ def translate_pointcloud(pointcloud):
 
 
 class ModelNet40H5(Dataset):
-    def __init__(self, num_points, partition='train'):
-        self.data, self.label = load_data(partition)
+    def __init__(self, num_points, partition='train', lazy=True, read_ahead=0):
+        self.data, self.label = load_data(partition, lazy, read_ahead)
         self.num_points = num_points
         self.partition = partition
 
@@ -934,15 +1089,17 @@ class ModelNet40H5(Dataset):
         return self.data.shape[0]
 
 
-def load_h5(h5_filename):
-    f = h5py.File(h5_filename)
-    data = f['data'][:].astype('float32')
-    label = f['label'][:].astype('float32')
+def load_h5(h5_filename, lazy=False, read_ahead=0):
+    with h5py.File(h5_filename, 'r') as f:
+        data = None if lazy else f['data'][:].astype('float32')
+        label = f['label'][:].astype('float32')
+    if lazy:
+        data = LazyH5Array([h5_filename], 'data', np.float32, read_ahead)
     return data, label
 
 class UniData(Dataset):
-    def __init__(self, dataset='', partition='train'):
-        self.data, self.label = load_h5('./datasets/unidata/uni_%s%s.h5' % (partition, dataset))
+    def __init__(self, dataset='', partition='train', lazy=True, read_ahead=0):
+        self.data, self.label = load_h5('./datasets/unidata/uni_%s%s.h5' % (partition, dataset), lazy, read_ahead)
         self.partition = partition
 
     def __getitem__(self, item):
@@ -958,6 +1115,23 @@ class UniData(Dataset):
         return self.data.shape[0]
 
 
+def get_batch_transforms(cfg, subset):
+    """Augmentation applied to the collated batch on the training device"""
+    if subset != DatasetSubset.TRAIN or not cfg.TRAIN.BATCH_AUGMENTATION:
+        return None
+    return utils.data_transforms.BatchCompose([{
+        'callback': 'BatchRandomMirrorPoints',
+        'objects': ['partial_cloud', 'gtcloud']
+    }])
+
+
+def expand_views(data, n_views):
+    """Repeat the per-object items of a multi-view batch so every partial view has its own row"""
+    if n_views == 1:
+        return data
+    return {k: v if k == 'partial_cloud' else v.repeat_interleave(n_views, 0) for k, v in data.items()}
+
+
 def to_categorical(y, num_classes):
     """ 1-hot encodes a tensor """
     new_y = torch.eye(num_classes)[y.cpu().data.numpy(),]
@@ -977,5 +1151,6 @@ DATASET_LOADER_MAPPING = {
     'ModelNet10': ModelNet10DataLoader,
     'ScanObjectNN': ScanObjectNNDataLoader,
     'ShapeNetPart': ShapeNetPartV0DataLoader,
+    'Shards': ShardDataLoader,
 }  # yapf: disable
 
@@ -23,14 +23,20 @@ class Compose(object):
                 'objects': tr['objects']
             })  # yapf: disable
 
-    def __call__(self, data): # data: dict type
+    def draw(self):
+        """One rnd_value per transform; pass to __call__ to augment several dicts identically"""
+        return np.random.uniform(0, 1, len(self.transformers))
+
+    def __call__(self, data, rnd_values=None): # data: dict type
         # print(3)
-        for tr in self.transformers:
+        for i, tr in enumerate(self.transformers):
             transform = tr['callback']
             objects = tr['objects']
-            rnd_value = np.random.uniform(0, 1)
+            rnd_value = np.random.uniform(0, 1) if rnd_values is None else rnd_values[i]
             if transform.__class__ in [NormalizeObjectPose]:
                 data = transform(data)
+            elif transform.__class__ in [JointRescalePoints]:
+                data = transform(data, objects)
             else:
                 for k, v in data.items(): #
                     if k in objects and k in data:
@@ -250,6 +256,46 @@ class RescalePointsAndLabels(object):
         return ptcloud, label
 
 
+def rescale_indices(curr, n_points, rng=np.random):
+    """Index form of RescalePoints: `x[rescale_indices(len(x), n)]` has n rows"""
+    need = n_points - curr
+    if need < 0:
+        return rng.permutation(n_points)
+
+    indices = np.arange(curr)
+    while curr <= need:
+        indices = np.tile(indices, 2)
+        need -= curr
+        curr *= 2
+
+    return np.concatenate((indices, indices[rng.permutation(need)]))
+
+
+class JointRescalePoints(object):
+    """Rescales all `objects` of a sample with shared index arrays, one per distinct length.
+
+    Points and their per-point labels (e.g. gtcloud and gtlabel) have the same length, so they are
+    resampled with the same indices and stay aligned. With `deterministic`, each length uses its own
+    RandomState(length), reproducing RescaleSegPoints/RescaleSegLabels without reseeding the global RNG.
+    """
+    def __init__(self, parameters):
+        self.n_points = parameters['n_points']
+        self.deterministic = parameters.get('deterministic', False)
+
+    def __call__(self, data, objects):
+        indices = {}
+        for k in objects:
+            if k not in data:
+                continue
+            curr = data[k].shape[0]
+            if curr not in indices:
+                rng = np.random.RandomState(curr) if self.deterministic else np.random
+                indices[curr] = rescale_indices(curr, self.n_points, rng)
+            data[k] = data[k][indices[curr]]
+
+        return data
+
+
 class RandomSamplePoints(object):
     def __init__(self, parameters):
         self.n_points = parameters['n_points']
@@ -348,3 +394,101 @@ class NormalizeObjectPose(object):
 
         data[self.ptcloud_key] = ptcloud
         return data
+
+
+class BatchCompose(object):
+    """Compose for collated (B, N, C) tensors; each transform draws one random value per sample,
+    shared by all objects of that sample (same contract as Compose's rnd_value)"""
+    def __init__(self, transforms):
+        self.transformers = []
+        for tr in transforms:
+            transformer = eval(tr['callback'])
+            parameters = tr['parameters'] if 'parameters' in tr else None
+            self.transformers.append({
+                'callback': transformer(parameters),
+                'objects': tr['objects']
+            })  # yapf: disable
+
+    def __call__(self, data):
+        batch_size = next(iter(data.values())).size(0)
+        for tr in self.transformers:
+            transform = tr['callback']
+            device = next(iter(data.values())).device
+            rnd_value = torch.rand(batch_size, device=device)
+            for k in tr['objects']:
+                if k in data:
+                    data[k] = transform(data[k], rnd_value)
+
+        return data
+
+
+class BatchRescalePoints(object):
+    def __init__(self, parameters):
+        self.n_points = parameters['n_points']
+
+    def __call__(self, ptcloud, rnd_value):
+        b, n, c = ptcloud.shape
+        choice = torch.argsort(torch.rand(b, n, device=ptcloud.device), dim=1)
+        if self.n_points <= n:
+            choice = choice[:, :self.n_points]
+        else:
+            extra = torch.randint(n, (b, self.n_points - n), device=ptcloud.device)
+            choice = torch.cat([choice, extra], dim=1)
+        return torch.gather(ptcloud, 1, choice.unsqueeze(-1).expand(-1, -1, c))
+
+
+class BatchRandomClipPoints(object):
+    def __init__(self, parameters):
+        parameters = parameters or {}
+        self.sigma = parameters['sigma'] if 'sigma' in parameters else 0.01
+        self.clip = parameters['clip'] if 'clip' in parameters else 0.05
+
+    def __call__(self, ptcloud, rnd_value):
+        noise = torch.clamp(self.sigma * torch.randn_like(ptcloud[..., :3]), -self.clip, self.clip)
+        return torch.cat([ptcloud[..., :3] + noise, ptcloud[..., 3:]], dim=-1)
+
+
+class BatchRandomRotatePoints(object):
+    def __init__(self, parameters):
+        pass
+
+    def __call__(self, ptcloud, rnd_value):
+        # Rotation around the y axis, as transforms3d.axangles.axangle2mat([0, 1, 0], angle)
+        angle = 2 * math.pi * rnd_value
+        cos, sin = torch.cos(angle), torch.sin(angle)
+        zeros, ones = torch.zeros_like(angle), torch.ones_like(angle)
+        trfm_mat = torch.stack([
+            torch.stack([cos, zeros, sin], -1),
+            torch.stack([zeros, ones, zeros], -1),
+            torch.stack([-sin, zeros, cos], -1)
+        ], 1).to(ptcloud.dtype)  # B, 3, 3
+        xyz = torch.bmm(ptcloud[..., :3], trfm_mat.transpose(1, 2))
+        return torch.cat([xyz, ptcloud[..., 3:]], dim=-1)
+
+
+class BatchScalePoints(object):
+    def __init__(self, parameters):
+        self.scale = None
+        if parameters is not None and 'scale' in parameters:
+            self.scale = parameters['scale']
+
+    def __call__(self, ptcloud, rnd_value):
+        if self.scale is not None:
+            return ptcloud * self.scale
+        # Same range as ScalePoints: randint(85, 95) * 0.01
+        scale = (85 + torch.floor(rnd_value * 10)) * 0.01
+        return ptcloud * scale.to(ptcloud.dtype).view(-1, 1, 1)
+
+
+class BatchRandomMirrorPoints(object):
+    def __init__(self, parameters):
+        pass
+
+    def __call__(self, ptcloud, rnd_value):
+        # Same partition of rnd_value as RandomMirrorPoints: xz, x, z, none
+        flip_x = rnd_value <= 0.5
+        flip_z = (rnd_value <= 0.25) | ((rnd_value > 0.5) & (rnd_value <= 0.75))
+        sign = torch.ones(ptcloud.size(0), 3, dtype=ptcloud.dtype, device=ptcloud.device)
+        sign[flip_x, 0] = -1
+        sign[flip_z, 2] = -1
+        return torch.cat([ptcloud[..., :3] * sign.unsqueeze(1), ptcloud[..., 3:]], dim=-1)
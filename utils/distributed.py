@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+# Multi-process (DistributedDataParallel) training helpers; every function also works in a single process.
+# Launch with: torchrun --nproc_per_node=<n> main25_ddp.py   (or scripts/dist_train.sh <n> <port>)
+
+import logging
+import os
+import torch
+import torch.distributed as dist
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def get_local_rank():
+    return int(os.environ.get('LOCAL_RANK', 0))
+
+
+def get_local_world_size():
+    return int(os.environ.get('LOCAL_WORLD_SIZE', get_world_size()))
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def init_distributed(backend=None):
+    """Joins the process group described by the launcher's environment (RANK, WORLD_SIZE, MASTER_ADDR, ...).
+
+    `backend` defaults to nccl with CUDA and gloo without, so the same entry point also runs multi-process
+    on CPU-only hosts. Each process is bound to the GPU of its LOCAL_RANK.
+    """
+    if 'RANK' not in os.environ or 'WORLD_SIZE' not in os.environ:
+        raise Exception('RANK and WORLD_SIZE are not set; launch with torchrun or torch.distributed.launch')
+    if not backend:
+        backend = 'nccl' if torch.cuda.is_available() else 'gloo'
+    if backend == 'nccl' and not torch.cuda.is_available():
+        raise Exception('The nccl backend needs CUDA; use gloo on CPU-only hosts')
+    if torch.cuda.is_available():
+        torch.cuda.set_device(get_local_rank())
+    dist.init_process_group(backend=backend)
+    logging.info('Joined process group: rank %d/%d, backend %s' % (get_rank(), get_world_size(), backend))
+
+
+def cleanup():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def broadcast_object(obj, src=0):
+    """The value of `obj` on rank `src`, e.g. one output directory name for all ranks"""
+    if not is_distributed():
+        return obj
+    objects = [obj]
+    dist.broadcast_object_list(objects, src=src)
+    return objects[0]
+
+
+def all_gather_object(obj):
+    """[obj of rank 0, obj of rank 1, ...] on every rank"""
+    if not is_distributed():
+        return [obj]
+    objects = [None] * get_world_size()
+    dist.all_gather_object(objects, obj)
+    return objects
+
+
+def all_reduce_mean(values):
+    """Averages a list of floats over all ranks, in one collective"""
+    if not is_distributed():
+        return values
+    device = torch.device('cuda', get_local_rank()) if dist.get_backend() == 'nccl' else torch.device('cpu')
+    buf = torch.tensor(values, dtype=torch.float64, device=device)
+    dist.all_reduce(buf)
+    return (buf / get_world_size()).tolist()
+
+
+def wrap_model(model, sync_bn=False):
+    """DistributedDataParallel when running distributed, DataParallel on GPUs otherwise (as before).
+
+    Both expose the network as `model.module`. BatchNorm layers are converted to SyncBatchNorm when
+    `sync_bn` is set; SyncBatchNorm needs CUDA, so it is skipped with a warning on CPU-only hosts.
+    """
+    if not is_distributed():
+        if torch.cuda.is_available():
+            model = torch.nn.DataParallel(model).cuda()
+        return model
+
+    if sync_bn:
+        if torch.cuda.is_available():
+            model = torch.nn.SyncBatchNorm.convert_sync_batchnorm(model)
+        else:
+            logging.warning('SyncBatchNorm needs CUDA; keeping per-process BatchNorm')
+    if torch.cuda.is_available():
+        local_rank = get_local_rank()
+        return torch.nn.parallel.DistributedDataParallel(model.cuda(local_rank), device_ids=[local_rank],
+                                                         output_device=local_rank)
+    return torch.nn.parallel.DistributedDataParallel(model)
+
+
+def eval_model(model):
+    """A view of a wrapped model for evaluation on a single rank.
+
+    Forward passes of DistributedDataParallel take part in collectives (buffer broadcast), which would hang
+    while the other ranks wait, so rank 0 evaluates the shared network through a plain DataParallel.
+    """
+    if not isinstance(model, torch.nn.parallel.DistributedDataParallel):
+        return model
+    if torch.cuda.is_available():
+        return torch.nn.DataParallel(model.module, device_ids=[get_local_rank()])
+    return torch.nn.DataParallel(model.module)
+
+
+class _NullWriter(object):
+    """Stands in for SummaryWriter on ranks other than 0"""
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+def summary_writer(log_dir):
+    if not is_main_process():
+        return _NullWriter()
+    from torch.utils.tensorboard import SummaryWriter
+    return SummaryWriter(log_dir)
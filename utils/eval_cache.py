@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+# Evaluation sets transformed once and replayed every epoch, in memory or as memmapped .npy files.
+
+import hashlib
+import json
+import logging
+import math
+import os
+import random
+import numpy as np
+import torch
+import torch.utils.data
+import utils.data_transforms
+
+from utils.data_loaders import BatchCollator
+
+
+def _seed_worker(worker_id):
+    # torch derives each worker's seed from the loader's generator; numpy and random follow it
+    seed = torch.initial_seed() % 2 ** 32
+    np.random.seed(seed)
+    random.seed(seed)
+
+
+def _transforms_tag(dataset):
+    """The dataset's transforms with their parameters, and the source of utils.data_transforms"""
+    with open(utils.data_transforms.__file__, 'rb') as f:
+        tag = [hashlib.sha1(f.read()).hexdigest()]
+    transforms = getattr(dataset, 'transforms', None)
+    for tr in getattr(transforms, 'transformers', []):
+        tag.append([type(tr['callback']).__name__, vars(tr['callback']), tr['objects']])
+    return tag
+
+
+def _sources_digest(dataset):
+    """Digest of the paths, mtimes and sizes of the files the samples are read from"""
+    digest = hashlib.sha1()
+    for sample in getattr(dataset, 'file_list', []):
+        for k, v in sorted(sample.items()):
+            if not k.endswith('_path'):
+                continue
+            for path in (v if isinstance(v, list) else [v]):
+                # Remote storage keys are only identified by name
+                st = os.stat(path) if os.path.exists(path) else None
+                digest.update(('%s:%s:%s\n' % (path, st and st.st_mtime_ns, st and st.st_size)).encode())
+    return digest.hexdigest()
+
+
+def eval_cache_dir(cfg, dataset_name, subset, dataset=None):
+    """Directory of the memmapped cache for one evaluation set, or None to keep it in memory.
+
+    The key covers the dataset config, the seed and, given `dataset`, its transforms (and the code defining
+    them) and the mtimes/sizes of its source files, so edited transforms or regenerated files are re-cached.
+    """
+    if not cfg.TEST.EVAL_CACHE.DIR:
+        return None
+    dataset_cfg = {k: v for k, v in cfg.DATASETS.items() if k not in ('CACHE', 'MANIFEST', 'SHARDS')}
+    key = [dataset_name, str(subset), dataset_cfg, cfg.TEST.EVAL_CACHE.SEED]
+    if dataset is not None:
+        key += [_transforms_tag(dataset), _sources_digest(dataset)]
+    blob = json.dumps(key, sort_keys=True, default=str)
+    return os.path.join(cfg.TEST.EVAL_CACHE.DIR, '%s-%s' % (dataset_name, hashlib.sha1(blob.encode()).hexdigest()[:16]))
+
+
+class EvalCache(object):
+    """A fully transformed evaluation set, iterated like a DataLoader over BatchCollator batches.
+
+    Random choices in the dataset (rendering, resampling, augmentation) are drawn once from `seed`
+    while building, so every epoch and every run with the same cache sees identical inputs. The global
+    numpy/random/torch states are restored afterwards, so building does not change the training run.
+    """
+    def __init__(self, taxonomy_ids, model_ids, data, labels, batch_size):
+        self.taxonomy_ids = taxonomy_ids
+        self.model_ids = model_ids
+        self.data = data
+        self.labels = labels
+        self.batch_size = batch_size
+
+    @classmethod
+    def build(cls, dataset, batch_size, num_workers=0, seed=0, cache_dir=None):
+        if cache_dir is not None and os.path.exists(os.path.join(cache_dir, 'meta.json')):
+            return cls.load(cache_dir, batch_size)
+
+        # torch.manual_seed reseeds every CUDA device too, so their states are restored as well
+        states = np.random.get_state(), random.getstate(), torch.get_rng_state()
+        cuda_states = torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None
+        try:
+            np.random.seed(seed)
+            random.seed(seed)
+            torch.manual_seed(seed)
+            return cls._build(dataset, batch_size, num_workers, seed, cache_dir)
+        finally:
+            np.random.set_state(states[0])
+            random.setstate(states[1])
+            torch.set_rng_state(states[2])
+            if cuda_states is not None:
+                torch.cuda.set_rng_state_all(cuda_states)
+
+    @classmethod
+    def _build(cls, dataset, batch_size, num_workers, seed, cache_dir):
+        generator = torch.Generator()
+        generator.manual_seed(seed)
+        loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, num_workers=num_workers,
+                                             collate_fn=BatchCollator(), shuffle=False, drop_last=False,
+                                             worker_init_fn=_seed_worker, generator=generator)
+        if cache_dir is not None and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+        n_samples, start = len(dataset), 0
+        taxonomy_ids, model_ids, arrays = [], [], {}
+        labels = np.empty((n_samples, ), dtype=np.int64)
+        for batch_taxonomy_ids, batch_model_ids, data, batch_labels in loader:
+            end = start + len(batch_labels)
+            for k, v in data.items():
+                if k not in arrays:
+                    shape, dtype = (n_samples, ) + tuple(v.shape[1:]), v.numpy().dtype
+                    if cache_dir is None:
+                        arrays[k] = np.empty(shape, dtype=dtype)
+                    else:
+                        arrays[k] = np.lib.format.open_memmap(os.path.join(cache_dir, '%s.npy' % k), 'w+', dtype,
+                                                              shape)
+                arrays[k][start:end] = v.numpy()
+            labels[start:end] = batch_labels.numpy()
+            taxonomy_ids.extend(batch_taxonomy_ids)
+            model_ids.extend(batch_model_ids)
+            start = end
+
+        if cache_dir is None:
+            logging.info('Cached %d evaluation samples in memory' % n_samples)
+            return cls(taxonomy_ids, model_ids, arrays, labels, batch_size)
+
+        for array in arrays.values():
+            array.flush()
+        np.save(os.path.join(cache_dir, 'labels.npy'), labels)
+        # Written last: a cache directory without meta.json is incomplete and gets rebuilt
+        with open(os.path.join(cache_dir, 'meta.json.tmp'), 'w') as f:
+            json.dump({'taxonomy_ids': taxonomy_ids, 'model_ids': model_ids, 'items': list(arrays.keys())}, f)
+        os.replace(os.path.join(cache_dir, 'meta.json.tmp'), os.path.join(cache_dir, 'meta.json'))
+        logging.info('Cached %d evaluation samples in %s' % (n_samples, cache_dir))
+        return cls.load(cache_dir, batch_size)
+
+    @classmethod
+    def load(cls, cache_dir, batch_size):
+        with open(os.path.join(cache_dir, 'meta.json')) as f:
+            meta = json.load(f)
+        data = {k: np.load(os.path.join(cache_dir, '%s.npy' % k), mmap_mode='r') for k in meta['items']}
+        labels = np.load(os.path.join(cache_dir, 'labels.npy'))
+        return cls(meta['taxonomy_ids'], meta['model_ids'], data, labels, batch_size)
+
+    def __len__(self):
+        return math.ceil(len(self.labels) / self.batch_size)
+
+    def __iter__(self):
+        for start in range(0, len(self.labels), self.batch_size):
+            end = min(start + self.batch_size, len(self.labels))
+            data = {}
+            for k, v in self.data.items():
+                v = v[start:end]
+                # Memmapped slices are read-only; in-memory slices are handed out without a copy
+                data[k] = torch.from_numpy(v if v.flags.writeable else np.array(v))
+            yield self.taxonomy_ids[start:end], self.model_ids[start:end], data, torch.from_numpy(self.labels[start:end])
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+# Lazy row access to HDF5 datasets, so DataLoader workers do not each hold a full copy in RAM.
+
+import os
+import h5py
+import numpy as np
+
+
+class LazyH5Array(object):
+    """Rows of the dataset `key` concatenated over `file_paths`, read on demand.
+
+    Files are opened on first access in each process (after the DataLoader has forked or spawned its
+    workers) and reads are aligned to the dataset's chunk rows. With `read_ahead` > 0, each read also
+    fetches that many following chunks, which helps sequential (non-shuffled) iteration. Only the
+    current block is kept, so memory does not grow with dataset size or worker count.
+    """
+    def __init__(self, file_paths, key, dtype=None, read_ahead=0):
+        self.file_paths = list(file_paths)
+        self.key = key
+        self.dtype = dtype
+        self.read_ahead = read_ahead
+
+        lengths, self.block_rows = [], []
+        row_shape = None
+        for file_path in self.file_paths:
+            with h5py.File(file_path, 'r') as f:
+                dataset = f[key]
+                lengths.append(dataset.shape[0])
+                row_shape = dataset.shape[1:]
+                chunk_rows = dataset.chunks[0] if dataset.chunks is not None else 1
+                self.block_rows.append(chunk_rows * (1 + read_ahead))
+        self.offsets = np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+        self.shape = (int(self.offsets[-1]), ) + tuple(row_shape or ())
+        self._pid = None
+        self._files = None
+        self._block = None
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_pid'] = state['_files'] = state['_block'] = None
+        return state
+
+    def _datasets(self):
+        if self._pid != os.getpid():
+            # Handles inherited through fork are not safe to use; open private ones
+            self._files = [h5py.File(file_path, 'r') for file_path in self.file_paths]
+            self._pid = os.getpid()
+            self._block = None
+        return [f[self.key] for f in self._files]
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError('index %d is out of range for %d rows' % (idx, len(self)))
+        file_idx = int(np.searchsorted(self.offsets, idx, side='right')) - 1
+        row = idx - int(self.offsets[file_idx])
+
+        if self._block is not None and self._pid == os.getpid():
+            block_file, block_start, block = self._block
+            if block_file == file_idx and block_start <= row < block_start + len(block):
+                return block[row - block_start]
+
+        dataset = self._datasets()[file_idx]
+        block_rows = self.block_rows[file_idx]
+        block_start = row // block_rows * block_rows
+        block = dataset[block_start:min(block_start + block_rows, dataset.shape[0])]
+        if self.dtype is not None:
+            block = block.astype(self.dtype)
+        self._block = (file_idx, block_start, block)
+        return block[row - block_start]
+
+    def close(self):
+        if self._files is not None and self._pid == os.getpid():
+            for f in self._files:
+                f.close()
+        self._files = self._pid = self._block = None
@@ -10,23 +10,25 @@ import h5py
 import numpy as np
 import open3d
 import os
-import sys
 
 from io import BytesIO
 
-# References: http://confluence.sensetime.com/pages/viewpage.action?pageId=44650315
 from config_pcn import cfg
-sys.path.append(cfg.MEMCACHED.LIBRARY_PATH)
-
-mc_client = None
-if cfg.MEMCACHED.ENABLED:
-    import mc
-    mc_client = mc.MemcachedClient.GetInstance(cfg.MEMCACHED.SERVER_CONFIG, cfg.MEMCACHED.CLIENT_CONFIG)
+from utils.storage import get_backend
+from utils.point_codec import encode_points, decode_points
 
 
 class IO:
+    # Decoded from bytes by get_many on local files too; HDF5 files are opened by path so that only the
+    # datasets read are loaded
+    _BATCHED_EXTENSIONS = ['.png', '.jpg', '.npy', '.pcd', '.txt', '.qpc']
+
     @classmethod
     def get(cls, file_path):
+        backend = get_backend(cfg)
+        if not backend.is_local:
+            return cls.decode(file_path, backend.get(file_path))
+
         _, file_extension = os.path.splitext(file_path)
 
         if file_extension in ['.png', '.jpg']:
@@ -41,6 +43,46 @@ class IO:
             return cls._read_h5(file_path)
         elif file_extension in ['.txt', 'seg']:
             return cls._read_txt(file_path)
+        elif file_extension in ['.qpc']:
+            return cls._read_qpc(file_path)
+        else:
+            raise Exception('Unsupported file extension: %s' % file_extension)
+
+    @classmethod
+    def get_many(cls, file_paths):
+        """All files of a sample or batch; remote backends answer them in one request, local files are
+        read by the backend's threads"""
+        backend = get_backend(cfg)
+        if not backend.is_local:
+            return [cls.decode(p, buf) for p, buf in zip(file_paths, backend.get_many(file_paths))]
+
+        values = [None] * len(file_paths)
+        batched = [i for i, p in enumerate(file_paths) if os.path.splitext(p)[1] in cls._BATCHED_EXTENSIONS]
+        for i, buf in zip(batched, backend.get_many([file_paths[i] for i in batched])):
+            values[i] = cls.decode(file_paths[i], buf)
+        for i, file_path in enumerate(file_paths):
+            if values[i] is None:
+                values[i] = cls.get(file_path)
+        return values
+
+    @classmethod
+    def decode(cls, file_path, buf):
+        """Same result as get(file_path), from the file's bytes"""
+        _, file_extension = os.path.splitext(file_path)
+
+        if file_extension in ['.png', '.jpg']:
+            return cv2.imdecode(np.frombuffer(buf, np.uint8), cv2.IMREAD_UNCHANGED) / 255.
+        elif file_extension in ['.npy']:
+            return np.load(BytesIO(buf))
+        elif file_extension in ['.pcd']:
+            return cls._decode_pcd(buf)
+        elif file_extension in ['.h5']:
+            with h5py.File(BytesIO(buf), 'r') as f:
+                return f['data'][()]
+        elif file_extension in ['.txt', 'seg']:
+            return np.loadtxt(BytesIO(buf))
+        elif file_extension in ['.qpc']:
+            return decode_points(buf)
         else:
             raise Exception('Unsupported file extension: %s' % file_extension)
 
@@ -52,78 +94,74 @@ class IO:
             return cls._write_pcd(file_path, file_content)
         elif file_extension in ['.h5']:
             return cls._write_h5(file_path, file_content)
+        elif file_extension in ['.qpc']:
+            return cls._write_qpc(file_path, file_content)
         else:
             raise Exception('Unsupported file extension: %s' % file_extension)
 
     @classmethod
     def _read_img(cls, file_path):
-        if mc_client is None:
-            return cv2.imread(file_path, cv2.IMREAD_UNCHANGED) / 255.
-        else:
-            pyvector = mc.pyvector()
-            mc_client.Get(file_path, pyvector)
-            buf = mc.ConvertBuffer(pyvector)
-            img_array = np.frombuffer(buf, np.uint8)
-            img = cv2.imdecode(img_array, cv2.IMREAD_UNCHANGED)
-            return img / 255.
-
-    # References: https://github.com/numpy/numpy/blob/master/numpy/lib/format.py
+        return cv2.imread(file_path, cv2.IMREAD_UNCHANGED) / 255.
+
     @classmethod
     def _read_npy(cls, file_path):
-        if mc_client is None:
-            return np.load(file_path)
-        else:
-            pyvector = mc.pyvector()
-            mc_client.Get(file_path, pyvector)
-            buf = mc.ConvertBuffer(pyvector)
-            buf_bytes = buf.tobytes()
-            if not buf_bytes[:6] == b'\x93NUMPY':
-                raise Exception('Invalid npy file format.')
-
-            header_size = int.from_bytes(buf_bytes[8:10], byteorder='little')
-            header = eval(buf_bytes[10:header_size + 10])
-            dtype = np.dtype(header['descr'])
-            nd_array = np.frombuffer(buf[header_size + 10:], dtype).reshape(header['shape'])
-
-            return nd_array
+        return np.load(file_path)
 
     # @classmethod
     # def _read_exr(cls, file_path):
         # return 1.0 / pyexr.open(file_path).get("Depth.Z").astype(np.float32)
 
-    # References: https://github.com/dimatura/pypcd/blob/master/pypcd/pypcd.py#L275
-    # Support PCD files without compression ONLY!
     @classmethod
     def _read_pcd(cls, file_path):
-        if mc_client is None:
-            pc = open3d.io.read_point_cloud(file_path)
-            ptcloud = np.array(pc.points)
-        else:
-            pyvector = mc.pyvector()
-            mc_client.Get(file_path, pyvector)
-            text = mc.ConvertString(pyvector).split('\n')
-            start_line_idx = len(text) - 1
-            for idx, line in enumerate(text):
-                if line == 'DATA ascii':
-                    start_line_idx = idx + 1
-                    break
-
-            ptcloud = text[start_line_idx:]
-            ptcloud = np.genfromtxt(BytesIO('\n'.join(ptcloud).encode()), dtype=np.float32)
+        pc = open3d.io.read_point_cloud(file_path)
+        ptcloud = np.array(pc.points)
 
         # ptcloud = np.concatenate((ptcloud, np.array([[0, 0, 0]])), axis=0)
         return ptcloud
 
+    # References: https://github.com/dimatura/pypcd/blob/master/pypcd/pypcd.py#L275
+    # Support PCD files without compression ONLY!
+    @classmethod
+    def _decode_pcd(cls, buf):
+        header, pos = {}, 0
+        while 'DATA' not in header:
+            end = buf.index(b'\n', pos)
+            line = buf[pos:end].decode('ascii').strip()
+            pos = end + 1
+            if line and not line.startswith('#'):
+                key, _, value = line.partition(' ')
+                header[key] = value.split()
+
+        fields = header['FIELDS']
+        counts = [int(c) for c in header.get('COUNT', ['1'] * len(fields))]
+        n_points = int(header['POINTS'][0])
+        if header['DATA'][0] == 'ascii':
+            values = np.array(buf[pos:].decode('ascii').split(), dtype=np.float32).reshape(n_points, -1)
+            columns = np.cumsum([0] + counts[:-1])
+            return values[:, [columns[fields.index(f)] for f in ('x', 'y', 'z')]]
+        elif header['DATA'][0] == 'binary':
+            dtype = np.dtype([(f, '<%s%s' % (t.lower(), s), (c, ) if c > 1 else ())
+                              for f, t, s, c in zip(fields, header['TYPE'], header['SIZE'], counts)])
+            values = np.frombuffer(buf, dtype, count=n_points, offset=pos)
+            return np.stack([values['x'], values['y'], values['z']], 1).astype(np.float32)
+        else:
+            raise Exception('Unsupported PCD data format: %s' % header['DATA'][0])
+
     @classmethod
     def _read_h5(cls, file_path):
-        f = h5py.File(file_path, 'r')
-        # Avoid overflow while gridding
-        return f['data'][()]
+        with h5py.File(file_path, 'r') as f:
+            # Avoid overflow while gridding
+            return f['data'][()]
 
     @classmethod
     def _read_txt(cls, file_path):
         return np.loadtxt(file_path)
 
+    @classmethod
+    def _read_qpc(cls, file_path):
+        with open(file_path, 'rb') as f:
+            return decode_points(f.read())
+
     @classmethod
     def _write_pcd(cls, file_path, file_content):
         pc = open3d.geometry.PointCloud()
@@ -134,3 +172,8 @@ class IO:
     def _write_h5(cls, file_path, file_content):
         with h5py.File(file_path, 'w') as f:
             f.create_dataset('data', data=file_content)
+
+    @classmethod
+    def _write_qpc(cls, file_path, file_content):
+        with open(file_path, 'wb') as f:
+            f.write(encode_points(file_content, cfg.STORAGE.QPC_BITS, cfg.STORAGE.QPC_ZSTD))
@@ -3,6 +3,7 @@ import collections
 from Chamfer3D.dist_chamfer_3D import chamfer_3DDist
 from models.utils import fps_subsample
 chamfer_dist = chamfer_3DDist()
+mse_loss = torch.nn.MSELoss()
 
 
 def chamfer(p1, p2):
@@ -29,6 +30,57 @@ def chamfer_single_side_sqrt(pcd1, pcd2):
     return d1, idx1, idx2
 
 
+def _cross_entropy_heads(logits, labels):
+    """Log-probabilities (H, B, C) of the stacked logits and the CrossEntropyLoss() (H, ) of each head"""
+    if isinstance(logits, (list, tuple)):
+        logits = torch.stack(logits)
+    n_heads = logits.shape[0]
+    log_probs = torch.nn.functional.log_softmax(logits, dim=-1)
+    ce = -log_probs.gather(-1, labels.view(1, -1, 1).expand(n_heads, -1, 1)).squeeze(-1).mean(-1)
+    return log_probs, ce
+
+
+def _kl_to_teacher(log_probs, teacher_idx):
+    """KLDivLoss(reduction='batchmean', log_target=True)(student, teacher) (H - 1, ) of each head but the teacher"""
+    n_heads, batch_size = log_probs.shape[:2]
+    if torch.is_tensor(teacher_idx):
+        teacher_idx = teacher_idx.to(log_probs.device).long().view(1) % n_heads
+        students_idx = torch.arange(n_heads - 1, device=log_probs.device)
+        students_idx = students_idx + (students_idx >= teacher_idx).long()
+        teacher = log_probs.index_select(0, teacher_idx)
+        students = log_probs.index_select(0, students_idx)
+    else:
+        teacher_idx = teacher_idx % n_heads
+        teacher = log_probs[teacher_idx:teacher_idx + 1]
+        students = torch.cat([log_probs[:teacher_idx], log_probs[teacher_idx + 1:]])
+    return torch.nn.functional.kl_div(students, teacher.expand_as(students), reduction='none',
+                                      log_target=True).sum((1, 2)) / batch_size
+
+
+def _most_common_idx(indices, cur_idx, n_heads):
+    # indices holds the 0-dim index tensors of the previous steps (see get_loss_nomi); counted on the device
+    if not indices:
+        return cur_idx
+    return torch.bincount(torch.stack(indices), minlength=n_heads).argmax()
+
+
+def self_distillation(logits, labels, teacher_idx=-1, alpha=0.2):
+    """Cross entropy of every classifier head and KL divergence of the other heads to a teacher head,
+    computed on the stacked logits in one pass.
+    Args
+        logits: (H, B, C) tensor, or a list of H (B, C) logits
+        labels: (B, ) class indices
+        teacher_idx: int, or a 0-dim tensor that is used on the device without being read by the host
+    Returns
+        (1 - alpha) * sum(CE) + alpha * sum(KL), and a (2H - 1, ) tensor of the terms: the CE of each head,
+        then the KL of each head but the teacher, in head order (ce1, ce2, ce3, kl1, kl2 for three heads)
+    """
+    log_probs, ce = _cross_entropy_heads(logits, labels)
+    kl = _kl_to_teacher(log_probs, teacher_idx)
+    loss = (1 - alpha) * ce.sum() + alpha * kl.sum()
+    return loss, torch.cat([ce, kl])
+
+
 def get_loss_up_1ce(pcds_pred, labels_pred, partial, gt, gt_label, feats_cls, sqrt=True):
     """loss function
     Args
@@ -90,32 +142,15 @@ def get_loss_wo_bcs(pcds_pred, labels_pred, partial, gt, gt_label, feats_cls, sq
 
     partial_matching = PM(partial, P3)
 
-    CE = torch.nn.CrossEntropyLoss()
-    ce1 = CE(labels_pred[0], gt_label)
-    ce2 = CE(labels_pred[1], gt_label)
-    ce3 = CE(labels_pred[2], gt_label)
-
+    alpha, beta = 0.2, 0.5
     # use last classifier as reference label
-    KL = torch.nn.KLDivLoss(reduction='batchmean', log_target=True)
-    label_pred_soft0 = torch.nn.functional.log_softmax(labels_pred[0], dim=-1)
-    label_pred_soft1 = torch.nn.functional.log_softmax(labels_pred[1], dim=-1)
-    label_pred_soft2 = torch.nn.functional.log_softmax(labels_pred[2], dim=-1)
-
-    kl1 = KL(label_pred_soft0, label_pred_soft2)
-    kl2 = KL(label_pred_soft1, label_pred_soft2)
+    loss_dis, cls_terms = self_distillation(labels_pred[:3], gt_label, 2, alpha)
+    ce1, ce2, ce3, kl1, kl2 = cls_terms.unbind()
 
     # L2 feature loss
-    MSE = torch.nn.MSELoss()
-    mse1 = MSE(feats_cls[0], feats_cls[2])
-    mse2 = MSE(feats_cls[1], feats_cls[2])
-
-    alpha, beta = 0.2, 0.5
+    loss_l2 = mse_loss(feats_cls[0], feats_cls[2]) + mse_loss(feats_cls[1], feats_cls[2]) if mse else 0
 
     loss_cd = cdc + cd1 + cd2 + cd3 + partial_matching
-    loss_ce = ce1 + ce2 + ce3
-    loss_kl = kl1 + kl2
-    loss_l2 = mse1 + mse2 if mse else 0
-    loss_dis = (1 - alpha) * loss_ce + alpha * loss_kl
     loss_all = loss_cd * 1e3 + loss_dis + beta * loss_l2
     losses = [cdc, cd1, cd2, cd3, partial_matching, ce1, ce2, ce3, kl1, kl2]
     return loss_all, losses
@@ -148,42 +183,19 @@ def get_loss_nomi(labels_pred, gt_label, pcds_pred, partial, gt, feats_cls, last
 
     partial_matching, _, _ = PM(partial, P3)
 
-    CE = torch.nn.CrossEntropyLoss()
-    ce1 = CE(labels_pred[0], gt_label)
-    ce2 = CE(labels_pred[1], gt_label)
-    ce3 = CE(labels_pred[2], gt_label)
-    # print(f'loss label and gt_label after gathering: {labels_pred[0].shape, gt_label.shape}')
-    # ced = CE(labels_pred[3], gt_label)
-    cur_idx = torch.argmin(torch.tensor([ce1, ce2, ce3], requires_grad=True))
-    indices.append(cur_idx.item())
     if nomi:
         # counter = collections.Counter(indices)
         # best_idx = counter.most_common(1)[0][0]
         best_idx = 0 if epoch_idx < 100 else 2
     else:
         best_idx = last_idx
-    # indices.append(cur_idx.item())
-    # counter = collections.Counter(indices)
-    # best_idx = counter.most_common(1)[0][0]
-    # use last classifier as reference label
-
-    KL = torch.nn.KLDivLoss(reduction='batchmean', log_target=True)
-    label_pred_soft0 = torch.nn.functional.log_softmax(labels_pred[0], dim=-1)
-    label_pred_soft1 = torch.nn.functional.log_softmax(labels_pred[1], dim=-1)
-    label_pred_soft2 = torch.nn.functional.log_softmax(labels_pred[2], dim=-1)
-    label_pred_softs = [label_pred_soft0, label_pred_soft1, label_pred_soft2]
-    loss_kl, kls = 0, []
-    if nomi:
-        for s in range(len(label_pred_softs)):
-            if s != best_idx:
-                kl = KL(label_pred_softs[s], label_pred_softs[best_idx])
-                loss_kl += kl
-                kls.append(kl)
-        kl1, kl2 = kls
-    else: # the deepest is the teacher
-        kl1 = KL(label_pred_soft0, label_pred_soft2)
-        kl2 = KL(label_pred_soft1, label_pred_soft2)
-        loss_kl = kl1 + kl2
+    # use the best (nomi) or the deepest classifier as the teacher
+    alpha, beta, theta = 0.2, 1.0, 10.0
+    loss_dis, cls_terms = self_distillation(labels_pred[:3], gt_label, best_idx if nomi else 2, alpha)
+    cur_idx = torch.argmin(cls_terms[:3].detach())
+    if indices is not None:
+        # Stays on the device: indices collects 0-dim tensors, torch.stack(indices).tolist() when needed
+        indices.append(cur_idx)
 
 
     # L2 feature loss
@@ -197,19 +209,16 @@ def get_loss_nomi(labels_pred, gt_label, pcds_pred, partial, gt, feats_cls, last
     #     mse2 = torch.tensor(0)
     #     mse3 = torch.tensor(0)
     # kl1, kl2 = torch.tensor(0), torch.tensor(0)
-    mse1, mse2, mse3= torch.tensor(0), torch.tensor(0), torch.tensor(0)
-    alpha, beta, theta = 0.2, 1.0, 10.0
+    mse1 = mse2 = mse3 = torch.zeros((), device=cdc.device)
 
 
     loss_cd = cdc + cd1 + cd2 + cd3 + partial_matching
-    loss_ce = ce1 + ce2 + ce3
-    # loss_kl = kl1 + kl2
     # loss_l2 = mse1 if epoch_idx < 100 else  mse2 + mse3 if mse else 0
     loss_l2 = mse2 + mse3 if mse else 0
-    loss_dis = (1 - alpha) * loss_ce + alpha * loss_kl
     loss_all = loss_cd * 1e3 + loss_dis + beta * loss_l2 #+ theta * loss_sdf
     # loss_all = loss_cd * 1e3 + loss_ce
-    losses = [cdc, cd1, cd2, cd3, partial_matching, ce1, ce2, ce3, kl1, kl2, mse1, mse2, mse3]
+    # ce1, ce2, ce3, kl1, kl2
+    losses = [cdc, cd1, cd2, cd3, partial_matching] + list(cls_terms.unbind()) + [mse1, mse2, mse3]
     return loss_all, losses, cur_idx, best_idx
 
 
@@ -271,7 +280,7 @@ def get_loss_9(labels_pred, gt_label, pcds_pred, partial, gt, infos, sqrt=True):
 
 
     # kl1, kl2 = torch.tensor(0), torch.tensor(0)
-    mse1, mse2, mse3= torch.tensor(0), torch.tensor(0), torch.tensor(0)
+    mse1 = mse2 = mse3 = torch.zeros((), device=labels_pred[0].device)
     alpha, beta, theta = 0.2, 1.0, 10.0
 
 
@@ -319,7 +328,7 @@ def get_loss_10(labels_pred, gt_label, pcds_pred, partial, gt, sqrt=True): # wit
     ce1 = CE(labels_pred[0], gt_label0)
 
     # kl1, kl2 = torch.tensor(0), torch.tensor(0)
-    mse1, mse2, mse3= torch.tensor(0), torch.tensor(0), torch.tensor(0)
+    mse1 = mse2 = mse3 = torch.zeros((), device=labels_pred[0].device)
     alpha, beta, theta = 0.2, 1.0, 10.0
 
 
@@ -362,12 +371,11 @@ def get_loss_nomi23(labels_pred, gt_label, pcds_pred, partial, gt, feats_cls, la
 
     partial_matching = PM(partial, P2)
 
-    CE = torch.nn.CrossEntropyLoss()
-    ce1 = CE(labels_pred[0], gt_label)
-    ce2 = CE(labels_pred[1], gt_label)
-    cur_idx = torch.argmin(torch.tensor([ce1, ce2], requires_grad=True))
-    # print(cur_idx)
-    indices.append(cur_idx.item())
+    _, ce = _cross_entropy_heads(labels_pred[:2], gt_label)
+    ce1, ce2 = ce.unbind()
+    cur_idx = torch.argmin(ce.detach())
+    if indices is not None:
+        indices.append(cur_idx)
     if nomi:
         # counter = collections.Counter(indices)
         # best_idx = counter.most_common(1)[0][0]
@@ -405,7 +413,7 @@ def get_loss_nomi23(labels_pred, gt_label, pcds_pred, partial, gt, feats_cls, la
     # else:
     #     mse1 = torch.tensor(0)
     #     mse2 = torch.tensor(0)
-    kl1, mse1, mse2 = torch.tensor(0), torch.tensor(0), torch.tensor(0)
+    kl1 = mse1 = mse2 = torch.zeros((), device=ce.device)
     alpha, beta, theta = 0.2, 1.0, 10.0
 
 
@@ -448,46 +456,21 @@ def get_loss_nomi22(labels_pred, gt_label, pcds_pred, partial, gt, feats_cls, la
 
     partial_matching = PM(partial, P3)
 
-    CE = torch.nn.CrossEntropyLoss()
-    ce1 = CE(labels_pred[0], gt_label)
-    ce2 = CE(labels_pred[1], gt_label)
-    ce3 = CE(labels_pred[2], gt_label)
-    ce4 = CE(labels_pred[3], gt_label)
-    cur_idx = torch.argmin(torch.tensor([ce1, ce2, ce3, ce4], requires_grad=True))
-    indices.append(cur_idx.item())
+    log_probs, ce = _cross_entropy_heads(labels_pred[:4], gt_label)
+    cur_idx = torch.argmin(ce.detach())
+    if indices is not None:
+        indices.append(cur_idx)
     if nomi:
-        counter = collections.Counter(indices)
-        best_idx = counter.most_common(1)[0][0]
+        best_idx = _most_common_idx(indices, cur_idx, 4)
     else:
         best_idx = last_idx
-    # indices.append(cur_idx.item())
-    # counter = collections.Counter(indices)
-    # best_idx = counter.most_common(1)[0][0]
-    # use last classifier as reference label
-    KL = torch.nn.KLDivLoss(reduction='batchmean', log_target=True)
-    label_pred_soft0 = torch.nn.functional.log_softmax(labels_pred[0], dim=-1)
-    label_pred_soft1 = torch.nn.functional.log_softmax(labels_pred[1], dim=-1)
-    label_pred_soft2 = torch.nn.functional.log_softmax(labels_pred[2], dim=-1)
-    label_pred_soft3 = torch.nn.functional.log_softmax(labels_pred[3], dim=-1)
-
-    label_pred_softs = [label_pred_soft0, label_pred_soft1, label_pred_soft2, label_pred_soft3]
-    loss_kl, kls = 0, []
-    if nomi:
-        for s in label_pred_softs:
-            if s is not label_pred_softs[best_idx]:
-                kl = KL(s, label_pred_softs[best_idx])
-                loss_kl += kl
-                kls.append(kl)
-        kl1, kl2, kl3 = kls
-    else: # the deepest is the teacher
-        kl1 = KL(label_pred_soft0, label_pred_soft2)
-        kl2 = KL(label_pred_soft1, label_pred_soft2)
-        kl3 = KL(label_pred_soft3, label_pred_soft2)
-        loss_kl = kl1 + kl2 + kl3
+    # the most frequent best (nomi) or the third classifier is the teacher
+    kl = _kl_to_teacher(log_probs, best_idx if nomi else 2)
+    ce1, ce2, ce3, ce4 = ce.unbind()
+    kl1, kl2, kl3 = kl.unbind()
 
 
     # L2 feature loss
-    MSE = torch.nn.MSELoss()
     # print(f'MSE: {feats_cls[0].shape, feats_cls[3].shape}')
     # mse1 = MSE(feats_cls[0], feats_cls[3]) # last is the code from snowflake
     # mse2 = MSE(feats_cls[1], feats_cls[3])
@@ -495,9 +478,9 @@ def get_loss_nomi22(labels_pred, gt_label, pcds_pred, partial, gt, feats_cls, la
     # mse1 = MSE(feats_cls[3], feats_cls[2]) # last is the code from snowflake
     # mse2 = MSE(feats_cls[1], feats_cls[2])
     # mse3 = MSE(feats_cls[0], feats_cls[2])
-    mse1 = MSE(feats_cls[1], feats_cls[0]) # gradual mse, reversed
-    mse2 = MSE(feats_cls[2], feats_cls[0])
-    mse3 = MSE(feats_cls[3], feats_cls[0])
+    mse1 = mse_loss(feats_cls[1], feats_cls[0]) # gradual mse, reversed
+    mse2 = mse_loss(feats_cls[2], feats_cls[0])
+    mse3 = mse_loss(feats_cls[3], feats_cls[0])
     # mse1 = MSE(feats_cls[0], feats_cls[3]) # gradual mse
     # mse2 = MSE(feats_cls[1], feats_cls[0])
     # mse3 = MSE(feats_cls[2], feats_cls[1])
@@ -542,30 +525,13 @@ def get_loss_ensem(labels_pred, gt_label): # only cross entropy
         pcds_pred: List of predicted point clouds, order in [Pc, P1, P2, P3...]
     """
 
-    CE = torch.nn.CrossEntropyLoss()
-    ce1 = CE(labels_pred[0], gt_label)
-    ce2 = CE(labels_pred[1], gt_label)
-    ce3 = CE(labels_pred[2], gt_label)
-    ce4 = CE(labels_pred[3], gt_label)
-
     # use last classifier as reference label
-    KL = torch.nn.KLDivLoss(reduction='batchmean', log_target=True)
-    label_pred_soft0 = torch.nn.functional.log_softmax(labels_pred[0], dim=-1)
-    label_pred_soft1 = torch.nn.functional.log_softmax(labels_pred[1], dim=-1)
-    label_pred_soft2 = torch.nn.functional.log_softmax(labels_pred[2], dim=-1)
-    label_pred_soft3 = torch.nn.functional.log_softmax(labels_pred[3], dim=-1)
-    kl1 = KL(label_pred_soft0, label_pred_soft3)
-    kl2 = KL(label_pred_soft1, label_pred_soft3)
-    kl3 = KL(label_pred_soft2, label_pred_soft3)
-
     alpha, beta = 0.2, 0.5
+    loss_dis, cls_terms = self_distillation(labels_pred[:4], gt_label, 3, alpha)
 
-    loss_ce = ce1 + ce2 + ce3 + ce4
-    loss_kl = kl1 + kl2 + kl3
     # loss_l2 = mse1 + mse2
-    loss_dis = (1 - alpha) * loss_ce + alpha * loss_kl
     loss_all = loss_dis# + beta * loss_l2
-    losses = [ce1, ce2, ce3, ce4, kl1, kl2, kl3]
+    losses = list(cls_terms.unbind()) # ce1, ce2, ce3, ce4, kl1, kl2, kl3
     return loss_all, losses
 
 
@@ -606,31 +572,16 @@ def get_loss_ensem_sd(labels_pred, gt_label, pcds_pred, partial, gt, feats_cls,
 
     partial_matching = PM(partial, P3)
 
-    CE = torch.nn.CrossEntropyLoss()
-    ce1 = CE(labels_pred[0], gt_label)
-    ce2 = CE(labels_pred[1], gt_label)
-    ce3 = CE(labels_pred[2], gt_label)
-    ce4 = CE(labels_pred[3], gt_label)
-
     # use last classifier as reference label
-    KL = torch.nn.KLDivLoss(reduction='batchmean', log_target=True)
-    label_pred_soft0 = torch.nn.functional.log_softmax(labels_pred[0], dim=-1)
-    label_pred_soft1 = torch.nn.functional.log_softmax(labels_pred[1], dim=-1)
-    label_pred_soft2 = torch.nn.functional.log_softmax(labels_pred[2], dim=-1)
-    label_pred_soft3 = torch.nn.functional.log_softmax(labels_pred[3], dim=-1)
-    kl1 = KL(label_pred_soft0, label_pred_soft3)
-    kl2 = KL(label_pred_soft1, label_pred_soft3)
-    kl3 = KL(label_pred_soft2, label_pred_soft3)
-
-    MSE = torch.nn.MSELoss()
+    _, cls_terms = self_distillation(labels_pred[:4], gt_label, 3)
+    ce1, ce2, ce3, ce4, kl1, kl2, kl3 = cls_terms.unbind()
+
     if mse:
-        mse1 = MSE(feats_cls[0], feats_cls[3]) # gradual mse, reversed
-        mse2 = MSE(feats_cls[1], feats_cls[3])
-        mse3 = MSE(feats_cls[2], feats_cls[3])
+        mse1 = mse_loss(feats_cls[0], feats_cls[3]) # gradual mse, reversed
+        mse2 = mse_loss(feats_cls[1], feats_cls[3])
+        mse3 = mse_loss(feats_cls[2], feats_cls[3])
     else:
-        mse1 = torch.tensor(0)
-        mse2 = torch.tensor(0)
-        mse3 = torch.tensor(0)
+        mse1 = mse2 = mse3 = torch.zeros((), device=cls_terms.device)
 
     alpha, beta, theta = 0.2, 1.0, 10.0
 
@@ -650,28 +601,12 @@ def get_loss_3ce(labels_pred, gt_label): # only cross entropy
         pcds_pred: List of predicted point clouds, order in [Pc, P1, P2, P3...]
     """
 
-    CE = torch.nn.CrossEntropyLoss()
-    ce1 = CE(labels_pred[0], gt_label)
-    ce2 = CE(labels_pred[1], gt_label)
-    ce3 = CE(labels_pred[2], gt_label)
-
     # use last classifier as reference label
-    KL = torch.nn.KLDivLoss(reduction='batchmean', log_target=True)
-    label_pred_soft0 = torch.nn.functional.log_softmax(labels_pred[0], dim=-1)
-    label_pred_soft1 = torch.nn.functional.log_softmax(labels_pred[1], dim=-1)
-    label_pred_soft2 = torch.nn.functional.log_softmax(labels_pred[2], dim=-1)
-    kl1 = KL(label_pred_soft0, label_pred_soft2)
-    kl2 = KL(label_pred_soft1, label_pred_soft2)
-
-
     alpha, beta = 0.2, 0.5
+    loss_dis, cls_terms = self_distillation(labels_pred[:3], gt_label, 2, alpha)
 
-    loss_ce = ce1 + ce2 + ce3
-    loss_kl = kl1 + kl2
-    # loss_l2 = mse1 + mse2
-    loss_dis = (1 - alpha) * loss_ce + alpha * loss_kl
     loss_all = loss_dis# + beta * loss_l2
-    losses = [ce1, ce2, ce3, kl1, kl2]
+    losses = list(cls_terms.unbind()) # ce1, ce2, ce3, kl1, kl2
     return loss_all, losses
 
 
@@ -681,48 +616,26 @@ def get_loss_3ce_nomi(labels_pred, gt_label, feats_cls, last_idx, indices, mse=F
         pcds_pred: List of predicted point clouds, order in [Pc, P1, P2, P3...]
     """
 
-    CE = torch.nn.CrossEntropyLoss()
-    ce1 = CE(labels_pred[0], gt_label)
-    ce2 = CE(labels_pred[1], gt_label)
-    ce3 = CE(labels_pred[2], gt_label)
-
-    # use last classifier as reference label
-    KL = torch.nn.KLDivLoss(reduction='batchmean', log_target=True)
-    label_pred_soft0 = torch.nn.functional.log_softmax(labels_pred[0], dim=-1)
-    label_pred_soft1 = torch.nn.functional.log_softmax(labels_pred[1], dim=-1)
-    label_pred_soft2 = torch.nn.functional.log_softmax(labels_pred[2], dim=-1)
-
-    cur_idx = torch.argmin(torch.tensor([ce1, ce2, ce3], requires_grad=True))
-    indices.append(cur_idx.item())
+    log_probs, ce = _cross_entropy_heads(labels_pred[:3], gt_label)
+    cur_idx = torch.argmin(ce.detach())
+    if indices is not None:
+        indices.append(cur_idx)
     # if nomi:
-    counter = collections.Counter(indices)
-    best_idx = counter.most_common(1)[0][0]
-        # print(best_idx[0][0], counter)
+    best_idx = _most_common_idx(indices, cur_idx, 3)
     # else:
     #     best_idx = last_idx
 
-    label_pred_softs = [label_pred_soft0, label_pred_soft1, label_pred_soft2]
-    loss_kl, kls = 0, []
-    for s in label_pred_softs:
-        if s is not label_pred_softs[best_idx]:
-            kl = KL(s, label_pred_softs[best_idx])
-            loss_kl += kl
-            kls.append(kl)
-
-    kl1, kl2 = kls
+    # the most frequent best classifier is the teacher
+    kl = _kl_to_teacher(log_probs, best_idx)
     # L2 feature loss
     if mse:
-        MSE = torch.nn.MSELoss()
-        mse1 = MSE(feats_cls[0], feats_cls[2])
-        mse2 = MSE(feats_cls[1], feats_cls[2])
+        mse1 = mse_loss(feats_cls[0], feats_cls[2])
+        mse2 = mse_loss(feats_cls[1], feats_cls[2])
 
     alpha, beta = 0.2, 0.5
 
-    loss_ce = ce1 + ce2 + ce3
-    loss_kl = kl1 + kl2
     loss_l2 = mse1 + mse2 if mse else 0
-    loss_dis = (1 - alpha) * loss_ce + alpha * loss_kl
+    loss_dis = (1 - alpha) * ce.sum() + alpha * kl.sum()
     loss_all = loss_dis + beta * loss_l2
-    losses = [ce1, ce2, ce3, kl1, kl2]
+    losses = list(torch.cat([ce, kl]).unbind()) # ce1, ce2, ce3, kl1, kl2
     return loss_all, losses, cur_idx, best_idx
-
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+# Cached dataset manifests: resolve a loader's file list once and reuse it across runs.
+
+import hashlib
+import json
+import logging
+import os
+import pickle
+
+
+class ManifestCache(object):
+    """Pickled file lists keyed by the loader config and the mtimes/sizes of their source files.
+
+    Editing a split file, a category file or the dataset config changes the key, so stale
+    manifests are never read; they are simply left behind in `cache_dir`.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.memo = {}
+
+    def key(self, name, config, sources):
+        stamps = []
+        for path in sources:
+            st = os.stat(path)
+            stamps.append([os.path.abspath(path), st.st_mtime_ns, st.st_size])
+        blob = json.dumps([name, config, stamps], sort_keys=True, default=str)
+        return '%s-%s' % (name, hashlib.sha1(blob.encode()).hexdigest()[:16])
+
+    def load(self, name, config, sources, build_fn):
+        key = self.key(name, config, sources)
+        if key in self.memo:
+            return self.memo[key]
+
+        path = os.path.join(self.cache_dir, '%s.pkl' % key)
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                file_list = pickle.load(f)
+            logging.info('Loaded manifest %s. Total files: %d' % (path, len(file_list)))
+        else:
+            file_list = build_fn()
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            tmp_path = '%s.%d.tmp' % (path, os.getpid())
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(file_list, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+            logging.info('Saved manifest to %s' % path)
+
+        self.memo[key] = file_list
+        return file_list
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+# Micro-batching with gradient accumulation: a logical batch is run as k smaller forward/backward passes.
+
+import contextlib
+import logging
+import torch
+
+
+def split_batch(tensors, micro_batch_size, n_views=1):
+    """Splits tensors sharing dim 0 into micro-batches of at most `micro_batch_size` samples.
+
+    Returns [(micro-batch tensors, weight)], where weight = micro-batch size / batch size, so that the sum
+    of weighted batch-mean losses is the batch-mean loss. Sizes are balanced (no tiny trailing micro-batch,
+    which BatchNorm cannot train on) and the n_views partial views of an object stay together.
+    """
+    batch_size = tensors[0].size(0)
+    if micro_batch_size <= 0 or micro_batch_size >= batch_size:
+        return [(tensors, 1.)]
+    n_objects = batch_size // n_views
+    n_micro = -(-n_objects // max(1, micro_batch_size // n_views))
+    bounds = [n_views * (n_objects * i // n_micro) for i in range(n_micro + 1)]
+    bounds[-1] = batch_size
+    return [([t[start:end] for t in tensors], (end - start) / float(batch_size))
+            for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+@contextlib.contextmanager
+def accumulate_bn(model, n_micro):
+    """BatchNorm running statistics updated once per logical batch instead of once per micro-batch.
+
+    Each of the n_micro updates uses momentum 1 - (1 - m) ** (1 / n_micro), so together they decay the old
+    statistics exactly like one update with momentum m. Normalisation itself uses micro-batch statistics.
+    """
+    if n_micro <= 1:
+        yield
+        return
+    saved = []
+    for module in model.modules():
+        if isinstance(module, torch.nn.modules.batchnorm._BatchNorm) and module.momentum is not None:
+            saved.append((module, module.momentum))
+            module.momentum = 1. - (1. - module.momentum) ** (1. / n_micro)
+    try:
+        yield
+    finally:
+        for module, momentum in saved:
+            module.momentum = momentum
+
+
+def no_sync(model, enabled):
+    """DistributedDataParallel.no_sync() for all but the last micro-batch: gradients are all-reduced once"""
+    if enabled and isinstance(model, torch.nn.parallel.DistributedDataParallel):
+        return model.no_sync()
+    return contextlib.nullcontext()
+
+
+def _peak_memory():
+    return max(torch.cuda.max_memory_allocated(d) for d in range(torch.cuda.device_count()))
+
+
+def auto_micro_batch_size(model, step_fn, batch_size, memory_budget=0, n_views=1):
+    """Largest micro-batch size expected to fit in `memory_budget` GiB per device (0: 90% of device memory).
+
+    `step_fn(n)` runs forward and backward on the first n samples of a batch. Peak memory is measured for
+    two probe sizes and extrapolated linearly; gradients and BatchNorm running statistics are restored.
+    """
+    if not torch.cuda.is_available():
+        return batch_size
+    if memory_budget > 0:
+        budget = memory_budget * 1024 ** 3
+    else:
+        budget = 0.9 * min(torch.cuda.get_device_properties(d).total_memory
+                           for d in range(torch.cuda.device_count()))
+    small = min(batch_size, 4 * n_views)
+    large = min(batch_size, 2 * small)
+    if large == small:
+        return batch_size
+
+    bn_state = {k: v.clone() for k, v in model.state_dict().items() if 'running_' in k or 'num_batches' in k}
+    peaks = []
+    try:
+        for n in (small, large):
+            model.zero_grad(set_to_none=True)
+            torch.cuda.empty_cache()
+            torch.cuda.reset_peak_memory_stats()
+            step_fn(n)
+            torch.cuda.synchronize()
+            peaks.append(_peak_memory())
+    finally:
+        model.zero_grad(set_to_none=True)
+        model.load_state_dict(bn_state, strict=False)
+
+    per_sample = max(1., (peaks[1] - peaks[0]) / float(large - small))
+    base = peaks[0] - small * per_sample
+    micro_batch_size = int((budget - base) // per_sample) // n_views * n_views
+    micro_batch_size = max(n_views, min(batch_size, micro_batch_size))
+    logging.info('Micro-batch size %d for a budget of %.1f GiB (%.1f MiB per sample, %.1f MiB base)' %
+                 (micro_batch_size, budget / 1024 ** 3, per_sample / 1024 ** 2, base / 1024 ** 2))
+    return micro_batch_size
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+# Seed-and-patch partial views, as written by the processors in utils/preprocess.py
+
+import hashlib
+import os
+import numpy as np
+from sklearn.neighbors import KDTree
+
+
+def knn_table(ptcloud, k):
+    """(N, k) indices of the k nearest neighbours of every point (itself first)"""
+    tree = KDTree(ptcloud, leaf_size=2)
+    _, ball_idx = tree.query(ptcloud, k=min(k, len(ptcloud)))
+    return ball_idx.astype(np.int16 if len(ptcloud) < 2 ** 15 else np.int32)
+
+
+def seed_patch_partial(ptcloud, neighbours, num_seed, rng=np.random):
+    """Union of the k-NN patches around `num_seed` random seeds, one (num_seed * k, C) view"""
+    seeds = rng.choice(len(ptcloud), num_seed)
+    return ptcloud[neighbours[seeds].reshape(-1)]
+
+
+class SeedPatchSampler(object):
+    """Synthesises partial views from the complete cloud at load time.
+
+    Neighbour tables depend only on the complete cloud and k, so they are computed once per object
+    and kept as .npy files in `cache_dir`; num_seed can change freely between runs.
+    """
+    def __init__(self, num_seed, k, cache_dir=None):
+        self.num_seed = num_seed
+        self.k = k
+        self.cache_dir = cache_dir
+        if cache_dir is not None and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def neighbours(self, gt_path, ptcloud):
+        if self.cache_dir is None:
+            return knn_table(ptcloud, self.k)
+
+        name = hashlib.sha1(os.path.abspath(gt_path).encode()).hexdigest()
+        table_path = os.path.join(self.cache_dir, '%s_k%d.npy' % (name, self.k))
+        if os.path.exists(table_path):
+            table = np.load(table_path)
+            if table.shape[0] == len(ptcloud):
+                return table
+
+        table = knn_table(ptcloud, self.k)
+        tmp_path = '%s.%d.tmp.npy' % (table_path[:-4], os.getpid())
+        np.save(tmp_path, table)
+        os.replace(tmp_path, table_path)
+        return table
+
+    def __call__(self, gt_path, ptcloud, rng=np.random):
+        return seed_patch_partial(ptcloud, self.neighbours(gt_path, ptcloud), self.num_seed, rng)
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+# Fixed-point point cloud codec (.qpc): 16-bit coordinates with per-column offset/scale, optionally zstd.
+# Only the xyz columns are quantized; further columns (e.g. the part labels of packed (N, 4) clouds) are kept
+# as float32, so labels decode exactly.
+# Quantization error report: python -m utils.point_codec <files> [--bits 16] [--zstd]
+
+import argparse
+import struct
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+_MAGIC_V1 = b'QPC1'
+_MAGIC = b'QPC2'
+# magic, flags, bits, n_points, n_columns (QPC1: every column is quantized)
+_HEADER_V1 = struct.Struct('<4sBBII')
+# magic, flags, bits, n_points, n_columns, n_quantized
+_HEADER = struct.Struct('<4sBBIII')
+_FLAG_ZSTD = 1
+# Columns quantized by default: xyz
+QUANTIZED_COLUMNS = 3
+
+
+def encode_points(ptcloud, bits=16, compress=False, level=3, n_quantized=QUANTIZED_COLUMNS):
+    """(N, C) points -> bytes. Each of the first n_quantized columns is mapped linearly onto
+    [0, 2 ** bits - 1] over its own range, so the error per coordinate is at most half a step:
+    range / (2 ** bits - 1) / 2. The other columns are stored as float32."""
+    if bits not in (8, 16):
+        raise Exception('Unsupported quantization bits: %d' % bits)
+    if compress and zstandard is None:
+        raise Exception('zstd compression needs the zstandard package')
+    ptcloud = np.asarray(ptcloud, dtype=np.float32).reshape(len(ptcloud), -1)
+    n_points, n_columns = ptcloud.shape
+    n_quantized = min(n_quantized, n_columns)
+    coords, extra = ptcloud[:, :n_quantized], ptcloud[:, n_quantized:]
+    levels = 2 ** bits - 1
+    offset = coords.min(0) if n_points > 0 else np.zeros(n_quantized, dtype=np.float32)
+    extent = coords.max(0) - offset if n_points > 0 else np.zeros(n_quantized, dtype=np.float32)
+    scale = np.where(extent > 0, extent / levels, 1).astype(np.float32)
+    quantized = np.rint((coords - offset) / scale).clip(0, levels).astype(np.uint8 if bits == 8 else '<u2')
+
+    payload = quantized.tobytes() + np.ascontiguousarray(extra, dtype='<f4').tobytes()
+    if compress:
+        payload = zstandard.ZstdCompressor(level=level).compress(payload)
+    header = _HEADER.pack(_MAGIC, _FLAG_ZSTD if compress else 0, bits, n_points, n_columns, n_quantized)
+    return header + offset.astype('<f4').tobytes() + scale.astype('<f4').tobytes() + payload
+
+
+def decode_points(buf, out=None):
+    """bytes -> (N, C) float32, written into `out` when given (e.g. `pinned_tensor.numpy()`)"""
+    magic = bytes(buf[:4])
+    if magic == _MAGIC:
+        _, flags, bits, n_points, n_columns, n_quantized = _HEADER.unpack_from(buf, 0)
+        pos = _HEADER.size
+    elif magic == _MAGIC_V1:
+        _, flags, bits, n_points, n_columns = _HEADER_V1.unpack_from(buf, 0)
+        n_quantized = n_columns
+        pos = _HEADER_V1.size
+    else:
+        raise Exception('Invalid qpc data.')
+    offset = np.frombuffer(buf, '<f4', n_quantized, pos)
+    scale = np.frombuffer(buf, '<f4', n_quantized, pos + 4 * n_quantized)
+    payload = memoryview(buf)[pos + 8 * n_quantized:]
+    if flags & _FLAG_ZSTD:
+        if zstandard is None:
+            raise Exception('zstd-compressed qpc data needs the zstandard package')
+        payload = zstandard.ZstdDecompressor().decompress(payload)
+    dtype = np.dtype(np.uint8 if bits == 8 else '<u2')
+    quantized = np.frombuffer(payload, dtype, n_points * n_quantized)
+    extra = np.frombuffer(payload, '<f4', n_points * (n_columns - n_quantized),
+                          n_points * n_quantized * dtype.itemsize)
+
+    if out is None:
+        out = np.empty((n_points, n_columns), dtype=np.float32)
+    coords = out[:, :n_quantized]
+    np.multiply(quantized.reshape(n_points, n_quantized), scale, out=coords)
+    np.add(coords, offset, out=coords)
+    out[:, n_quantized:] = extra.reshape(n_points, n_columns - n_quantized)
+    return out
+
+
+def qpc_encoder(decode, bits=16, compress=False):
+    """`encode` hook for utils.shards.write_dataset_shards: stores point files as <path>.qpc. Columns after xyz,
+    such as the labels of packed segmentation clouds, are stored losslessly."""
+    def encode(file_path, blob):
+        if not (file_path.endswith('.pcd') or file_path.endswith('.npy')):
+            return file_path, blob
+        return file_path + '.qpc', encode_points(decode(file_path, blob), bits, compress)
+
+    return encode
+
+
+def chamfer_distance(a, b):
+    """CD as in utils.metrics (mean squared nearest-neighbour distance both ways), x 1000"""
+    from sklearn.neighbors import KDTree
+    d1, _ = KDTree(b).query(a, k=1)
+    d2, _ = KDTree(a).query(b, k=1)
+    return (np.mean(d1 ** 2) + np.mean(d2 ** 2)) * 1000
+
+
+def quantization_report(file_paths, bits=16, compress=False):
+    """Chamfer error and size of the qpc encoding for each file, plus their means"""
+    from utils.io import IO
+    rows = []
+    for file_path in file_paths:
+        ptcloud = IO.get(file_path).astype(np.float32)[:, :3]
+        buf = encode_points(ptcloud, bits, compress)
+        rows.append({
+            'file': file_path,
+            'cd': chamfer_distance(ptcloud, decode_points(buf)),
+            'max_error': float(np.abs(decode_points(buf) - ptcloud).max()) if len(ptcloud) > 0 else 0.,
+            'ratio': len(buf) / float(ptcloud.nbytes)
+        })
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Chamfer error introduced by qpc quantization')
+    parser.add_argument('files', nargs='+')
+    parser.add_argument('--bits', type=int, default=16)
+    parser.add_argument('--zstd', action='store_true')
+    args = parser.parse_args()
+
+    rows = quantization_report(args.files, args.bits, args.zstd)
+    for row in rows:
+        print('%s\tCD(x1e3)=%.6f\tmax_err=%.6f\tsize=%.3f' % (row['file'], row['cd'], row['max_error'], row['ratio']))
+    print('mean\tCD(x1e3)=%.6f\tmax_err=%.6f\tsize=%.3f' %
+          tuple(np.mean([row[k] for row in rows]) for k in ('cd', 'max_error', 'ratio')))
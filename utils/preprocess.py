@@ -15,6 +15,11 @@ from utils.io import IO
 from config_pcn import cfg
 import collections
 import h5py
+import hashlib
+import multiprocessing
+import time
+from concurrent.futures import ThreadPoolExecutor
+from sklearn.neighbors import KDTree
 
 
 label_mapping = {
@@ -500,74 +505,110 @@ def l2_norm(x, y):
     return ((x - y) ** 2).sum(axis=2)
 
 
-def farthest_point_sampling(pts, k, initial_idx=None, metrics=l2_norm, skip_initial=False, indices_dtype=np.int32, distances_dtype=np.float32):
-    """Batch operation of farthest point sampling
+def _fps_batch(pts, k, initial_idx, metrics, skip_initial, indices_dtype, distances_dtype):
+    batch_size, num_point, coord_dim = pts.shape
+    indices = np.zeros((batch_size, k, ), dtype=indices_dtype)
+    indices[:, 0] = initial_idx
+
+    batch_indices = np.arange(batch_size)
+    farthest_point = pts[batch_indices, indices[:, 0]]
+    # minimum distances to the sampled farthest points, the only (batch_size, num_point) state kept
+    min_distances = metrics(farthest_point[:, None, :], pts).astype(distances_dtype)
+
+    if skip_initial:
+        # Override 0-th `indices` by the farthest point of `initial_idx`
+        indices[:, 0] = np.argmax(min_distances, axis=1)
+        farthest_point = pts[batch_indices, indices[:, 0]]
+        min_distances = metrics(farthest_point[:, None, :], pts).astype(distances_dtype)
+
+    for i in range(1, k):
+        indices[:, i] = np.argmax(min_distances, axis=1)
+        farthest_point = pts[batch_indices, indices[:, i]]
+        np.minimum(min_distances, metrics(farthest_point[:, None, :], pts), out=min_distances)
+    return indices, min_distances
+
+
+def farthest_point_sampling(pts, k, initial_idx=None, metrics=l2_norm, skip_initial=False, indices_dtype=np.int32,
+                            distances_dtype=np.float32, return_distances=False, num_threads=1, rng=None):
+    """Streaming batch operation of farthest point sampling, O(num_point) memory per cloud
     Args:
-        pts (numpy.ndarray or cupy.ndarray): 2-dim array (num_point, coord_dim)
+        pts (numpy.ndarray or list): 2-dim array (num_point, coord_dim)
             or 3-dim array (batch_size, num_point, coord_dim)
+            or a list of 2-dim arrays with different num_point.
             When input is 2-dim array, it is treated as 3-dim array with
             `batch_size=1`.
         k (int): number of points to sample
         initial_idx (int): initial index to start farthest point sampling.
-            `None` indicates to sample from random index,
-            in this case the returned value is not deterministic.
+            `None` indicates to sample from random index drawn from `rng`,
+            in this case the returned value is only deterministic for a seeded `rng`.
         metrics (callable): metrics function, indicates how to calc distance.
         skip_initial (bool): If True, initial point is skipped to store as
             farthest point. It stabilizes the function output.
-        xp (numpy or cupy):
         indices_dtype (): dtype of output `indices`
         distances_dtype (): dtype of output `distances`
-    Returns (tuple): `indices` and `distances`.
-        indices (numpy.ndarray or cupy.ndarray): 2-dim array (batch_size, k, )
-            indices of sampled farthest points.
+        return_distances (bool): If True, also return `distances`.
+        num_threads (int): clouds (or chunks of the batch) are sampled in
+            this many threads; numpy releases the GIL in the inner loop.
+        rng (numpy.random.RandomState): source of the random initial indices,
+            drawn before the threads start; `None` uses `np.random`.
+    Returns: `indices`, or `indices` and `distances` if `return_distances`.
+        indices (numpy.ndarray): 2-dim array (batch_size, k, ), or a list of
+            (k, ) arrays for list input.
             `pts[indices[i, j]]` represents `i-th` batch element of `j-th`
             farthest point.
-        distances (numpy.ndarray or cupy.ndarray): 3-dim array
-            (batch_size, k, num_point)
+        distances (numpy.ndarray): 2-dim array (batch_size, num_point), or a
+            list of (num_point, ) arrays for list input. Distance of every
+            input point to its nearest sampled point.
     """
-    if pts.ndim == 2:
-        # insert batch_size axis
-        pts = pts[None, ...]
-    assert pts.ndim == 3
-    # xp = cuda.get_array_module(pts)
-    batch_size, num_point, coord_dim = pts.shape
-    indices = np.zeros((batch_size, k, ), dtype=indices_dtype)
-
-    # distances[bs, i, j] is distance between i-th farthest point `pts[bs, i]`
-    # and j-th input point `pts[bs, j]`.
-    distances = np.zeros((batch_size, k, num_point), dtype=distances_dtype)
+    is_list = isinstance(pts, (list, tuple))
+    if is_list:
+        chunks = [np.asarray(p)[None, ...] for p in pts]
+    else:
+        if pts.ndim == 2:
+            # insert batch_size axis
+            pts = pts[None, ...]
+        assert pts.ndim == 3
+        chunks = np.array_split(pts, min(max(num_threads, 1), len(pts)))
     if initial_idx is None:
-        indices[:, 0] = np.random.randint(len(pts))
+        rng = np.random if rng is None else rng
+        initial_idx = [rng.randint(chunk.shape[1], size=len(chunk)) for chunk in chunks]
     else:
-        indices[:, 0] = initial_idx
+        initial_idx = [initial_idx] * len(chunks)
 
-    batch_indices = np.arange(batch_size)
-    farthest_point = pts[batch_indices, indices[:, 0]]
-    # minimum distances to the sampled farthest point
-    try:
-        min_distances = metrics(farthest_point[:, None, :], pts)
-    except Exception as e:
-        import IPython; IPython.embed()
+    def run(chunk, chunk_initial_idx):
+        return _fps_batch(chunk, k, chunk_initial_idx, metrics, skip_initial, indices_dtype, distances_dtype)
 
-    if skip_initial:
-        # Override 0-th `indices` by the farthest point of `initial_idx`
-        indices[:, 0] = np.argmax(min_distances, axis=1)
-        farthest_point = pts[batch_indices, indices[:, 0]]
-        min_distances = metrics(farthest_point[:, None, :], pts)
+    if num_threads > 1 and len(chunks) > 1:
+        with ThreadPoolExecutor(num_threads) as executor:
+            results = list(executor.map(run, chunks, initial_idx))
+    else:
+        results = [run(chunk, idx) for chunk, idx in zip(chunks, initial_idx)]
 
-    distances[:, 0, :] = min_distances
-    for i in range(1, k):
-        indices[:, i] = np.argmax(min_distances, axis=1)
-        farthest_point = pts[batch_indices, indices[:, i]]
-        dist = metrics(farthest_point[:, None, :], pts)
-        distances[:, i, :] = dist
-        min_distances = np.minimum(min_distances, dist)
-    return indices, distances
+    if is_list:
+        indices = [r[0][0] for r in results]
+        distances = [r[1][0] for r in results]
+    else:
+        indices = np.concatenate([r[0] for r in results])
+        distances = np.concatenate([r[1] for r in results])
+    if return_distances:
+        return indices, distances
+    return indices
+
+
+def fps_downsample(ptcloud, n_points, num_threads=1, rng=None):
+    """Subsample one (N, C) cloud, or a list of them, to `n_points` with farthest point sampling.
+    Starting points are drawn from `rng` (np.random when None); pass a seeded RandomState for reproducible output."""
+    if isinstance(ptcloud, (list, tuple)):
+        indices = farthest_point_sampling([p[:, :3] for p in ptcloud], n_points, num_threads=num_threads, rng=rng)
+        return [p[idx] for p, idx in zip(ptcloud, indices)]
+    return ptcloud[farthest_point_sampling(ptcloud[:, :3], n_points, rng=rng)[0]]
 
 
 class ModelNetDataLoader(object):
-    def __init__(self, cfg, gen_complete=False, gen_partial=False, num_seed=64, k=16, modes=('test', 'train')):
+    def __init__(self, cfg, gen_complete=False, gen_partial=False, num_seed=64, k=16, modes=('test', 'train'),
+                 store_path=None):
         self.cfg = cfg
+        store = ModelNetStore(store_path) if store_path is not None else None
         for mode in modes:
             print('Generating mode =', mode)
             pcd_path = '../datasets/modelnet40_normal_resampled/%s/%s.txt'
@@ -579,11 +620,13 @@ class ModelNetDataLoader(object):
                     category_name = info[0]
                 else:
                     category_name = '_'.join(info[:-1])
-                cur_pcd = np.loadtxt(pcd_path % (category_name, pcd_name), delimiter=',')[:, :3]
+                if store is not None:
+                    cur_pcd = store[pcd_name][:, :3]
+                else:
+                    cur_pcd = parse_modelnet_txt(pcd_path % (category_name, pcd_name))[:, :3]
                 pcd = o3d.geometry.PointCloud()
-                pcd.points = o3d.utility.Vector3dVector(cur_pcd)
                 # 1k or 10k points to be the ground truth, comment or uncomment the statement below
-                pcd = pcd.farthest_point_down_sample(1024)        
+                pcd.points = o3d.utility.Vector3dVector(fps_downsample(cur_pcd, 1024))
                 if gen_complete:
                     target_complete_path = '../datasets/ModelNet40/%s/complete/%s/' % (mode, category_name)
                     if not os.path.exists(target_complete_path):
@@ -985,8 +1028,332 @@ class ScanOjbectProcesser(object):
         np.savetxt(category_file, list(set(label)), fmt='%02d')
 
 
+def write_pcd(file_path, ptcloud):
+    """Binary float32 PCD (what Open3D writes by default), without building an Open3D cloud"""
+    ptcloud = np.ascontiguousarray(ptcloud[:, :3], dtype=np.float32)
+    header = ('# .PCD v0.7 - Point Cloud Data file format\nVERSION 0.7\nFIELDS x y z\nSIZE 4 4 4\nTYPE F F F\n'
+              'COUNT 1 1 1\nWIDTH %d\nHEIGHT 1\nVIEWPOINT 0 0 0 1 0 0 0\nPOINTS %d\nDATA binary\n' %
+              (len(ptcloud), len(ptcloud)))
+    with open(file_path, 'wb') as f:
+        f.write(header.encode('ascii'))
+        f.write(ptcloud.tobytes())
+
+
+def make_views(cur_pcd, num_views, num_seed, k, rng=np.random):
+    """All seed-and-patch views of one object from a single tree and a single batched query"""
+    tree = KDTree(cur_pcd, leaf_size=2)
+    rand_idx = rng.choice(len(cur_pcd), num_views * num_seed)
+    _, ball_idx = tree.query(cur_pcd[rand_idx], k=k)
+    return cur_pcd[ball_idx].reshape(num_views, num_seed * k, -1)
+
+
+MODELNET_STORE = '../datasets/modelnet40_normal_resampled/modelnet40_store.h5'
+
+
+def parse_modelnet_txt(file_path):
+    """(N, 6) float32 points+normals; one vectorised parse of the whole file instead of np.loadtxt"""
+    with open(file_path) as f:
+        values = f.read().replace(',', ' ').split()
+    return np.array(values, dtype=np.float32).reshape(-1, 6)
+
+
+def _parse_modelnet_job(args):
+    name, file_path = args
+    return name, parse_modelnet_txt(file_path)
+
+
+def modelnet_txt_path(pcd_name):
+    info = pcd_name.split('_')
+    category_name = info[0] if len(info) == 2 else '_'.join(info[:-1])
+    return '../datasets/modelnet40_normal_resampled/%s/%s.txt' % (category_name, pcd_name)
+
+
+def build_modelnet_store(store_path=MODELNET_STORE, modes=('train', 'test'), num_workers=None, chunk_rows=64):
+    """Parse every modelnet40_normal_resampled text file once into a chunked HDF5 store.
+
+    `points` is (M, N, 6) float32 with one object per chunk and `names` maps rows to object names;
+    ModelNetStore reads it back, so later variants never touch the text files again.
+    """
+    names = []
+    for mode in modes:
+        names.extend(np.loadtxt('../datasets/modelnet40_normal_resampled/modelnet40_%s.txt' % mode, dtype=str))
+    tmp_path = '%s.%d.tmp' % (store_path, os.getpid())
+    with h5py.File(tmp_path, 'w') as f, multiprocessing.Pool(num_workers or os.cpu_count()) as pool:
+        f.create_dataset('names', data=np.array(names, dtype='S'))
+        points, buffer, row = None, [], 0
+        jobs = [(name, modelnet_txt_path(name)) for name in names]
+        for name, cur_pcd in tqdm(pool.imap(_parse_modelnet_job, jobs, chunksize=8), total=len(jobs)):
+            if points is None:
+                points = f.create_dataset('points', shape=(len(names), ) + cur_pcd.shape, dtype=np.float32,
+                                          chunks=(1, ) + cur_pcd.shape)
+            if cur_pcd.shape != points.shape[1:]:
+                raise ValueError('%s has shape %s, expected %s' % (name, cur_pcd.shape, points.shape[1:]))
+            buffer.append(cur_pcd)
+            if len(buffer) == chunk_rows:
+                points[row:row + len(buffer)] = np.stack(buffer)
+                row, buffer = row + len(buffer), []
+        if buffer:
+            points[row:row + len(buffer)] = np.stack(buffer)
+    os.replace(tmp_path, store_path)
+    logging.info('Saved %d ModelNet objects to %s' % (len(names), store_path))
+
+
+class ModelNetStore(object):
+    """Read access to the store written by build_modelnet_store, one object per lookup"""
+    def __init__(self, store_path=MODELNET_STORE):
+        self.file = h5py.File(store_path, 'r')
+        self.points = self.file['points']
+        self.names = [n.decode() for n in self.file['names'][:]]
+        self.rows = {name: row for row, name in enumerate(self.names)}
+
+    def __contains__(self, name):
+        return name in self.rows
+
+    def __getitem__(self, name):
+        return self.points[self.rows[name]]
+
+    def close(self):
+        self.file.close()
+
+
+_modelnet_stores = {}
+
+
+def load_modelnet_store(store_path, pcd_name, n_points=1024, rng=None):
+    # One handle per worker process, opened on first use after the pool has forked
+    if store_path not in _modelnet_stores:
+        _modelnet_stores[store_path] = ModelNetStore(store_path)
+    return fps_downsample(_modelnet_stores[store_path][pcd_name][:, :3], n_points, rng=rng)
+
+
+def load_modelnet_txt(file_path, n_points=1024, rng=None):
+    return fps_downsample(parse_modelnet_txt(file_path)[:, :3], n_points, rng=rng)
+
+
+SOURCE_LOADERS = {
+    'modelnet_txt': load_modelnet_txt,
+    'modelnet_store': load_modelnet_store,
+}
+
+
+def _run_job(job):
+    # Seeded by the stamp, so regenerating an unchanged object reproduces the same outputs
+    if job['points'] is not None:
+        cur_pcd = job['points']
+    else:
+        cur_pcd = SOURCE_LOADERS[job['loader']](job['source_path'], *job['source_args'],
+                                                rng=np.random.RandomState(int(job['stamp'][8:16], 16)))
+
+    if job['complete_path'] is not None:
+        os.makedirs(os.path.dirname(job['complete_path']), exist_ok=True)
+        write_pcd(job['complete_path'], cur_pcd)
+    for txt_path, arr in job['txt_outputs']:
+        np.savetxt(txt_path, arr, fmt='%.5f')
+    if job['partial_paths']:
+        os.makedirs(os.path.dirname(job['partial_paths'][0]), exist_ok=True)
+        rng = np.random.RandomState(int(job['stamp'][:8], 16))
+        views = make_views(cur_pcd, len(job['partial_paths']), job['num_seed'], job['k'], rng)
+        for target_path, view in zip(job['partial_paths'], views):
+            write_pcd(target_path, view)
+
+    return job['name'], job['stamp']
+
+
+def make_job(name, num_seed, k, complete_path=None, partial_paths=(), points=None, source_path=None,
+             loader=None, source_args=(), txt_outputs=()):
+    """One object for PreprocessEngine; `points` in memory, or read by SOURCE_LOADERS[loader](source_path, *source_args)"""
+    if points is not None:
+        source_id = hashlib.sha1(np.ascontiguousarray(points).tobytes()).hexdigest()
+    else:
+        st = os.stat(source_path)
+        source_id = [os.path.abspath(source_path), st.st_mtime_ns, st.st_size, list(source_args)]
+    params = [source_id, num_seed, k, complete_path, list(partial_paths), [p for p, _ in txt_outputs]]
+    return {
+        'name': name,
+        'stamp': hashlib.sha1(json.dumps(params, default=str).encode()).hexdigest(),
+        'points': points,
+        'source_path': source_path,
+        'loader': loader,
+        'source_args': tuple(source_args),
+        'complete_path': complete_path,
+        'partial_paths': list(partial_paths),
+        'txt_outputs': list(txt_outputs),
+        'num_seed': num_seed,
+        'k': k
+    }
+
+
+class PreprocessEngine(object):
+    """Runs preprocessing jobs over a process pool, one object per task.
+
+    Stamps (hash of source + parameters + output paths) are kept in `stamp_path`; objects whose
+    stamp is unchanged and whose outputs all exist are skipped, so re-running is incremental.
+    Stamps are saved every `save_interval` seconds and when the run stops, so an interrupted run
+    resumes where it was.
+    """
+    def __init__(self, stamp_path, num_workers=None, save_interval=30):
+        self.stamp_path = stamp_path
+        self.num_workers = num_workers or os.cpu_count()
+        self.save_interval = save_interval
+        self.stamps = {}
+        if os.path.exists(stamp_path):
+            with open(stamp_path) as f:
+                self.stamps = json.load(f)
+
+    def _is_done(self, job):
+        outputs = job['partial_paths'] + [p for p, _ in job['txt_outputs']]
+        if job['complete_path'] is not None:
+            outputs.append(job['complete_path'])
+        return self.stamps.get(job['name']) == job['stamp'] and all(os.path.exists(p) for p in outputs)
+
+    def run(self, jobs):
+        todo = [job for job in jobs if not self._is_done(job)]
+        logging.info('Preprocessing %d objects (%d unchanged)' % (len(todo), len(jobs) - len(todo)))
+        if not todo:
+            return
+        last_save = time.time()
+        try:
+            with multiprocessing.Pool(self.num_workers) as pool:
+                for name, stamp in tqdm(pool.imap_unordered(_run_job, todo, chunksize=16), total=len(todo)):
+                    self.stamps[name] = stamp
+                    if time.time() - last_save > self.save_interval:
+                        self._save()
+                        last_save = time.time()
+        finally:
+            self._save()
+
+    def _save(self):
+        stamp_dir = os.path.dirname(self.stamp_path)
+        if stamp_dir and not os.path.exists(stamp_dir):
+            os.makedirs(stamp_dir)
+        tmp_path = self.stamp_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.stamps, f)
+        os.replace(tmp_path, self.stamp_path)
+
+
+def scanobjectnn_jobs(num_seed=64, k=16, BG=True, modes=('test', 'train'), gen_complete=True, gen_partial=True):
+    """Same outputs and naming as ScanOjbectProcesser"""
+    obj_id, jobs, labels = 0, [], []
+    BG_postfix = '' if BG else '_nobg'
+    tar_type = '%s_75_s%d_k%d' % (BG_postfix, num_seed, k)
+    root = '../datasets/ScanObjectNN%s' % tar_type
+    if not os.path.exists(root):
+        os.makedirs(root)
+    for m in modes:
+        m_ = 'training' if m == 'train' else m
+        h5_path = '../datasets/h5_files/main_split%s/%s_objectdataset_augmentedrot_scale75.h5' % (BG_postfix, m_)
+        data, label = load_h5(h5_path, BG)[:2]
+        mode_objs = []
+        for i in range(len(label)):
+            class_name, name = label[i], '%02d_%05d' % (label[i], obj_id)
+            complete_path = '%s/%s/complete/%02d/%s.pcd' % (root, m, class_name, name)
+            if m == 'train':
+                partial_paths = ['%s/%s/partial/%02d/%s/%s-%d.pcd' % (root, m, class_name, name, name, v)
+                                 for v in range(8)]
+            else:
+                partial_paths = ['%s/%s/partial/%02d/%s.pcd' % (root, m, class_name, name)]
+            jobs.append(make_job('%s/%s' % (m, name), num_seed, k, points=data[i],
+                                 complete_path=complete_path if gen_complete else None,
+                                 partial_paths=partial_paths if gen_partial else ()))
+            mode_objs.append(name)
+            obj_id += 1
+        np.savetxt('%s/scanobjectnn_%s.txt' % (root, m), mode_objs, fmt='%s')
+        labels.append(label)
+    np.savetxt('%s/scanobjectnn_shape_names.txt' % root, list(set(np.concatenate(labels))), fmt='%02d')
+    return jobs, '%s/.preprocess_stamps.json' % root
+
+
+def modelnet_jobs(num_seed=64, k=16, modes=('test', 'train'), gen_complete=True, gen_partial=True,
+                  store_path=MODELNET_STORE):
+    """Same outputs and naming as ModelNetDataLoader; objects come from the bulk store when it exists"""
+    use_store = store_path is not None and os.path.exists(store_path)
+    jobs = []
+    for mode in modes:
+        pcd_list = np.loadtxt('../datasets/modelnet40_normal_resampled/modelnet40_%s.txt' % mode, dtype=str)
+        for pcd_name in pcd_list:
+            info = pcd_name.split('_')
+            category_name = info[0] if len(info) == 2 else '_'.join(info[:-1])
+            if mode == 'train':
+                partial_paths = ['../datasets/ModelNet40/%s/partial/%s/%s/%s-%d.pcd' %
+                                 (mode, category_name, pcd_name, pcd_name, v) for v in range(8)]
+            else:
+                partial_paths = ['../datasets/ModelNet40/%s/partial/%s/%s.pcd' % (mode, category_name, pcd_name)]
+            if use_store:
+                source = {'loader': 'modelnet_store', 'source_path': store_path, 'source_args': (pcd_name, )}
+            else:
+                source = {'loader': 'modelnet_txt', 'source_path': modelnet_txt_path(pcd_name)}
+            jobs.append(make_job('%s/%s' % (mode, pcd_name), num_seed, k, **source,
+                                 complete_path='../datasets/ModelNet40/%s/complete/%s/%s.pcd' %
+                                 (mode, category_name, pcd_name) if gen_complete else None,
+                                 partial_paths=partial_paths if gen_partial else ()))
+    return jobs, '../datasets/ModelNet40/.preprocess_stamps_s%d_k%d.json' % (num_seed, k)
+
+
+def shapenetpart_jobs(num_seed=64, k=16, gen_complete=True, gen_partial=True, gen_json=True):
+    """Same outputs and naming as ShapeNetPartV0Processer"""
+    category_file = '../datasets/shapenet_part_seg_hdf5_data/synsetoffset2category.txt'
+    label_mapping = np.loadtxt(category_file, dtype=str)
+    cat_dict = {'train': collections.defaultdict(list), 'test': collections.defaultdict(list)}
+    taxonomy_id, jobs = 0, []
+    for m in ('train', 'test'):
+        FILE_LIST = os.path.join('../datasets/shapenet_part_seg_hdf5_data/', '%s_hdf5_file_list.txt' % m)
+        for file_name in [line.rstrip() for line in open(FILE_LIST)]:
+            batch_data, batch_label, batch_seg = load_h5_data_label_seg(
+                os.path.join('../datasets/shapenet_part_seg_hdf5_data/', file_name))
+            for batch_idx in range(len(batch_label)):
+                class_name = label_mapping[batch_label[batch_idx, 0]][1]
+                complete_dir = '../datasets/ShapeNetPartV0/%s/complete/%s/' % (m, class_name)
+                if m == 'train':
+                    partial_paths = ['../datasets/ShapeNetPartV0/%s/partial/%s/%d/%d-%d.pcd' %
+                                     (m, class_name, taxonomy_id, taxonomy_id, v) for v in range(8)]
+                else:
+                    partial_paths = ['../datasets/ShapeNetPartV0/%s/partial/%s/%d.pcd' % (m, class_name, taxonomy_id)]
+                jobs.append(make_job('%s/%d' % (m, taxonomy_id), num_seed, k, points=batch_data[batch_idx],
+                                     complete_path=complete_dir + '%d.pcd' % taxonomy_id if gen_complete else None,
+                                     txt_outputs=[(complete_dir + '%d.txt' % taxonomy_id, batch_seg[batch_idx])]
+                                     if gen_complete else (),
+                                     partial_paths=partial_paths if gen_partial else ()))
+                cat_dict[m][class_name].append(str(taxonomy_id))
+                taxonomy_id += 1
+    if gen_json:
+        seg_dicts = [{
+            'taxonomy_id': category_id,
+            'taxonomy_name': category,
+            'test': cat_dict['test'][category_id],
+            'train': cat_dict['train'][category_id],
+        } for category, category_id in label_mapping]
+        with open('../datasets/ShapeNetPartV0.json', 'w') as outfile:
+            json.dump(seg_dicts, outfile, indent=4)
+    return jobs, '../datasets/ShapeNetPartV0/.preprocess_stamps_s%d_k%d.json' % (num_seed, k)
+
+
+def pack_seg_labels(root='../datasets/ShapeNetPartV0', modes=('train', 'test')):
+    """Write <name>.npy next to every complete <name>.pcd/<name>.txt pair: (N, 4) float32, part label last.
+
+    Read by Datasetv0 when cfg.DATASETS.SHAPENET.PACKED_LABELS is set, so labels arrive with their points.
+    """
+    for mode in modes:
+        complete_dir = os.path.join(root, mode, 'complete')
+        for category in sorted(os.listdir(complete_dir)):
+            category_dir = os.path.join(complete_dir, category)
+            for file_name in tqdm(sorted(os.listdir(category_dir))):
+                if not file_name.endswith('.pcd'):
+                    continue
+                name = file_name[:-4]
+                label_path = os.path.join(category_dir, '%s.txt' % name)
+                if not os.path.exists(label_path):
+                    continue
+                ptcloud = IO.get(os.path.join(category_dir, file_name))[:, :3]
+                label = np.loadtxt(label_path, dtype=np.float32).reshape(-1, 1)
+                np.save(os.path.join(category_dir, '%s.npy' % name),
+                        np.concatenate((ptcloud, label), 1).astype(np.float32))
+
+
 if __name__ == '__main__':
-    from sklearn.neighbors import KDTree
+    # build_modelnet_store()  # parse the ModelNet text files once, modelnet_jobs() then reads the store
+    # jobs, stamp_path = scanobjectnn_jobs(num_seed=64, k=16, BG=False)
+    # PreprocessEngine(stamp_path).run(jobs)
     # loader = ModelNetDataLoader(cfg, gen_complete=False, gen_partial=True, num_seed=64, k=4)
     # loader = ScanOjbectProcesser(cfg, gen_complete=True, gen_partial=False, num_seed=4, k=128, BG=True)
     # loader = ShapeNetProcesser(cfg, gen_complete=True, gen_partial=False, mode='test') # mode= test or train
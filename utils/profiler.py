@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+# Per-stage profiling of training steps with torch.profiler: Chrome traces and a per-stage summary table.
+# Stages are named ranges attached at run time (forward hooks on modules, wrappers around functions), chosen in
+# cfg.TRAIN.PROFILE.MODULES/FUNCTIONS, so hot paths are profiled without editing the model code.
+# Enable with cfg.TRAIN.PROFILE.ENABLED or `--profile`; open the traces in chrome://tracing or Perfetto.
+
+import contextlib
+import functools
+import importlib
+import logging
+import os
+import sys
+import threading
+import torch
+from torch.autograd.profiler import record_function
+
+STAGE_PREFIX = 'stage:'
+
+# Ranges are only opened while a Profiler is recording; otherwise stage() is a null context
+_active = False
+
+
+def stage(name):
+    """Named range around a block, e.g. `with stage('backward'):`"""
+    return record_function(STAGE_PREFIX + name) if _active else contextlib.nullcontext()
+
+
+def _wrap_function(fn, label):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with record_function(STAGE_PREFIX + label):
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+class _ModuleRanges(object):
+    """Forward pre/post hooks opening and closing one named range per module call.
+
+    Labels carry the module path, e.g. `SPD(decoder.uppers.1)`. Hooks are copied into DataParallel
+    replicas, whose forwards run in one thread per device, so open ranges are kept per thread.
+    """
+    def __init__(self, model, class_names):
+        self.local = threading.local()
+        self.handles = []
+        network = model.module if hasattr(model, 'module') else model
+        for path, module in network.named_modules():
+            if type(module).__name__ in class_names:
+                label = STAGE_PREFIX + '%s(%s)' % (type(module).__name__, path)
+                self.handles.append(module.register_forward_pre_hook(self._pre_hook(label)))
+                self.handles.append(module.register_forward_hook(self._post_hook()))
+
+    def _stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def _pre_hook(self, label):
+        def hook(module, inputs):
+            ctx = record_function(label)
+            ctx.__enter__()
+            self._stack().append(ctx)
+        return hook
+
+    def _post_hook(self):
+        def hook(module, inputs, outputs):
+            stack = self._stack()
+            if stack:
+                stack.pop().__exit__(None, None, None)
+        return hook
+
+    def remove(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+
+class _FunctionRanges(object):
+    """Replaces `package.module.function` by a wrapper in every loaded module that refers to it.
+
+    Names bound by `from ... import` (e.g. fps_subsample in models.model25) are covered as well.
+    """
+    def __init__(self, specs):
+        self.patched = []
+        for spec in specs:
+            module_name, _, attr = spec.rpartition('.')
+            try:
+                fn = getattr(importlib.import_module(module_name), attr)
+            except (ImportError, AttributeError) as e:
+                logging.warning('Not profiling %s: %s' % (spec, e))
+                continue
+            wrapper = _wrap_function(fn, attr)
+            for module in list(sys.modules.values()):
+                for name, value in list(getattr(module, '__dict__', {}).items()):
+                    if value is fn:
+                        setattr(module, name, wrapper)
+                        self.patched.append((module, name, fn))
+
+    def remove(self):
+        for module, name, fn in self.patched:
+            setattr(module, name, fn)
+        self.patched = []
+
+
+def _device_time(event):
+    # Renamed from cuda_time_total in recent versions of PyTorch
+    return getattr(event, 'device_time_total', getattr(event, 'cuda_time_total', 0))
+
+
+def stage_table(events, n_steps):
+    """Inclusive time per stage and step (ms), sorted by device time, then host time.
+
+    Nested stages are included in their parents, e.g. a KNN query in the SPD stage calling it.
+    """
+    stages = [e for e in events if e.key.startswith(STAGE_PREFIX)]
+    step_cpu = sum(e.cpu_time_total for e in events if e.key.startswith('ProfilerStep#'))
+    step_device = sum(_device_time(e) for e in events if e.key.startswith('ProfilerStep#'))
+    stages.sort(key=lambda e: (_device_time(e), e.cpu_time_total), reverse=True)
+
+    n_steps = max(1, n_steps)
+    width = max([len('Stage')] + [len(e.key) - len(STAGE_PREFIX) for e in stages])
+    lines = ['%-*s %10s %12s %8s %14s %8s' % (width, 'Stage', 'Calls/step', 'CPU ms/step', 'CPU %',
+                                              'Device ms/step', 'Device %')]
+    for e in stages:
+        lines.append('%-*s %10.1f %12.3f %8.1f %14.3f %8.1f' % (
+            width, e.key[len(STAGE_PREFIX):], e.count / float(n_steps), e.cpu_time_total / 1e3 / n_steps,
+            100. * e.cpu_time_total / step_cpu if step_cpu else 0., _device_time(e) / 1e3 / n_steps,
+            100. * _device_time(e) / step_device if step_device else 0.))
+    lines.append('%-*s %10s %12.3f %8s %14.3f' % (width, 'Step', '', step_cpu / 1e3 / n_steps, '',
+                                                  step_device / 1e3 / n_steps))
+    return '\n'.join(lines)
+
+
+class Profiler(object):
+    """torch.profiler over training steps, driven by cfg.TRAIN.PROFILE.
+
+    After WAIT steps and WARMUP steps (recorded but discarded), ACTIVE steps are recorded, REPEAT times
+    (0: until stop()). Each recorded window writes to `output_dir`:
+        rank<r>_step<n>.pt.trace.json  Chrome trace
+        rank<r>_step<n>.txt            per-stage summary, followed by the most expensive operators
+    Module hooks and function wrappers are removed once the last window is written. When disabled, every
+    method is a no-op.
+    """
+    def __init__(self, profile_cfg, output_dir, model=None, rank=0):
+        self.cfg = profile_cfg
+        self.enabled = profile_cfg.ENABLED
+        self.output_dir = output_dir
+        self.model = model
+        self.rank = rank
+        self.prof = None
+        self.ranges = []
+        self.n_steps = 0
+
+    def start(self):
+        global _active
+        if not self.enabled:
+            return
+        if not os.path.exists(self.output_dir):
+            os.makedirs(self.output_dir, exist_ok=True)
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.prof = torch.profiler.profile(
+            activities=activities,
+            schedule=torch.profiler.schedule(wait=self.cfg.WAIT, warmup=self.cfg.WARMUP, active=self.cfg.ACTIVE,
+                                             repeat=self.cfg.REPEAT),
+            on_trace_ready=self._on_trace_ready,
+            record_shapes=self.cfg.RECORD_SHAPES,
+            profile_memory=self.cfg.PROFILE_MEMORY,
+            with_stack=self.cfg.WITH_STACK)
+        if self.model is not None:
+            self.ranges.append(_ModuleRanges(self.model, self.cfg.MODULES))
+        self.ranges.append(_FunctionRanges(self.cfg.FUNCTIONS))
+        _active = True
+        self.prof.start()
+        logging.info('Profiling %d steps after %d steps; traces in %s' %
+                     (self.cfg.ACTIVE, self.cfg.WAIT + self.cfg.WARMUP, self.output_dir))
+
+    def step(self):
+        if self.prof is None:
+            return
+        self.prof.step()
+        self.n_steps += 1
+        if self.cfg.REPEAT > 0 and \
+                self.n_steps >= (self.cfg.WAIT + self.cfg.WARMUP + self.cfg.ACTIVE) * self.cfg.REPEAT:
+            self.stop()
+
+    def stop(self):
+        global _active
+        if self.prof is None:
+            return
+        self.prof.stop()
+        self.prof = None
+        _active = False
+        for ranges in self.ranges:
+            ranges.remove()
+        self.ranges = []
+
+    def _on_trace_ready(self, prof):
+        name = os.path.join(self.output_dir, 'rank%d_step%d' % (self.rank, prof.step_num))
+        prof.export_chrome_trace(name + '.pt.trace.json')
+        events = prof.key_averages()
+        summary = stage_table(events, self.cfg.ACTIVE)
+        sort_by = 'self_cuda_time_total' if torch.cuda.is_available() else 'self_cpu_time_total'
+        with open(name + '.txt', 'w') as f:
+            f.write(summary + '\n\n' + events.table(sort_by=sort_by, row_limit=30) + '\n')
+        logging.info('Stage times over %d steps (%s.pt.trace.json):\n%s' % (self.cfg.ACTIVE, name, summary))
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
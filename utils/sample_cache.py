@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+# Shared-memory cache of decoded point clouds, readable by all DataLoader workers.
+
+import atexit
+import hashlib
+import multiprocessing as mp
+import os
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+
+# One row per cached array; rows with nbytes < 0 are free. `gen` is the insert count when the row was filled,
+# so a reader can tell whether the row was evicted (and its bytes reused) while it copied them
+_ENTRY_DTYPE = np.dtype([('key', '<i8'), ('offset', '<i8'), ('nbytes', '<i8'),
+                         ('dim0', '<i8'), ('dim1', '<i8'), ('gen', '<i8')])
+# Shared counters
+_HITS, _MISSES, _EVICTIONS, _INSERTS, _BYTES_USED, _HEAD, _N_FREE, _QUEUE_START, _QUEUE_LEN, _TOMBSTONES = range(10)
+_N_STATS = 10
+# Hash index buckets: rows, or empty / deleted
+_EMPTY, _DELETED = -1, -2
+_ALIGN = 64
+
+
+def _hash_key(key):
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little', signed=True)
+
+
+def shm_available_bytes(path='/dev/shm'):
+    """Free space of the shared-memory filesystem, or None where there is none (e.g. macOS)"""
+    try:
+        st = os.statvfs(path)
+    except (OSError, AttributeError):
+        return None
+    return st.f_bavail * st.f_frsize
+
+
+class SharedSampleCache(object):
+    """Bounded cache of float32 arrays keyed by file path.
+
+    Data and index both live in shared memory created by the main process, so every
+    DataLoader worker (forked or spawned) sees the same entries and the memory is paid once.
+    Arrays are appended to the data arena as to a ring buffer and evicted oldest first when it wraps,
+    so inserting and evicting are O(1); keys are found through an open-addressing hash index. Hits are
+    copied out without holding the lock and then checked against the row's generation.
+    """
+    def __init__(self, max_bytes, max_entries=65536):
+        self.max_bytes = int(max_bytes)
+        self.max_entries = int(max_entries)
+        self._owner_pid = os.getpid()
+        self._lock = mp.Lock()
+        self._data_shm = shared_memory.SharedMemory(create=True, size=self.max_bytes)
+        self._meta_shm = shared_memory.SharedMemory(create=True, size=self._meta_size())
+        self._attach()
+        self._stats[:] = 0
+        self._entries[:] = 0
+        self._entries['nbytes'] = -1
+        self._index[:] = _EMPTY
+        self._free[:] = np.arange(self.max_entries)
+        self._stats[_N_FREE] = self.max_entries
+        atexit.register(self.close)
+
+    def _n_buckets(self):
+        # At most half the buckets hold live rows, so probe sequences stay short
+        return 1 << (2 * self.max_entries - 1).bit_length()
+
+    def _meta_size(self):
+        return 8 * _N_STATS + _ENTRY_DTYPE.itemsize * self.max_entries + 8 * self._n_buckets() + \
+            2 * 8 * self.max_entries
+
+    def _attach(self):
+        buf = self._meta_shm.buf
+        n_buckets = self._n_buckets()
+        self._mask = n_buckets - 1
+        self._data = np.ndarray((self.max_bytes, ), dtype=np.uint8, buffer=self._data_shm.buf)
+        self._stats = np.ndarray((_N_STATS, ), dtype=np.int64, buffer=buf)
+        pos = 8 * _N_STATS
+        self._entries = np.ndarray((self.max_entries, ), dtype=_ENTRY_DTYPE, buffer=buf, offset=pos)
+        pos += _ENTRY_DTYPE.itemsize * self.max_entries
+        self._index = np.ndarray((n_buckets, ), dtype=np.int64, buffer=buf, offset=pos)
+        pos += 8 * n_buckets
+        # Stack of free rows, and the rows in insertion (= eviction) order as a circular queue
+        self._free = np.ndarray((self.max_entries, ), dtype=np.int64, buffer=buf, offset=pos)
+        pos += 8 * self.max_entries
+        self._queue = np.ndarray((self.max_entries, ), dtype=np.int64, buffer=buf, offset=pos)
+
+    def __getstate__(self):
+        # Only used with the spawn start method; fork inherits the mappings directly
+        return {
+            'max_bytes': self.max_bytes,
+            'max_entries': self.max_entries,
+            'owner_pid': self._owner_pid,
+            'lock': self._lock,
+            'data_name': self._data_shm.name,
+            'meta_name': self._meta_shm.name
+        }
+
+    def __setstate__(self, state):
+        self.max_bytes = state['max_bytes']
+        self.max_entries = state['max_entries']
+        self._owner_pid = state['owner_pid']
+        self._lock = state['lock']
+        self._data_shm = shared_memory.SharedMemory(name=state['data_name'])
+        self._meta_shm = shared_memory.SharedMemory(name=state['meta_name'])
+        # Attaching registers the segments with this process' tracker, which would unlink them on exit
+        for shm in (self._data_shm, self._meta_shm):
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        self._attach()
+
+    def get(self, key):
+        """Return a private copy of the cached array, or None on a miss."""
+        h = _hash_key(key)
+        with self._lock:
+            slot = self._find(h)
+            if slot < 0:
+                self._stats[_MISSES] += 1
+                return None
+            entry = self._entries[slot]
+            offset, gen = int(entry['offset']), int(entry['gen'])
+            dim0, dim1 = int(entry['dim0']), int(entry['dim1'])
+
+        shape = (dim0, ) if dim1 < 0 else (dim0, dim1)
+        size = int(np.prod(shape)) * 4
+        array = self._data[offset:offset + size].view(np.float32).reshape(shape).copy()
+        with self._lock:
+            # Rows are evicted before their bytes are reused, so an unchanged row means an intact copy
+            valid = self._entries['nbytes'][slot] >= 0 and self._entries['gen'][slot] == gen
+            self._stats[_HITS if valid else _MISSES] += 1
+        return array if valid else None
+
+    def put(self, key, array):
+        array = np.ascontiguousarray(array, dtype=np.float32)
+        if array.ndim not in (1, 2):
+            return False
+        size = array.nbytes
+        nbytes = (size + _ALIGN - 1) // _ALIGN * _ALIGN
+        if nbytes > self.max_bytes:
+            return False
+
+        h = _hash_key(key)
+        with self._lock:
+            if self._find(h) >= 0:
+                return True
+            slot, offset = self._reserve(nbytes)
+            self._data[offset:offset + size] = array.view(np.uint8).reshape(-1)
+            self._stats[_INSERTS] += 1
+            self._entries[slot] = (h, offset, nbytes, array.shape[0], array.shape[1] if array.ndim == 2 else -1,
+                                   self._stats[_INSERTS])
+            self._insert_index(h, slot)
+            self._stats[_BYTES_USED] += nbytes
+        return True
+
+    def stats(self):
+        with self._lock:
+            hits, misses, evictions, inserts, bytes_used, _, n_free = [int(s) for s in self._stats[:_N_FREE + 1]]
+        lookups = hits + misses
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / lookups if lookups > 0 else 0.,
+            'evictions': evictions,
+            'inserts': inserts,
+            'entries': self.max_entries - n_free,
+            'bytes_used': bytes_used,
+            'max_bytes': self.max_bytes
+        }
+
+    def close(self):
+        if self._data_shm is None:
+            return
+        is_owner = os.getpid() == self._owner_pid
+        self._data = self._stats = self._entries = self._index = self._free = self._queue = None
+        for shm in (self._data_shm, self._meta_shm):
+            shm.close()
+            if is_owner:
+                try:
+                    shm.unlink()
+                except FileNotFoundError:
+                    pass
+        self._data_shm = self._meta_shm = None
+
+    # The methods below are called with the lock held
+
+    def _find(self, h):
+        i = h & self._mask
+        while True:
+            slot = int(self._index[i])
+            if slot == _EMPTY:
+                return -1
+            if slot >= 0 and self._entries['key'][slot] == h:
+                return slot
+            i = (i + 1) & self._mask
+
+    def _insert_index(self, h, slot):
+        i = h & self._mask
+        while self._index[i] >= 0:
+            i = (i + 1) & self._mask
+        if self._index[i] == _DELETED:
+            self._stats[_TOMBSTONES] -= 1
+        self._index[i] = slot
+
+    def _remove_index(self, h, slot):
+        i = h & self._mask
+        while self._index[i] != slot:
+            i = (i + 1) & self._mask
+        self._index[i] = _DELETED
+        self._stats[_TOMBSTONES] += 1
+        if self._stats[_TOMBSTONES] > len(self._index) // 4:
+            # Deleted buckets lengthen probe sequences; reinsert the live rows now and then
+            self._index[:] = _EMPTY
+            self._stats[_TOMBSTONES] = 0
+            for live in np.nonzero(self._entries['nbytes'] >= 0)[0]:
+                self._insert_index(int(self._entries['key'][live]), int(live))
+
+    def _evict_oldest(self):
+        start = int(self._stats[_QUEUE_START])
+        slot = int(self._queue[start])
+        self._stats[_QUEUE_START] = (start + 1) % self.max_entries
+        self._stats[_QUEUE_LEN] -= 1
+        self._stats[_BYTES_USED] -= self._entries['nbytes'][slot]
+        self._entries['nbytes'][slot] = -1
+        self._remove_index(int(self._entries['key'][slot]), slot)
+        self._free[self._stats[_N_FREE]] = slot
+        self._stats[_N_FREE] += 1
+        self._stats[_EVICTIONS] += 1
+
+    def _oldest_offset(self):
+        return int(self._entries['offset'][self._queue[self._stats[_QUEUE_START]]])
+
+    def _reserve(self, nbytes):
+        # Rows sit in the arena in insertion order starting at the write head, so the oldest rows are
+        # exactly those the next nbytes would overwrite
+        head = int(self._stats[_HEAD])
+        if head + nbytes > self.max_bytes:
+            # Wrap around: the rows between the head and the end of the arena go first
+            while self._stats[_QUEUE_LEN] > 0 and self._oldest_offset() >= head:
+                self._evict_oldest()
+            head = 0
+        while self._stats[_QUEUE_LEN] > 0 and (self._stats[_N_FREE] == 0 or
+                                               head <= self._oldest_offset() < head + nbytes):
+            self._evict_oldest()
+
+        self._stats[_N_FREE] -= 1
+        slot = int(self._free[self._stats[_N_FREE]])
+        self._queue[(self._stats[_QUEUE_START] + self._stats[_QUEUE_LEN]) % self.max_entries] = slot
+        self._stats[_QUEUE_LEN] += 1
+        self._stats[_HEAD] = head + nbytes
+        return slot, head
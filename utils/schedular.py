@@ -68,3 +68,17 @@ class GradualWarmupScheduler(_LRScheduler):
                 return super(GradualWarmupScheduler, self).step(epoch)
         else:
             self.step_ReduceLROnPlateau(metrics, epoch) # ReduceLROnPlateau
+
+    def state_dict(self):
+        # The after_scheduler holds the optimizer, so it is saved through its own state_dict
+        state = {key: value for key, value in self.__dict__.items() if key not in ('optimizer', 'after_scheduler')}
+        if self.after_scheduler is not None:
+            state['after_scheduler'] = self.after_scheduler.state_dict()
+        return state
+
+    def load_state_dict(self, state_dict):
+        state_dict = dict(state_dict)
+        after_scheduler = state_dict.pop('after_scheduler', None)
+        self.__dict__.update(state_dict)
+        if after_scheduler is not None and self.after_scheduler is not None:
+            self.after_scheduler.load_state_dict(after_scheduler)
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+# Sequential tar shards of whole samples, written from any Dataset and streamed back per rank and worker.
+
+import io
+import json
+import logging
+import os
+import queue
+import random
+import tarfile
+import threading
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.utils.data
+
+from utils.io import IO
+from utils.storage import normalize_key
+
+_META_DIR = '__sample__'
+
+
+class ShardWriter(object):
+    """Writes samples into <out_dir>/<prefix>-%06d.tar, rolling over every `samples_per_shard` samples.
+
+    A sample is a JSON meta member followed by the raw bytes of its files, stored under their original
+    (normalised) paths, so the shards also serve TarShardBackend lookups by path.
+    """
+    def __init__(self, out_dir, prefix, samples_per_shard=1000):
+        self.out_dir = out_dir
+        self.prefix = prefix
+        self.samples_per_shard = samples_per_shard
+        self.shards = []
+        self.tar = None
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+
+    def _add_member(self, name, blob):
+        info = tarfile.TarInfo(name)
+        info.size = len(blob)
+        self.tar.addfile(info, io.BytesIO(blob))
+
+    def _roll(self):
+        self._close_shard()
+        name = '%s-%06d.tar' % (self.prefix, len(self.shards))
+        self.tar = tarfile.open(os.path.join(self.out_dir, name + '.tmp'), 'w')
+        self.shards.append({'name': name, 'n_samples': 0})
+
+    def _close_shard(self):
+        if self.tar is not None:
+            self.tar.close()
+            path = os.path.join(self.out_dir, self.shards[-1]['name'])
+            os.replace(path + '.tmp', path)
+            self.tar = None
+
+    def write(self, meta, files):
+        """`meta` is JSON-serialisable; `files` maps file paths to their bytes"""
+        if self.tar is None or self.shards[-1]['n_samples'] == self.samples_per_shard:
+            self._roll()
+        self._add_member('%s/%06d.json' % (_META_DIR, self.shards[-1]['n_samples']), json.dumps(meta).encode())
+        for file_path, blob in files.items():
+            self._add_member(normalize_key(file_path), blob)
+        self.shards[-1]['n_samples'] += 1
+
+    def close(self):
+        self._close_shard()
+        with open(os.path.join(self.out_dir, '%s.json' % self.prefix), 'w') as f:
+            json.dump({'shards': self.shards}, f, indent=4)
+
+
+def write_dataset_shards(dataset, out_dir, prefix, samples_per_shard=1000, encode=None):
+    """Shard every sample of a Dataset/Datasetv0 (e.g. `loader.get_dataset(DatasetSubset.TRAIN)`).
+
+    All renderings of a sample are kept, so rendering choice and augmentation still happen at read time.
+    `encode(file_path, bytes)` may return (new_path, new_bytes) to store files in another format, e.g.
+    utils.point_codec.qpc_encoder(IO.decode) for 16-bit quantized points.
+    """
+    writer = ShardWriter(out_dir, prefix, samples_per_shard)
+    required_items = list(dataset.options['required_items']) + list(dataset.options.get('required_labels', []))
+    for idx, sample in enumerate(dataset.file_list):
+        meta = {
+            'taxonomy_id': sample['taxonomy_id'],
+            'model_id': sample.get('model_id', sample['taxonomy_id']),
+            'taxonomy_name': sample.get('taxonomy_name', sample['taxonomy_id']),
+            'label': int(dataset.labels[idx]),
+            'required_labels': list(dataset.options.get('required_labels', [])),
+            'items': {}
+        }
+        files = {}
+        for ri in required_items:
+            file_paths = sample['%s_path' % ri]
+            file_paths = file_paths if type(file_paths) == list else [file_paths]
+            meta['items'][ri] = []
+            for file_path in file_paths:
+                with open(file_path, 'rb') as f:
+                    blob = f.read()
+                if encode is not None:
+                    file_path, blob = encode(file_path, blob)
+                meta['items'][ri].append(normalize_key(file_path))
+                files[file_path] = blob
+        writer.write(meta, files)
+    writer.close()
+    logging.info('Wrote %d samples into %d shards in %s' % (len(dataset.file_list), len(writer.shards), out_dir))
+
+
+class ShardDataset(torch.utils.data.IterableDataset):
+    """Streams samples from the shards listed in <shard_dir>/<prefix>.json.
+
+    Shards are split over distributed ranks and DataLoader workers, reshuffled every epoch, read
+    sequentially by a background thread `read_ahead` samples ahead and mixed in a `shuffle_buffer`.
+    Samples come out exactly like Dataset (or Datasetv0 for segmentation shards), for BatchCollator.
+    """
+    def __init__(self, shard_dir, prefix, options, transforms=None):
+        self.shard_dir = shard_dir
+        self.options = options
+        self.transforms = transforms
+        with open(os.path.join(shard_dir, '%s.json' % prefix)) as f:
+            self.shards = json.load(f)['shards']
+        self.epoch = -1
+
+    def set_epoch(self, epoch):
+        # Optional; persistent workers keep their own copy, so __iter__ also counts epochs itself
+        self.epoch = epoch - 1
+
+    def _consumers(self):
+        rank, world_size = 0, 1
+        if dist.is_available() and dist.is_initialized():
+            rank, world_size = dist.get_rank(), dist.get_world_size()
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info is not None else (0, 1)
+        return rank, world_size, worker_id, num_workers
+
+    def __len__(self):
+        # Per rank, the same on every rank: all ranks must run the same number of steps under DDP
+        _, world_size, _, _ = self._consumers()
+        return -(-sum(s['n_samples'] for s in self.shards) // world_size)
+
+    def _my_shards(self):
+        """Shards read by this worker, and the number of samples it yields from them"""
+        rank, world_size, worker_id, num_workers = self._consumers()
+        order = list(range(len(self.shards)))
+        if self.options['shuffle']:
+            # Same permutation in every consumer, then a disjoint slice each
+            random.Random(self.options.get('seed', 0) + self.epoch).shuffle(order)
+        if len(order) < world_size * num_workers:
+            logging.warning('%d shards for %d consumers; some workers repeat shards' %
+                            (len(order), world_size * num_workers))
+        # Consumers without a shard of their own read the shards of their rank, or all of them
+        rank_order = order[rank::world_size] or order
+        worker_order = rank_order[worker_id::num_workers] or rank_order
+        n_samples = len(self)
+        quota = n_samples // num_workers + (worker_id < n_samples % num_workers)
+        return [self.shards[i]['name'] for i in worker_order], quota
+
+    def _cycle(self, shard_names, n_samples):
+        # Shards are assigned whole, so consumers hold different numbers of samples: wrap around the
+        # shards of the short ones and stop the long ones at their quota
+        while n_samples > 0:
+            n_read = 0
+            for record in self._stream(shard_names):
+                yield record
+                n_read += 1
+                if n_read == n_samples:
+                    return
+            if n_read == 0:
+                return
+            n_samples -= n_read
+
+    def _read(self, shard_names, out, stop):
+        def put(item):
+            # Give up once the consumer has stopped reading, rather than block on a full queue forever
+            while not stop.is_set():
+                try:
+                    out.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            for shard_name in shard_names:
+                with tarfile.open(os.path.join(self.shard_dir, shard_name), 'r|') as tar:
+                    meta, files = None, {}
+                    for member in tar:
+                        blob = tar.extractfile(member).read()
+                        if member.name.startswith(_META_DIR + '/'):
+                            if meta is not None and not put((meta, files)):
+                                return
+                            meta, files = json.loads(blob.decode()), {}
+                        else:
+                            files[member.name] = blob
+                    if meta is not None and not put((meta, files)):
+                        return
+        except Exception as e:
+            put(e)
+        put(None)
+
+    def _stream(self, shard_names):
+        out, stop = queue.Queue(maxsize=self.options.get('read_ahead', 64)), threading.Event()
+        threading.Thread(target=self._read, args=(shard_names, out, stop), daemon=True).start()
+        try:
+            while True:
+                record = out.get()
+                if record is None:
+                    return
+                if isinstance(record, Exception):
+                    raise record
+                yield record
+        finally:
+            stop.set()
+
+    def _build(self, meta, files):
+        data = {}
+        for ri, file_paths in meta['items'].items():
+            rand_idx = random.randint(0, len(file_paths) - 1) if self.options['shuffle'] else 0
+            file_path = file_paths[rand_idx] if ri == 'partial_cloud' else file_paths[0]
+            data[ri] = IO.decode(file_path, files[file_path]).astype(np.float32)
+        if self.transforms is not None:
+            data = self.transforms(data)
+        if meta['required_labels']:
+            data_label = {ri: data.pop(ri) for ri in meta['required_labels']}
+            return meta['taxonomy_id'], meta['taxonomy_name'], data, data_label, np.int64(meta['label'])
+        return meta['taxonomy_id'], meta['taxonomy_id'], data, np.int64(meta['label'])
+
+    def __iter__(self):
+        self.epoch += 1
+        records = self._cycle(*self._my_shards())
+        buffer_size = self.options.get('shuffle_buffer', 1000) if self.options['shuffle'] else 0
+        buffer = []
+        for record in records:
+            if len(buffer) < buffer_size:
+                buffer.append(record)
+                continue
+            if buffer_size > 0:
+                i = random.randrange(buffer_size)
+                record, buffer[i] = buffer[i], record
+            yield self._build(*record)
+        random.shuffle(buffer)
+        for record in buffer:
+            yield self._build(*record)
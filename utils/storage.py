@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+# Storage backends behind IO: raw bytes by file path, one at a time or a whole batch per request.
+
+import glob
+import os
+import pickle
+import queue
+import socket
+import socketserver
+import struct
+import sys
+import tarfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+def normalize_key(key):
+    return os.path.normpath(key)
+
+
+class StorageBackend(object):
+    """Maps file paths to their raw bytes. Subclasses override get, and get_many when batching helps."""
+    is_local = False
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def get_many(self, keys):
+        return [self.get(key) for key in keys]
+
+
+class LocalBackend(StorageBackend):
+    """Plain files. IO reads single files through its path-based readers and batches through get_many"""
+    is_local = True
+
+    def __init__(self, n_threads=8):
+        self.n_threads = n_threads
+        self._pool = None
+        self._pid = None
+
+    def get(self, key):
+        with open(key, 'rb') as f:
+            return f.read()
+
+    def get_many(self, keys):
+        if len(keys) < 2 or self.n_threads < 2:
+            return [self.get(key) for key in keys]
+        if self._pid != os.getpid():
+            self._pool = ThreadPoolExecutor(self.n_threads)
+            self._pid = os.getpid()
+        return list(self._pool.map(self.get, keys))
+
+
+class TarShardBackend(StorageBackend):
+    """Members of uncompressed tar shards, looked up by their (normalised) file path.
+
+    The member index of each shard is built once and saved next to it as <shard>.idx; reads are
+    plain seeks into per-process file handles, sorted by shard and offset within a batch.
+    """
+    def __init__(self, shard_pattern):
+        self.shard_paths = sorted(glob.glob(shard_pattern))
+        if not self.shard_paths:
+            raise Exception('No tar shards match %s' % shard_pattern)
+        self.index = {}
+        for shard_idx, shard_path in enumerate(self.shard_paths):
+            for name, (offset, size) in self._shard_index(shard_path).items():
+                self.index[name] = (shard_idx, offset, size)
+        self._files = None
+        self._pid = None
+
+    @staticmethod
+    def _shard_index(shard_path):
+        index_path = shard_path + '.idx'
+        if os.path.exists(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(shard_path):
+            with open(index_path, 'rb') as f:
+                return pickle.load(f)
+
+        index = {}
+        with tarfile.open(shard_path, 'r:') as tar:
+            for member in tar:
+                if member.isfile():
+                    index[normalize_key(member.name)] = (member.offset_data, member.size)
+        tmp_path = '%s.%d.tmp' % (index_path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, index_path)
+        return index
+
+    def __contains__(self, key):
+        return normalize_key(key) in self.index
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_files'] = state['_pid'] = None
+        return state
+
+    def _read(self, shard_idx, offset, size):
+        if self._pid != os.getpid():
+            # Never share file offsets with the parent or other DataLoader workers
+            self._files = {}
+            self._pid = os.getpid()
+        if shard_idx not in self._files:
+            self._files[shard_idx] = open(self.shard_paths[shard_idx], 'rb')
+        f = self._files[shard_idx]
+        f.seek(offset)
+        return f.read(size)
+
+    def get(self, key):
+        return self._read(*self.index[normalize_key(key)])
+
+    def get_many(self, keys):
+        locations = [self.index[normalize_key(key)] for key in keys]
+        values = [None] * len(keys)
+        for i in sorted(range(len(keys)), key=lambda i: locations[i][:2]):
+            values[i] = self._read(*locations[i])
+        return values
+
+
+# Unix-socket key-value protocol, one round trip per batch:
+#   request  = op (1 byte: G or P) + n (uint32) + n * (len (uint32) + key) [+ n * (len (uint64) + value) for P]
+#   response = n * (len (int64, -1 if missing) + value) for G, one byte for P
+def _send_blob(sock, blob, fmt='<I'):
+    sock.sendall(struct.pack(fmt, len(blob)) + blob)
+
+
+def _recv_exact(sock, n):
+    chunks, remaining = [], n
+    while remaining > 0:
+        chunk = sock.recv(min(remaining, 1 << 20))
+        if not chunk:
+            raise ConnectionError('Connection closed by the key-value server')
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(chunks)
+
+
+def _recv_blob(sock, fmt='<I'):
+    size, = struct.unpack(fmt, _recv_exact(sock, struct.calcsize(fmt)))
+    return None if size < 0 else _recv_exact(sock, size)
+
+
+class KVBackend(StorageBackend):
+    """Client of a KVServer over a Unix socket, with a per-process pool of `pool_size` connections"""
+    def __init__(self, socket_path, pool_size=4):
+        self.socket_path = socket_path
+        self.pool_size = pool_size
+        self._pool = None
+        self._pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_pool'] = state['_pid'] = None
+        return state
+
+    def _acquire(self):
+        if self._pid != os.getpid():
+            self._pool = queue.LifoQueue()
+            self._pid = os.getpid()
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(self.socket_path)
+            return sock
+
+    def _release(self, sock):
+        if self._pool.qsize() < self.pool_size:
+            self._pool.put(sock)
+        else:
+            sock.close()
+
+    def _request(self, op, keys, values=None):
+        sock = self._acquire()
+        try:
+            sock.sendall(op + struct.pack('<I', len(keys)))
+            for key in keys:
+                _send_blob(sock, normalize_key(key).encode())
+            if values is not None:
+                for value in values:
+                    _send_blob(sock, bytes(value), '<Q')
+                _recv_exact(sock, 1)
+                result = None
+            else:
+                result = [_recv_blob(sock, '<q') for _ in keys]
+        except Exception:
+            sock.close()
+            raise
+        self._release(sock)
+        return result
+
+    def get(self, key):
+        return self.get_many([key])[0]
+
+    def get_many(self, keys):
+        values = self._request(b'G', keys)
+        for key, value in zip(keys, values):
+            if value is None:
+                raise KeyError(key)
+        return values
+
+    def put_many(self, keys, values):
+        self._request(b'P', keys, values)
+
+
+class _KVHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        sock, server = self.request, self.server
+        while True:
+            try:
+                op = _recv_exact(sock, 1)
+            except ConnectionError:
+                return
+            n, = struct.unpack('<I', _recv_exact(sock, 4))
+            keys = [_recv_blob(sock).decode() for _ in range(n)]
+            if op == b'P':
+                for key in keys:
+                    server.values[key] = _recv_blob(sock, '<Q')
+                sock.sendall(b'\x01')
+                continue
+
+            response = []
+            for key in keys:
+                value = server.values.get(key)
+                if value is None and server.root is not None:
+                    # Read-through from disk (never outside root), kept for the next epoch
+                    file_path = os.path.abspath(os.path.join(server.root, key))
+                    if file_path.startswith(server.root + os.sep) and os.path.isfile(file_path):
+                        with open(file_path, 'rb') as f:
+                            value = server.values[key] = f.read()
+                response.append(struct.pack('<q', -1) if value is None else struct.pack('<q', len(value)) + value)
+            sock.sendall(b''.join(response))
+
+
+class KVServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Key-value server on a Unix socket; values live in memory, optionally read through from `root`"""
+    daemon_threads = True
+
+    def __init__(self, socket_path, root=None):
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        self.values = {}
+        self.root = os.path.abspath(root) if root is not None else None
+        socketserver.UnixStreamServer.__init__(self, socket_path, _KVHandler)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+class MemcachedBackend(StorageBackend):
+    """The memcached client of the cluster environment (cfg.MEMCACHED)"""
+    def __init__(self, library_path, server_config, client_config):
+        sys.path.append(library_path)
+        import mc
+        self.mc = mc
+        self.client = mc.MemcachedClient.GetInstance(server_config, client_config)
+
+    def get(self, key):
+        pyvector = self.mc.pyvector()
+        self.client.Get(key, pyvector)
+        return self.mc.ConvertBuffer(pyvector).tobytes()
+
+
+_backend = None
+
+
+def get_backend(cfg):
+    global _backend
+    if _backend is None:
+        storage = cfg.STORAGE if 'STORAGE' in cfg else None
+        name = storage.BACKEND if storage is not None else 'local'
+        if cfg.MEMCACHED.ENABLED:
+            name = 'memcached'
+
+        if name == 'local':
+            _backend = LocalBackend(storage.N_THREADS if storage is not None else 8)
+        elif name == 'tar':
+            _backend = TarShardBackend(storage.TAR_SHARDS)
+        elif name == 'kv':
+            _backend = KVBackend(storage.KV_ADDRESS, storage.POOL_SIZE)
+        elif name == 'memcached':
+            _backend = MemcachedBackend(cfg.MEMCACHED.LIBRARY_PATH, cfg.MEMCACHED.SERVER_CONFIG,
+                                        cfg.MEMCACHED.CLIENT_CONFIG)
+        else:
+            raise Exception('Unsupported storage backend: %s' % name)
+    return _backend
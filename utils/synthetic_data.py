@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+# Synthetic datasets in the exact layouts the loaders of utils.data_loaders expect, at any scale, so the data
+# pipeline can be benchmarked (utils.data_benchmark) and exercised without the real datasets.
+# Usage: python -m utils.synthetic_data --root /tmp/pcn-synthetic [--datasets ModelNet40 ScanObjectNN]
+#        [--train-objects 16] [--test-objects 4] [--formats files shards h5]
+#
+# Files go to <root>/<path> for the relative paths in config_pcn ('./datasets/...'), so running with <root> as
+# the working directory (see in_root) makes every loader read the synthetic data. Objects are noisy surface
+# samples of a per-class primitive; partial clouds keep the points on one side of a random plane.
+
+import argparse
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import numpy as np
+
+from config_pcn import cfg
+from utils.data_loaders import DATASET_LOADER_MAPPING, DatasetSubset, code_mapping, label_mapping2, label_mapping3, \
+    label_mapping_partv0
+from utils.io import IO
+from utils.point_codec import qpc_encoder
+from utils.preprocess import write_pcd
+from utils.shards import write_dataset_shards
+
+MODELNET10_CATEGORIES = ['bathtub', 'bed', 'chair', 'desk', 'dresser', 'monitor', 'night_stand', 'sofa', 'table',
+                         'toilet']
+SHAPENETPART_NAMES = ['Airplane', 'Bag', 'Cap', 'Car', 'Chair', 'Earphone', 'Guitar', 'Knife', 'Lamp', 'Laptop',
+                      'Motorbike', 'Mug', 'Pistol', 'Rocket', 'Skateboard', 'Table']
+N_PARTS = 3  # part labels per ShapeNetPart category: 3 * class + {0, 1, 2}, below the 50 of the real dataset
+
+
+@contextlib.contextmanager
+def in_root(root):
+    """Working directory <root>, where the relative dataset paths of config_pcn resolve"""
+    cwd = os.getcwd()
+    if not os.path.exists(root):
+        os.makedirs(root)
+    os.chdir(root)
+    try:
+        yield
+    finally:
+        os.chdir(cwd)
+
+
+def _surface_points(class_idx, n_points, rng):
+    """Points on the surface of the primitive of `class_idx` (sphere, box, cylinder or torus), randomly posed"""
+    kind = class_idx % 4
+    shape_rng = np.random.RandomState(class_idx)
+    scale = shape_rng.uniform(0.5, 1., 3)
+    if kind == 0:
+        points = rng.normal(size=(n_points, 3))
+        points /= np.linalg.norm(points, axis=1, keepdims=True)
+    elif kind == 1:
+        points = rng.uniform(-1, 1, (n_points, 3))
+        axis = rng.randint(0, 3, n_points)
+        points[np.arange(n_points), axis] = np.sign(rng.uniform(-1, 1, n_points))
+    elif kind == 2:
+        theta = rng.uniform(0, 2 * np.pi, n_points)
+        points = np.stack([np.cos(theta), np.sin(theta), rng.uniform(-1, 1, n_points)], 1)
+    else:
+        theta, phi = rng.uniform(0, 2 * np.pi, (2, n_points))
+        ring = 1. + 0.3 * np.cos(phi)
+        points = np.stack([ring * np.cos(theta), ring * np.sin(theta), 0.3 * np.sin(phi)], 1)
+    points = points * scale * rng.uniform(0.8, 1.2)
+    q, _ = np.linalg.qr(rng.normal(size=(3, 3)))
+    points = points @ q + rng.normal(scale=0.01, size=(n_points, 3))
+    # Normalised into the unit sphere, like the preprocessed clouds
+    return (points / np.abs(points).max()).astype(np.float32)
+
+
+def _partial_points(complete, n_points, rng):
+    """The points of `complete` on one side of a random plane through its centre, resampled to n_points"""
+    direction = rng.normal(size=3)
+    kept = complete[complete @ direction > 0]
+    if len(kept) == 0:
+        kept = complete
+    return kept[rng.randint(0, len(kept), n_points)]
+
+
+def _part_labels(class_idx, points):
+    # Parts are slabs along z, so labels are spatially coherent
+    slab = np.clip(((points[:, 2] + 1.) / 2. * N_PARTS).astype(np.int64), 0, N_PARTS - 1)
+    return N_PARTS * class_idx + slab
+
+
+def _write_object(rng, class_idx, complete_path, partial_paths, n_complete, n_partial):
+    complete = _surface_points(class_idx, n_complete, rng)
+    os.makedirs(os.path.dirname(complete_path), exist_ok=True)
+    write_pcd(complete_path, complete)
+    for partial_path in partial_paths:
+        os.makedirs(os.path.dirname(partial_path), exist_ok=True)
+        write_pcd(partial_path, _partial_points(complete, n_partial, rng))
+    return complete
+
+
+def _write_names(file_path, names):
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    np.savetxt(file_path, names, fmt='%s')
+
+
+def generate_shapenet(cfg, n_objects, rng, n_complete=16384, n_partial=2048):
+    """PCN layout: ShapeNet.json, PCN/<subset>/complete/<taxonomy>/<model>.pcd and partial/.../<rendering>.pcd"""
+    categories = []
+    for class_idx, (taxonomy_name, taxonomy_id) in enumerate(sorted(code_mapping.items(), key=lambda x: x[1])):
+        dc = {'taxonomy_id': taxonomy_id, 'taxonomy_name': taxonomy_name}
+        for subset, n in n_objects.items():
+            dc[subset] = [hashlib.md5(('%s/%s/%d' % (taxonomy_id, subset, i)).encode()).hexdigest()
+                          for i in range(n)]
+            for model_id in dc[subset]:
+                complete_path = cfg.DATASETS.SHAPENET.COMPLETE_POINTS_PATH % (subset, taxonomy_id, model_id)
+                if subset == 'test':
+                    partial_paths = [complete_path.replace('complete', 'partial')]
+                else:
+                    partial_paths = [cfg.DATASETS.SHAPENET.PARTIAL_POINTS_PATH % (subset, taxonomy_id, model_id, i)
+                                     for i in range(cfg.DATASETS.SHAPENET.N_RENDERINGS)]
+                _write_object(rng, class_idx, complete_path, partial_paths, n_complete, n_partial)
+        categories.append(dc)
+    os.makedirs(os.path.dirname(cfg.DATASETS.SHAPENET.CATEGORY_FILE_PATH), exist_ok=True)
+    with open(cfg.DATASETS.SHAPENET.CATEGORY_FILE_PATH, 'w') as f:
+        json.dump(categories, f, indent=4)
+
+
+def _generate_named(dataset_cfg, categories, list_path, object_name, n_objects, rng, n_complete, n_partial):
+    # Layout shared by ModelNet40 and ScanObjectNN: <name> lists per subset and
+    # <subset>/complete/<category>/<name>.pcd, partial/<category>/<name>/<name>-<rendering>.pcd when training
+    _write_names(dataset_cfg.CATEGORY_FILE_PATH, categories)
+    obj_id = 0
+    for subset, n in n_objects.items():
+        names = []
+        for class_idx, category in enumerate(categories):
+            for _ in range(n):
+                name = object_name(category, obj_id)
+                complete_path = dataset_cfg.COMPLETE_POINTS_PATH % (subset, category, name)
+                if subset == 'test':
+                    partial_paths = [complete_path.replace('complete', 'partial')]
+                else:
+                    partial_paths = [dataset_cfg.PARTIAL_POINTS_PATH % (subset, category, name, name, i)
+                                     for i in range(dataset_cfg.N_RENDERINGS)]
+                _write_object(rng, class_idx, complete_path, partial_paths, n_complete, n_partial)
+                names.append(name)
+                obj_id += 1
+        _write_names(list_path % subset, names)
+
+
+def generate_modelnet(cfg, n_objects, rng, n_complete=10000, n_partial=1024):
+    """ModelNet40 layout, with the ModelNet10 category list next to it"""
+    categories = sorted(label_mapping2, key=label_mapping2.get)
+    _generate_named(cfg.DATASETS.MODELNET, categories, './datasets/ModelNet40/modelnet40_%s.txt',
+                    lambda category, obj_id: '%s_%04d' % (category, obj_id + 1), n_objects, rng, n_complete,
+                    n_partial)
+    _write_names(cfg.DATASETS.MODELNET.CATEGORY_FILE_PATH.replace('40', '10'), MODELNET10_CATEGORIES)
+
+
+def generate_scanobjectnn(cfg, n_objects, rng, n_complete=2048, n_partial=1024):
+    """ScanObjectNN layout of utils.preprocess.scanobjectnn_jobs, in the cfg.DATASETS.SCANOBNN.TYPE directory"""
+    categories = sorted(label_mapping3, key=label_mapping3.get)
+    _generate_named(cfg.DATASETS.SCANOBNN, categories,
+                    './datasets/%s/scanobjectnn_%%s.txt' % cfg.DATASETS.SCANOBNN.TYPE,
+                    lambda category, obj_id: '%s_%05d' % (category, obj_id), n_objects, rng, n_complete, n_partial)
+
+
+def generate_shapenetpart(cfg, n_objects, rng, n_complete=2048, n_partial=1024):
+    """ShapeNetPartV0 layout: per-point part labels as <name>.txt and packed with the points as <name>.npy"""
+    shapenet_cfg = cfg.DATASETS.SHAPENET
+    categories, obj_id = [], 0
+    taxonomy_ids = sorted(label_mapping_partv0, key=label_mapping_partv0.get)
+    for class_idx, (taxonomy_id, taxonomy_name) in enumerate(zip(taxonomy_ids, SHAPENETPART_NAMES)):
+        dc = {'taxonomy_id': taxonomy_id, 'taxonomy_name': taxonomy_name}
+        for subset, n in n_objects.items():
+            dc[subset] = []
+            for _ in range(n):
+                name = str(obj_id)
+                complete_path = shapenet_cfg.SEG_COMPLETE_POINTS_PATH % (subset, taxonomy_id, name)
+                if subset == 'test':
+                    partial_paths = [complete_path.replace('complete', 'partial')]
+                else:
+                    partial_paths = [shapenet_cfg.SEG_PARTIAL_POINTS_PATH % (subset, taxonomy_id, name, name, i)
+                                     for i in range(shapenet_cfg.N_RENDERINGS)]
+                complete = _write_object(rng, class_idx, complete_path, partial_paths, n_complete, n_partial)
+                labels = _part_labels(class_idx, complete)
+                np.savetxt(shapenet_cfg.COMPLETE_LABELS_PATH % (subset, taxonomy_id, name), labels, fmt='%d')
+                np.save(shapenet_cfg.SEG_PACKED_POINTS_PATH % (subset, taxonomy_id, name),
+                        np.concatenate((complete, labels[:, None].astype(np.float32)), 1))
+                dc[subset].append(name)
+                obj_id += 1
+        categories.append(dc)
+    with open(shapenet_cfg.SEGMENTATION_FILE_PATH, 'w') as f:
+        json.dump(categories, f, indent=4)
+
+
+def generate_modelnet_h5(n_objects, rng, n_points=2048, objects_per_file=2048):
+    """modelnet40_ply_hdf5_2048/ply_data_<subset><i>.h5, read by utils.data_loaders.ModelNet40H5"""
+    import h5py
+    out_dir = './datasets/modelnet40_ply_hdf5_2048'
+    os.makedirs(out_dir, exist_ok=True)
+    for subset, n in n_objects.items():
+        labels = np.repeat(np.arange(len(label_mapping2)), n)
+        rng.shuffle(labels)
+        for file_idx, start in enumerate(range(0, len(labels), objects_per_file)):
+            file_labels = labels[start:start + objects_per_file]
+            with h5py.File(os.path.join(out_dir, 'ply_data_%s%d.h5' % (subset, file_idx)), 'w') as f:
+                f.create_dataset('data', data=np.stack([_surface_points(c, n_points, rng) for c in file_labels]))
+                f.create_dataset('label', data=file_labels.reshape(-1, 1).astype(np.uint8))
+
+
+def generate_shards(cfg, dataset_name, qpc=False, samples_per_shard=1000):
+    """Tar shards of a generated dataset (cfg.DATASETS.SHARDS.DIR), for the Shards loader and the tar backend"""
+    loader = DATASET_LOADER_MAPPING[dataset_name](cfg)
+    encode = qpc_encoder(IO.decode, cfg.STORAGE.QPC_BITS, cfg.STORAGE.QPC_ZSTD) if qpc else None
+    for subset in (DatasetSubset.TRAIN, DatasetSubset.TEST):
+        write_dataset_shards(loader.get_dataset(subset), cfg.DATASETS.SHARDS.DIR,
+                             '%s-%s' % (dataset_name, loader._get_subset(subset)), samples_per_shard, encode)
+
+
+# Loaders of DATASET_LOADER_MAPPING -> the generator writing their files
+GENERATORS = {
+    'ShapeNet': generate_shapenet,
+    'ShapeNetCars': generate_shapenet,
+    'ModelNet40': generate_modelnet,
+    'ModelNet10': generate_modelnet,
+    'ScanObjectNN': generate_scanobjectnn,
+    'ShapeNetPart': generate_shapenetpart,
+}
+
+
+def generate(cfg, root, datasets, n_train=16, n_test=4, formats=('files', ), seed=0):
+    """Writes `datasets` under `root` with n_train/n_test objects per class; `formats` adds packed copies:
+    'shards' (tar), 'qpc' (tar of quantized points) and 'h5' (ModelNet40 point/label arrays)."""
+    n_objects = {'train': n_train, 'test': n_test}
+    with in_root(root):
+        generators = []
+        for dataset_name in datasets:
+            if dataset_name not in GENERATORS:
+                logging.warning('No synthetic layout for %s' % dataset_name)
+            elif GENERATORS[dataset_name] not in generators:
+                generators.append(GENERATORS[dataset_name])
+        for generator in generators:
+            logging.info('Writing %s under %s' % (generator.__name__, root))
+            generator(cfg, n_objects, np.random.RandomState(seed))
+        if 'shards' in formats or 'qpc' in formats:
+            for dataset_name in datasets:
+                if dataset_name in GENERATORS:
+                    generate_shards(cfg, dataset_name, qpc='qpc' in formats)
+        if 'h5' in formats:
+            generate_modelnet_h5(n_objects, np.random.RandomState(seed))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write synthetic datasets in the layouts of utils.data_loaders')
+    parser.add_argument('--root', required=True, help='Directory standing in for the repository root')
+    parser.add_argument('--datasets', nargs='+', default=['ShapeNet', 'ModelNet40', 'ScanObjectNN', 'ShapeNetPart'],
+                        choices=list(GENERATORS))
+    parser.add_argument('--train-objects', type=int, default=16, help='Training objects per class')
+    parser.add_argument('--test-objects', type=int, default=4, help='Test objects per class')
+    parser.add_argument('--formats', nargs='+', default=['files'], choices=['files', 'shards', 'qpc', 'h5'])
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    logging.basicConfig(format='[%(levelname)s] %(asctime)s %(message)s', level=logging.INFO)
+    generate(cfg, os.path.abspath(args.root), args.datasets, args.train_objects, args.test_objects, args.formats,
+             args.seed)